@@ -16,10 +16,16 @@
 # You should have received a copy of the GNU General Public License
 # along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
 
-from platforms.PlatformSelector import PlatformSelector
+import sys
+
+from utils import FileCache, option_list_to_dict
+from platforms.EnsembleDescriptor import EnsembleDescriptor
 
 class EnsembleCollection:
-    '''A container of model-target ensemble pairs'''
+    '''A container of model-target ensemble pairs. Ensembles are stored as
+EnsembleDescriptor objects, which only construct the ensemble when it is
+first used. Ensemble objects constructed elsewhere, such as array ensembles,
+can be added as well.'''
 
     def __init__(self, log_level=0):
         '''Constructor.'''
@@ -28,6 +34,9 @@ class EnsembleCollection:
         self.evaluators = {}
         self.log_level = log_level
 
+        # Packed samples of all ids (see get_packed_samples)
+        self.packed_samples = FileCache()
+
 
     def read_init_file(self, init_filename):
         '''Initialize ensembles from configuration file'''
@@ -62,6 +71,14 @@ class EnsembleCollection:
            are common to all ensemble types. The platform_specific_args argument is
            a dictionary containing options for the specific platform'''
 
+        self.insert_target_ensemble(id, EnsembleDescriptor(simulation_type, directory, reweight_beta, iteration_range,
+                                                           self.log_level,
+                                                           platform_specific_args))
+
+
+    def insert_target_ensemble(self, id, ensemble):
+        '''Add an already constructed target ensemble (or descriptor)'''
+
         if not self.ensembles.has_key(id):
             self.ensembles[id] = {}
 
@@ -69,10 +86,9 @@ class EnsembleCollection:
             print "ERROR: Duplicate target ensemble name: ", id
             sys.exit(1)
     
-        self.ensembles[id]["target"] = PlatformSelector.get_ensemble(simulation_type, directory, reweight_beta, iteration_range,
-                                                                     self.log_level,
-                                                                     platform_specific_args)
-        self.ensembles[id]["model"] = []
+        self.ensembles[id]["target"] = ensemble
+        if not self.ensembles[id].has_key("model"):
+            self.ensembles[id]["model"] = []
 
 
     def add_model_ensemble(self, id, directory, simulation_type, reweight_beta=None, iteration_range=None, 
@@ -81,24 +97,134 @@ class EnsembleCollection:
            are common to all ensemble types. The platform_specific_args argument is
            a dictionary containing options for the specific platform'''
 
+        self.insert_model_ensemble(id, EnsembleDescriptor(simulation_type, directory, reweight_beta, iteration_range,
+                                                          self.log_level,
+                                                          platform_specific_args))
+
+
+    def insert_model_ensemble(self, id, ensemble):
+        '''Add an already constructed model ensemble (or descriptor)'''
+
         if not self.ensembles.has_key(id):
             self.ensembles[id] = {}
 
         if not self.ensembles[id].has_key("model"):
             self.ensembles[id]["model"] = []
 
-        self.ensembles[id]["model"].append({})
-        self.ensembles[id]["model"][-1] = PlatformSelector.get_ensemble(simulation_type, directory, reweight_beta, iteration_range,
-                                                                        self.log_level,
-                                                                        platform_specific_args)
+        self.ensembles[id]["model"].append(ensemble)
 
             
 
+    def get_model_ids(self):
+        '''Ids with a target ensemble and at least one model ensemble, which are
+the ids used in optimizations. Other ids are kept in the collection, since
+their remaining ensembles may be registered later.'''
+        return [name for name in sorted(self.ensembles.keys())
+                if self.ensembles[name].has_key("target") and len(self.ensembles[name].get("model", [])) > 0]
+
+
     def set_evaluator(self, path, simulation_type):
         '''Set the path to an evaluator program for the given simulation_type'''
         self.evaluators[simulation_type] = path
         
 
+    def get_packed_samples(self, parameter_names, prefetcher=None, bootstrap_samples=200, chunk_size=None,
+                           bootstrap_seed=None):
+        '''Samples of the target ensemble and the latest model ensemble of all
+ids with model ensembles, packed into concatenated arrays so that the relative
+entropy derivatives of all ids can be calculated together (see
+Optimizer.calculate_packed_S_rel_derivatives). Since the derivatives are only
+calculated once, all parameters must be linear. Returns a dictionary with the
+ids, the packed target and model samples (PackedSamples), the beta and the
+parameter values of each model ensemble, and the weighted averages of the target
+derivatives of each id with their block bootstrap standard errors.
+
+The packed samples are cached, keyed on the parameter names, the bootstrap
+settings and the ensembles, and packed again when any of the data files of the
+ensembles is modified. They are shared by all optimizers using the collection,
+which must only read them.'''
+
+        names = self.get_model_ids()
+
+        key = [tuple(parameter_names), bootstrap_samples, bootstrap_seed]
+        filenames = []
+        for name in names:
+            for ensemble in [self.ensembles[name]["target"], self.ensembles[name]["model"][-1]]:
+                key.append((name, ensemble.directory, tuple(ensemble.iteration_range)))
+                filenames += ensemble.get_data_filenames()
+        key = tuple(key)
+
+        # Only the samples of the current ensembles are kept
+        if key not in self.packed_samples:
+            self.packed_samples.clear()
+
+        return self.packed_samples.get(key, filenames,
+                                       lambda: self.pack_samples(parameter_names, names, prefetcher,
+                                                                 bootstrap_samples, chunk_size, bootstrap_seed))
+
+
+    def pack_samples(self, parameter_names, names, prefetcher=None, bootstrap_samples=200, chunk_size=None,
+                     bootstrap_seed=None):
+        '''Pack the samples of the target and latest model ensemble of each of
+the ids in names (see get_packed_samples). If a Prefetcher is given, the
+ensembles are released as soon as they have been packed.'''
+
+        import numpy
+        from error_estimation import bootstrap_random_state
+        from platforms.SampleTable import SampleTable
+        from platforms.PackedSamples import PackedSamples
+
+        packed = {"ids": list(names),
+                  "target": PackedSamples(parameter_names),
+                  "model": PackedSamples(parameter_names),
+                  "beta": numpy.empty(len(names)),
+                  "parameter_values": numpy.empty((len(names), len(parameter_names)))}
+
+        for k, name in enumerate(names):
+            target_ensemble = self.ensembles[name]["target"]
+            model_ensemble = self.ensembles[name]["model"][-1]
+
+            if prefetcher != None:
+                prefetcher.wait(target_ensemble)
+                prefetcher.wait(model_ensemble)
+
+            model_evaluator_path = self.evaluators.get(model_ensemble.simulation_type)
+            target_evaluator_path = self.evaluators.get(target_ensemble.simulation_type)
+
+            parameters = model_ensemble.read_parameter_values(parameter_names)
+
+            packed["target"].append(SampleTable.from_ensemble(target_evaluator_path, parameters, target_ensemble,
+                                                              weight=target_ensemble.get_reweight_weights()))
+
+            # The energies restrict the model samples to those that can be reweighted
+            packed["model"].append(SampleTable.from_ensemble(model_evaluator_path, parameters, model_ensemble,
+                                                             weight=model_ensemble.get_reweight_weights(),
+                                                             energy=model_ensemble.get_energies()))
+
+            packed["beta"][k] = model_ensemble.get_beta()
+            packed["parameter_values"][k] = [parameter.get_value() for parameter in parameters]
+
+            if prefetcher != None:
+                prefetcher.release(target_ensemble)
+                prefetcher.release(model_ensemble)
+
+        packed["target"].pack()
+        packed["model"].pack()
+
+        # The target averages do not depend on the parameter values
+        target_samples = packed["target"]
+        target_weights = target_samples.relative_weights(target_samples.log_weights)
+        packed["target_derivatives_avg"] = target_samples.weighted_averages(target_weights, chunk_size)
+        packed["target_derivatives_error"] = target_samples.bootstrap_errors(target_weights, bootstrap_samples,
+                                                                             chunk_size,
+                                                                             bootstrap_random_state(bootstrap_seed))
+
+        if self.log_level >= 1:
+            print "Packed %d target and %d model samples of %d ids" % (len(packed["target"]), len(packed["model"]),
+                                                                       len(names))
+        return packed
+
+
     def __repr__(self):
         '''String representation'''
 
@@ -109,20 +235,19 @@ class EnsembleCollection:
         output += "\n";
 
         for id in self.ensembles.keys():            
-            if not self.ensembles[id].has_key("target"):
-                print "ERROR: Missing target ensemble entry for", id
-                sys.exit(1)
 
-            target = self.ensembles[id]["target"]
+            # Model ensembles may be registered before their target
+            if self.ensembles[id].has_key("target"):
+                target = self.ensembles[id]["target"]
 
-            output += "add_target_ensemble\t"
-            for item in target.get_settings().items():
-                if item[1] != None:
-                    output += "%s:%s\t" % item
-            output += "\n"
+                output += "add_target_ensemble\tid:%s\tsimulation_type:%s\t" % (id, target.simulation_type)
+                for item in target.get_settings().items():
+                    if item[1] != None:
+                        output += "%s:%s\t" % item
+                output += "\n"
 
-            for model in self.ensembles[id]["model"]:
-                output += "add_model_ensemble\t"
+            for model in self.ensembles[id].get("model", []):
+                output += "add_model_ensemble\tid:%s\tsimulation_type:%s\t" % (id, model.simulation_type)
                 for item in model.get_settings().items():
                     if item[1] != None:
                         output += "%s:%s\t" % item
@@ -139,6 +264,5 @@ class EnsembleCollection:
     def option_list_to_ensemble_option_dict(self, option_list):
         '''Defines how a list of options from the command line or configuration
            file is translated into an option dictionary'''
-        option_dict = dict([i.split(":",1) for i in option_list])
-        return option_dict
+        return option_list_to_dict(option_list)
 
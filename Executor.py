@@ -0,0 +1,309 @@
+# Executor.py --- Execution of external programs such as evaluators
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+from abc import ABCMeta, abstractmethod
+import os
+import subprocess
+import threading
+import Queue
+import time
+
+
+class ExecutorException(Exception):
+    '''Exception raised when a job cannot be submitted or fails.'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Job:
+    '''A shell command line executed in a working directory. The exit status
+is available once the job has finished.'''
+
+    def __init__(self, command_line, working_directory):
+        '''Constructor'''
+        self.command_line = command_line
+        self.working_directory = working_directory
+        self.exit_status = None
+        self.finished = threading.Event()
+
+        # Identifier assigned by a batch queue system
+        self.job_id = None
+
+    def set_exit_status(self, exit_status):
+        '''Mark the job as finished'''
+        self.exit_status = exit_status
+        self.finished.set()
+
+    def is_finished(self):
+        '''Whether the job has finished'''
+        return self.finished.is_set()
+
+    def __repr__(self):
+        return "Job(%s, %s)" % (self.working_directory, self.command_line)
+
+
+class Executor:
+    '''Executor base class. Jobs are submitted with submit() and their
+completion is awaited with collect(), which allows several jobs to run
+concurrently on executors supporting it.'''
+
+    # To allow specification of abstract base classes
+    __metaclass__ = ABCMeta
+
+    # Directory in which working directories for jobs are created (None
+    # for the system default). Must be reachable by the hosts running the jobs.
+    scratch_directory = None
+
+    @abstractmethod
+    def submit(self, command_line, working_directory):
+        '''Submit a shell command line to be run in working_directory.
+Returns a Job object.'''
+        pass
+
+    @abstractmethod
+    def wait(self, job):
+        '''Wait for job to finish.'''
+        pass
+
+    def collect(self, job):
+        '''Wait for job to finish. Raises ExecutorException if it failed.'''
+        self.wait(job)
+        if job.exit_status != 0:
+            raise ExecutorException("Job failed with exit status %s: %s" % (job.exit_status, job.command_line))
+
+    def run(self, command_line, working_directory):
+        '''Submit and collect a single job'''
+        job = self.submit(command_line, working_directory)
+        self.collect(job)
+        return job
+
+    def shutdown(self):
+        '''Release resources held by the executor'''
+        pass
+
+
+def run_shell_command(job):
+    '''Run the command line of job in a shell, and store its exit status'''
+    job.set_exit_status(subprocess.call(job.command_line, shell=True, cwd=job.working_directory))
+
+
+class SerialExecutor(Executor):
+    '''Runs each job as a local subprocess when it is submitted.'''
+
+    def submit(self, command_line, working_directory):
+        job = Job(command_line, working_directory)
+        run_shell_command(job)
+        return job
+
+    def wait(self, job):
+        pass
+
+
+class PoolExecutor(Executor):
+    '''Runs jobs as local subprocesses, using a fixed number of worker
+threads. Jobs are started in the order in which they are submitted.'''
+
+    def __init__(self, workers=None):
+        '''Constructor. Defaults to one worker per processor.'''
+        if workers == None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        '''Main loop of the worker threads'''
+        while True:
+            job = self.queue.get()
+            if job == None:
+                return
+            try:
+                run_shell_command(job)
+            except OSError:
+                job.set_exit_status(-1)
+
+    def submit(self, command_line, working_directory):
+        job = Job(command_line, working_directory)
+        self.queue.put(job)
+        return job
+
+    def wait(self, job):
+        # Waiting with a timeout keeps the main thread responsive to interrupts
+        while not job.finished.wait(1.0):
+            pass
+
+    def shutdown(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class BatchQueueExecutor(Executor):
+    '''Runs jobs through a batch queue system. Each job is written to a
+job script in its working directory, which is submitted with submit_command
+(for instance sbatch or qsub). The script records the exit status of the job
+in a file, whose appearance is polled for to detect completion, so the working
+directory must be on a file system shared with the compute nodes.'''
+
+    # Names of the files written in the working directory of a job
+    script_filename = "nettuno_job.sh"
+    exit_status_filename = "nettuno_job.exit_status"
+
+    def __init__(self, submit_command="sbatch", poll_interval=5.0, timeout=None, scratch_directory=None,
+                 script_header=""):
+        '''Constructor. The script_header is inserted at the beginning of
+each job script, and can contain directives for the queue system. If timeout
+(in seconds) is set, jobs that do not finish in time are considered failed.'''
+        self.submit_command = submit_command
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.scratch_directory = scratch_directory
+        self.script_header = script_header
+
+    def write_job_script(self, job):
+        '''Write the job script to the working directory of job. Returns the
+filename of the script.'''
+        script_filename = os.path.join(job.working_directory, self.script_filename)
+        exit_status_filename = os.path.join(job.working_directory, self.exit_status_filename)
+
+        script_file = open(script_filename, 'w')
+        script_file.write("#!/bin/sh\n")
+        script_file.write(self.script_header)
+        script_file.write("cd %s\n" % job.working_directory)
+        script_file.write("%s\n" % job.command_line)
+
+        # Write to a temporary file first, so that a partially
+        # written status is never read
+        script_file.write("echo $? > %s.tmp\n" % exit_status_filename)
+        script_file.write("mv %s.tmp %s\n" % (exit_status_filename, exit_status_filename))
+        script_file.close()
+        os.chmod(script_filename, 0755)
+
+        return script_filename
+
+    def submit_script(self, script_filename, working_directory):
+        '''Submit a job script to the queue. Returns the identifier of the job,
+taken to be the last word printed by the submit command.'''
+        process = subprocess.Popen("%s %s" % (self.submit_command, script_filename), shell=True,
+                                   cwd=working_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise ExecutorException("Submission of %s failed: %s" % (script_filename, output.strip()))
+
+        words = output.split()
+        if len(words) == 0:
+            return None
+        return words[-1]
+
+    def submit(self, command_line, working_directory):
+        job = Job(command_line, working_directory)
+        job.submit_time = time.time()
+        job.job_id = self.submit_script(self.write_job_script(job), working_directory)
+        return job
+
+    def poll(self, job):
+        '''Check whether job has finished, without waiting'''
+        if job.is_finished():
+            return True
+
+        exit_status_filename = os.path.join(job.working_directory, self.exit_status_filename)
+        if os.path.exists(exit_status_filename):
+            exit_status_file = open(exit_status_filename)
+            content = exit_status_file.read().strip()
+            exit_status_file.close()
+            try:
+                job.set_exit_status(int(content))
+            except ValueError:
+                job.set_exit_status(-1)
+            return True
+
+        if self.timeout != None and time.time() - job.submit_time > self.timeout:
+            job.set_exit_status(-1)
+            return True
+
+        return False
+
+    def wait(self, job):
+        while not self.poll(job):
+            time.sleep(self.poll_interval)
+
+
+class LocalBatchQueueExecutor(BatchQueueExecutor):
+    '''Stand-in for a batch queue system, running the job scripts as local
+background processes. Behaves like BatchQueueExecutor in all other respects,
+which allows the batch queue code path to be used without a scheduler.'''
+
+    def __init__(self, poll_interval=0.1, timeout=None, scratch_directory=None, script_header=""):
+        '''Constructor'''
+        BatchQueueExecutor.__init__(self, None, poll_interval, timeout, scratch_directory, script_header)
+        self.processes = {}
+
+    def submit_script(self, script_filename, working_directory):
+        '''Start the job script in the background. The process id is used as
+job identifier.'''
+        output_file = open(os.path.join(working_directory, "nettuno_job.out"), 'w')
+        process = subprocess.Popen(["/bin/sh", script_filename], cwd=working_directory,
+                                   stdout=output_file, stderr=subprocess.STDOUT)
+        output_file.close()
+
+        # The process is kept to be able to reap it once finished
+        self.processes[process.pid] = process
+        return str(process.pid)
+
+    def poll(self, job):
+        finished = BatchQueueExecutor.poll(self, job)
+        process = self.processes.get(int(job.job_id))
+        if process != None and process.poll() != None:
+            del self.processes[int(job.job_id)]
+
+            # The script was killed before recording its exit status
+            if not finished and not BatchQueueExecutor.poll(self, job):
+                job.set_exit_status(process.returncode or -1)
+                finished = True
+        return finished
+
+
+# Executors selectable by name
+executors = {"serial": SerialExecutor,
+             "pool": PoolExecutor,
+             "batch": BatchQueueExecutor,
+             "local_batch": LocalBatchQueueExecutor}
+
+
+def get_executor_names():
+    '''Names of the available executors'''
+    return sorted(executors.keys())
+
+
+def get_executor(name, **executor_args):
+    '''Construct an executor by name. The executor_args are passed on to its
+constructor.'''
+    if not executors.has_key(name):
+        raise ExecutorException("Unknown executor: %s" % name)
+    return executors[name](**executor_args)
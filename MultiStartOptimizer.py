@@ -0,0 +1,170 @@
+# MultiStartOptimizer.py --- Concurrent optimizations from several starting points
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import traceback
+import numpy
+
+from tracing import tracer
+
+
+class MultiStartOptimizer:
+    '''Runs several optimizers on the same EnsembleCollection concurrently, in
+threads. The optimizers may differ in class, starting point and step rule. The
+ensembles, and the data and derivative caches they hold, are shared by all
+optimizers, so the data is only read once. The ensembles are prepared (parameter
+types, iteration ranges, data loaded) before the optimizers are started, so that
+the optimizers only read from them.
+
+The results of the optimizers are compared by the change in relative entropy
+at their final parameters, evaluated by reweighting the model ensembles (see
+Optimizer.scan). The lowest value is the best result.'''
+
+    def __init__(self, optimizers, threads=None, log_level=0):
+        '''Constructor. The optimizers must have the same parameters. By
+default, all optimizers run at the same time.'''
+        self.optimizers = optimizers
+        self.threads = threads
+        self.log_level = log_level
+
+
+    def prepare(self, ensemble_collection):
+        '''Determine parameter types and iteration ranges, and load the data of
+the ensembles used by the optimizers'''
+
+        ensembles = []
+        for name in ensemble_collection.get_model_ids():
+            ensembles += [ensemble_collection.ensembles[name]["target"], ensemble_collection.ensembles[name]["model"][-1]]
+
+        optimizer = self.optimizers[0]
+        optimizer.classify_parameters(ensemble_collection, ensembles)
+        optimizer.detect_iteration_ranges(ensemble_collection, ensembles)
+        for ensemble in ensembles:
+            ensemble.prefetch()
+
+
+    def run_optimizer(self, optimizer, ensemble_collection):
+        '''Run a single optimizer, returning a dictionary with its result'''
+        result = {"optimizer": optimizer.__class__.__name__,
+                  "initial_parameter_values": optimizer.initial_parameter_values,
+                  "parameters": None,
+                  "trajectory": [],
+                  "error": None}
+        try:
+            parameters = optimizer.optimize(ensemble_collection)
+            if parameters != None:
+                result["parameters"] = [parameter.get_value() for parameter in parameters]
+        except Exception, e:
+            if self.log_level >= 1:
+                traceback.print_exc()
+            result["error"] = "%s: %s" % (e.__class__.__name__, e)
+        result["trajectory"] = optimizer.trajectory
+        return result
+
+
+    def optimize(self, ensemble_collection):
+        '''Run all optimizers. Returns the list of results, one for each
+optimizer, and the index of the best result (None if all failed). Each result is
+a dictionary with the final parameter values, the trajectory (list of parameter
+values and relative entropy derivatives of each iteration), the change in
+relative entropy at the final parameters, and the error message of optimizers
+that failed.'''
+
+        self.prepare(ensemble_collection)
+
+        thread_count = self.threads
+        if thread_count == None:
+            thread_count = len(self.optimizers)
+        thread_count = max(1, min(int(thread_count), len(self.optimizers)))
+
+        results = [None]*len(self.optimizers)
+        next_index = [0]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    index = next_index[0]
+                    next_index[0] += 1
+                if index >= len(self.optimizers):
+                    return
+                with tracer.span("multi_start", start=index):
+                    results[index] = self.run_optimizer(self.optimizers[index], ensemble_collection)
+
+        threads = [threading.Thread(target=work) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Compare the final parameters of all optimizers in a single scan
+        finished = [index for index, result in enumerate(results) if result["parameters"] != None]
+        best_index = None
+        if len(finished) > 0:
+            scan = self.optimizers[0].scan(ensemble_collection,
+                                           numpy.array([results[index]["parameters"] for index in finished]))
+            for index, delta_S_rel in zip(finished, scan["delta_S_rel"]):
+                results[index]["delta_S_rel"] = delta_S_rel
+            best_index = finished[int(numpy.argmin(scan["delta_S_rel"]))]
+
+        if self.log_level >= 1:
+            for index, result in enumerate(results):
+                if result["error"] != None:
+                    print "Start %d (%s) failed: %s" % (index, result["optimizer"], result["error"])
+                elif result["parameters"] == None:
+                    print "Start %d (%s) returned no parameters" % (index, result["optimizer"])
+                else:
+                    print "Start %d (%s): %d iterations, delta_S_rel=%g, parameters: %s" % (index, result["optimizer"],
+                                                                                             len(result["trajectory"]),
+                                                                                             result["delta_S_rel"],
+                                                                                             result["parameters"])
+            if best_index != None:
+                print "Best result: start %d, parameters: %s" % (best_index, results[best_index]["parameters"])
+            sys.stdout.flush()
+
+        return results, best_index
+
+
+def read_starts_file(filename):
+    '''Read the settings of the optimizers of a multi-start optimization. Each
+line describes an optimizer with options of the form name:value, for instance
+
+  optimizer:steepest_descent start:1.0,0.8 step_size:0.1 step_decay:0.5 max_iterations:200 step_tolerance:1e-4
+
+where start gives the initial parameter values, and max_iterations, step_tolerance
+and gradient_tolerance tell when the optimizer stops. Returns a list of dictionaries
+of optimizer arguments, with the name of the optimizer under "optimizer".'''
+
+    starts = []
+    starts_file = open(filename)
+    for line in starts_file.readlines():
+        line_split = line.strip().split()
+        if len(line_split) == 0 or line_split[0][0] == "#":
+            continue
+        start = dict([option.split(":", 1) for option in line_split])
+        if start.has_key("start"):
+            start["initial_parameter_values"] = [float(value) for value in start.pop("start").split(",")]
+        for key in ["step_size", "step_decay", "noise_threshold", "step_tolerance", "gradient_tolerance"]:
+            if start.has_key(key):
+                start[key] = float(start[key])
+        if start.has_key("max_iterations"):
+            start["max_iterations"] = int(start["max_iterations"])
+        starts.append(start)
+    starts_file.close()
+    return starts
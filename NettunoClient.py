@@ -0,0 +1,54 @@
+# NettunoClient.py --- Connection to a Nettuno server
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+
+
+class NettunoClient:
+    '''Sends commands to a NettunoServer over its Unix socket. Only the
+standard library is used, so that a command costs no more than the round trip
+to the server.'''
+
+    def __init__(self, socket_filename):
+        '''Constructor'''
+        self.socket_filename = socket_filename
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socket_filename)
+        self.stream = self.connection.makefile("rw")
+
+
+    def send(self, command, **arguments):
+        '''Execute a command on the server. Returns the result, or raises
+an exception with the message of the server if the command failed.'''
+        arguments["command"] = command
+        self.stream.write(json.dumps(arguments) + "\n")
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise IOError("Connection to Nettuno server closed")
+        response = json.loads(line)
+        if response["status"] != "ok":
+            raise RuntimeError(response["message"])
+        return response["result"]
+
+
+    def close(self):
+        '''Close the connection'''
+        self.stream.close()
+        self.connection.close()
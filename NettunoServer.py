@@ -0,0 +1,236 @@
+# NettunoServer.py --- Resident Nettuno process serving requests on a Unix socket
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+import SocketServer
+import numpy
+
+from utils import FileCache
+from platforms.EnsembleDescriptor import EnsembleDescriptor
+
+
+class NettunoRequestHandler(SocketServer.StreamRequestHandler):
+    '''Handles a connection to the server. Each line sent by the client is a
+JSON object with a "command" entry and the arguments of the command, and is
+answered by a line with a JSON object with a "status" entry ("ok" or "error")
+and either a "result" or a "message".'''
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if len(line.strip()) == 0:
+                continue
+            response = self.server.execute(line)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+            if self.server.stopping:
+                # The serving loop is stopped from another thread, since
+                # shutdown waits for it. This is done after the response has
+                # been sent, since the process ends with the loop.
+                threading.Thread(target=self.server.shutdown).start()
+                break
+
+
+class NettunoServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Keeps a Nettuno object, and thereby its ensemble collection, the data
+loaded from the ensemble directories and the derivative caches, in memory
+between commands. Commands are read from a Unix socket (see NettunoClient).
+Each connection is served by a thread of its own. The commands using the
+ensembles (register, optimize and scan) are executed one at a time, in the order
+in which they arrive, while status and shutdown are answered immediately, also
+during a long optimization. Since the caches are validated against the
+modification times of the files they were loaded from, data written by running
+simulations is picked up by the next command.
+
+Supported commands are register, optimize, scan, status and shutdown.'''
+
+    # Connection threads do not keep the server running after shutdown
+    daemon_threads = True
+
+    # Commands that are executed one at a time
+    exclusive_commands = ["register", "optimize", "scan"]
+
+    def __init__(self, socket_filename, nettuno, init_file_output=None, log_level=0):
+        '''Constructor. If init_file_output is set, the settings are written to
+this file after each command that changes them.'''
+        self.socket_filename = socket_filename
+        self.nettuno = nettuno
+        self.init_file_output = init_file_output
+        self.log_level = log_level
+        self.start_time = time.time()
+        self.command_count = 0
+        self.stopping = False
+        self.running_command = None
+        self.command_lock = threading.Lock()
+
+        self.commands = {"register": self.register,
+                         "optimize": self.optimize,
+                         "scan": self.scan,
+                         "status": self.status,
+                         "shutdown": self.shutdown_server}
+
+        self.remove_stale_socket()
+        SocketServer.UnixStreamServer.__init__(self, socket_filename, NettunoRequestHandler)
+
+
+    def remove_stale_socket(self):
+        '''Remove a socket file left behind by a server that is no longer
+running. Refuses to start if another server is listening on it.'''
+        if not os.path.exists(self.socket_filename):
+            return
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_filename)
+        except socket.error:
+            os.remove(self.socket_filename)
+            return
+        finally:
+            connection.close()
+        raise socket.error("A server is already listening on %s" % self.socket_filename)
+
+
+    def run(self):
+        '''Serve requests until a shutdown command is received'''
+        if self.log_level >= 1:
+            print "Nettuno server listening on %s" % self.socket_filename
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_filename):
+                os.remove(self.socket_filename)
+
+
+    def execute(self, line):
+        '''Execute a command given as a line of JSON, and return the response.
+Errors in a command are reported to the client, and do not stop the server.'''
+        try:
+            request = json.loads(line)
+            command = request.pop("command")
+            if not self.commands.has_key(command):
+                raise ValueError("Unknown command: %s" % command)
+            self.command_count += 1
+            if self.log_level >= 1:
+                print "Nettuno server command: %s" % command
+            if command not in self.exclusive_commands:
+                return {"status": "ok", "result": self.commands[command](**request)}
+            with self.command_lock:
+                self.running_command = command
+                try:
+                    return {"status": "ok", "result": self.commands[command](**request)}
+                finally:
+                    self.running_command = None
+        except (Exception, SystemExit), e:
+            if self.log_level >= 1:
+                traceback.print_exc()
+            return {"status": "error", "message": "%s: %s" % (e.__class__.__name__, e)}
+
+
+    def save_settings(self):
+        '''Write the settings to init_file_output, if set'''
+        if self.init_file_output != None:
+            self.nettuno.output_init_file(self.init_file_output)
+
+
+    def register(self, role, options):
+        '''Register a target or model ensemble, given the options of
+--add_target_ensemble or --add_model_ensemble as a dictionary'''
+        options = dict((str(key), str(value)) for key, value in options.items())
+        if role == "target":
+            self.nettuno.get_ensemble_collection().add_target_ensemble(**options)
+        elif role == "model":
+            self.nettuno.get_ensemble_collection().add_model_ensemble(**options)
+        else:
+            raise ValueError("Ensembles are registered as target or model, not %s" % role)
+        self.save_settings()
+        return self.describe_ensembles()
+
+
+    def optimize(self, max_iterations=None):
+        '''Optimize the parameters, optionally with at most max_iterations
+iterations of the optimizer. Returns the parameter names and the optimized
+values.'''
+        parameters = self.nettuno.optimize(max_iterations)
+        self.save_settings()
+        if parameters != None:
+            parameters = [float(parameter.get_value()) for parameter in parameters]
+        return {"parameter_names": self.nettuno.get_optimizer().parameter_names,
+                "parameters": parameters}
+
+
+    def scan(self, parameter_grid, output_filename=None):
+        '''Evaluate the relative entropy derivatives at a grid of parameter
+values, given as a list of rows. Returns the results of Nettuno.scan as lists.'''
+        results = self.nettuno.scan(numpy.array(parameter_grid, dtype=float, ndmin=2), output_filename)
+        return dict((key, numpy.asarray(value).tolist()) for key, value in results.items())
+
+
+    def is_loaded(self, ensemble):
+        '''Whether an ensemble has been constructed (and its data loaded)'''
+        return not isinstance(ensemble, EnsembleDescriptor) or ensemble.is_constructed()
+
+
+    def describe_ensembles(self):
+        '''Directories of the registered ensembles by id, and whether their
+data has been loaded'''
+        description = {}
+        for id, pair in self.nettuno.get_ensemble_collection().ensembles.items():
+            description[id] = {}
+            for role, ensembles in [("target", [pair.get("target")]), ("model", pair.get("model", []))]:
+                ensembles = [ensemble for ensemble in ensembles if ensemble != None]
+                description[id][role] = [{"directory": str(ensemble.get_settings()["directory"]),
+                                          "simulation_type": ensemble.simulation_type,
+                                          "loaded": self.is_loaded(ensemble)}
+                                         for ensemble in ensembles]
+        return description
+
+
+    def status(self):
+        '''Ensembles, number of cache entries by cache, the command being
+executed, and server statistics'''
+        caches = {}
+        for id, pair in self.nettuno.get_ensemble_collection().ensembles.items():
+            for ensemble in [pair.get("target")] + pair.get("model", []):
+                if ensemble == None or not self.is_loaded(ensemble):
+                    continue
+                if isinstance(ensemble, EnsembleDescriptor):
+                    ensemble = ensemble.get_ensemble()
+                for cls in ensemble.__class__.__mro__:
+                    for name, value in cls.__dict__.items():
+                        if isinstance(value, FileCache):
+                            caches["%s.%s" % (cls.__name__, name)] = len(value)
+        return {"ensembles": self.describe_ensembles(),
+                "caches": caches,
+                "running_command": self.running_command,
+                "commands": self.command_count,
+                "uptime": time.time() - self.start_time,
+                "pid": os.getpid()}
+
+
+    def shutdown_server(self):
+        '''Stop the server after answering this command. A command still
+being executed is abandoned.'''
+        self.stopping = True
+        return None
@@ -21,6 +21,12 @@ import numpy
 import copy
 import sys
 
+from error_estimation import block_bootstrap_errors, bootstrap_random_state
+from reweighting import log_sum_exp
+from platforms.SampleTable import SampleTable
+from Prefetcher import Prefetcher
+from tracing import tracer, traced
+
 class ReweightingException(Exception):
     '''Exception raised when there is no support for reweighting'''
     pass
@@ -33,11 +39,36 @@ class Optimizer:
     __metaclass__ = ABCMeta
 
 
-    def __init__(self, log_level):
-        '''Constructor'''
+    def __init__(self, log_level, noise_threshold=None, prefetch_memory=None, memory_budget=None,
+                 auto_iteration_range=False, initial_parameter_values=None, max_iterations=None):
+        '''Constructor. If noise_threshold is set, the optimization stops when
+the relative entropy derivatives are within noise_threshold standard errors of zero.
+If prefetch_memory is set, ensemble data is loaded in the background, reading ahead
+as far as allowed by this memory budget (in bytes). If memory_budget is set,
+averages are calculated in chunks whose temporary arrays fit within this
+budget (in bytes). If auto_iteration_range is set, the iteration range of
+ensembles without one is detected from the samples. The initial_parameter_values
+optionally give the starting point of the optimization. If max_iterations is set,
+the optimization stops after this many evaluations of the relative entropy
+derivatives.'''
         self.parameter_names = []
         self.beta = None
         self.log_level = log_level
+        self.noise_threshold = noise_threshold
+        self.prefetch_memory = prefetch_memory
+        self.memory_budget = memory_budget
+        self.auto_iteration_range = auto_iteration_range
+        self.initial_parameter_values = initial_parameter_values
+        self.max_iterations = max_iterations
+
+        # Parameter values and relative entropy derivatives (summed over
+        # ids) of each iteration of the last optimization
+        self.trajectory = []
+
+        # Number of resamplings used in block bootstrap error estimates, and
+        # the seed of their random number generator
+        self.bootstrap_samples = 200
+        self.bootstrap_seed = 0
 
 
     def read_init_file(self, init_filename):
@@ -96,7 +127,7 @@ class Optimizer:
             maximum_interval = max(maximum_interval, interval)
         for i,data_vector in enumerate(data_vectors):
             interval = data_vector[1,0] - data_vector[0,0]
-            index_intervals[i] = maximum_interval/interval
+            index_intervals[i] = int(maximum_interval/interval)
         
 
         iteration_range = [range_start, range_end]
@@ -121,13 +152,55 @@ class Optimizer:
         return truncated_data_vectors
 
 
+    def classify_parameters(self, ensemble_collection, ensembles):
+        '''Let the ensembles determine the type (linear or nonlinear) of
+parameters not known in advance. Must be called before the derivatives are
+calculated, since linear parameters are treated differently.'''
+
+        for ensemble in ensembles:
+            evaluator_path = ensemble_collection.evaluators.get(ensemble.simulation_type)
+            ensemble.classify_parameters(evaluator_path, ensemble.read_parameter_values(self.parameter_names))
+
+
+    def detect_iteration_ranges(self, ensemble_collection, ensembles):
+        '''Detect the iteration range of the ensembles specifying iteration_range:auto,
+or, if auto_iteration_range is set, no iteration range at all. Must be called before
+any evaluator runs, which are limited to the iteration range.'''
+
+        for ensemble in ensembles:
+            iteration_range = ensemble.get_settings()["iteration_range"]
+            if iteration_range == "auto" or (self.auto_iteration_range and iteration_range == None):
+                evaluator_path = ensemble_collection.evaluators.get(ensemble.simulation_type)
+                parameters = ensemble.read_parameter_values(self.parameter_names)
+                ensemble.detect_iteration_range(evaluator_path, parameters)
+
+                if self.log_level >= 1:
+                    print "Detected iteration range for %s: %s" % (ensemble.directory, ensemble.get_settings()["iteration_range"])
+
+
+    def start_prefetching(self, ensemble_collection, ensemble_pairs):
+        '''Start loading the ensembles in the background, in the order in which
+they are used, given as a list of (target_ensemble, model_ensemble) pairs.
+Returns None if prefetching is disabled.'''
+
+        if self.prefetch_memory == None:
+            return None
+
+        ensembles = []
+        for target_ensemble, model_ensemble in ensemble_pairs:
+            ensembles += [target_ensemble, model_ensemble]
+
+        return Prefetcher(ensembles, self.prefetch_memory, self.log_level).start()
+
+
     def reweighting_support(self, weights):
-        '''Check whether there is support enough for reweighting'''
+        '''Check whether there is support enough for reweighting, given the
+array of reweighting weights of the samples'''
 
-        weights_sum = sum(weights[:,1])
-        p = weights[:,1]/float(weights_sum)
+        weights_sum = numpy.sum(weights)
+        p = weights/float(weights_sum)
 
-        fraction = numpy.exp(-numpy.sum(numpy.log(p) * p))/float(len(weights[:,1]))
+        fraction = numpy.exp(-numpy.sum(numpy.log(p) * p))/float(len(weights))
 
         if self.log_level >= 2:
             print "fraction=", fraction
@@ -136,34 +209,66 @@ class Optimizer:
 
 
 
-    def calculate_first_derivative_averages(self, evaluator_path, parameters, ensemble, weights=None):
-        '''Calculate average of first derivatives for all parameters'''
-        
-        if weights == None:
-            weights = ensemble.scalar_to_ensemble_array(1.0)
+    def get_sample_table(self, evaluator_path, parameters, ensemble, **vectors):
+        '''Collect the derivatives of all parameters over the ensemble in a
+SampleTable, together with the two-column (iteration, value) vectors given as
+keyword arguments (see SampleTable.from_ensemble)'''
+        return SampleTable.from_ensemble(evaluator_path, parameters, ensemble, **vectors)
+
+
+    @traced("calculate_first_derivative_averages")
+    def calculate_first_derivative_averages(self, evaluator_path, parameters, ensemble, weights=None,
+                                            return_errors=False, sample_table=None):
+        '''Calculate average of first derivatives for all parameters. If return_errors
+is set, the block bootstrap standard errors of the averages are returned as well.
+If a sample_table from get_sample_table is given, its derivatives and weights are
+used.'''
+
+        if sample_table == None:
+            vectors = {}
+            if weights is not None:
+                vectors["weight"] = weights
+            sample_table = self.get_sample_table(evaluator_path, parameters, ensemble, **vectors)
+
+        names = [parameter.get_name() for parameter in parameters]
+        chunk_size = self.get_chunk_size(len(parameters))
+
+        derivative_averages = sample_table.weighted_average(names, chunk_size=chunk_size)
 
-        derivative_averages = []
-        for parameter in parameters:
-            derivative_values = ensemble.get_parameter_derivative_values(evaluator_path, parameter)
+        if not return_errors:
+            return derivative_averages
 
-            derivative_values, weights = self.truncate_to_common_iteration_range(derivative_values, 
-                                                                                 weights)
-            derivative_values_avg = numpy.average(derivative_values[:,1], weights=weights[:,1])
-            derivative_averages.append(derivative_values_avg)
+        derivative_errors = block_bootstrap_errors(sample_table.get_columns(names), sample_table.column("weight"),
+                                                   bootstrap_samples=self.bootstrap_samples,
+                                                   random_state=bootstrap_random_state(self.bootstrap_seed),
+                                                   chunk_size=chunk_size)
+        return derivative_averages, derivative_errors
 
-        return numpy.array(derivative_averages)
+
+    def get_chunk_size(self, column_count):
+        '''Number of samples processed at a time when averaging column_count
+columns, such that the double precision temporaries fit within the memory budget.
+None if no memory budget is set.'''
+
+        if self.memory_budget == None:
+            return None
+
+        # A converted copy of the chunk and its weighted values
+        bytes_per_sample = 2*numpy.dtype(numpy.float64).itemsize*column_count
+        return max(1, int(self.memory_budget/bytes_per_sample))
 
 
 
     def calculate_S_rel_derivative(self, parameters, ensemble_collection,
                                    model_ensemble, target_ensemble,
-                                   reweighting = False):
+                                   reweighting = False, return_errors = False):
         '''Calculate derivative of the relative entropy for all parameters. If the reweighting
-flag is set, the calculations will be done according to Ferrenberg-Swendsen'''
+flag is set, the calculations will be done according to Ferrenberg-Swendsen. If return_errors
+is set, the standard errors of the derivatives are returned as well.'''
 
         # Evaluators
-        model_evaluator_path = ensemble_collection.evaluators[model_ensemble.simulation_type]
-        target_evaluator_path = ensemble_collection.evaluators[target_ensemble.simulation_type]
+        model_evaluator_path = ensemble_collection.evaluators.get(model_ensemble.simulation_type)
+        target_evaluator_path = ensemble_collection.evaluators.get(target_ensemble.simulation_type)
 
         # Attempt to get beta from ensemble (model ensemble)
         beta = model_ensemble.get_beta()
@@ -179,7 +284,8 @@ flag is set, the calculations will be done according to Ferrenberg-Swendsen'''
         target_derivatives_avg =  self.calculate_first_derivative_averages(target_evaluator_path, 
                                                                            parameters,  
                                                                            target_ensemble,
-                                                                           weights=reweight_weights)
+                                                                           weights=reweight_weights,
+                                                                           return_errors=return_errors)
 
         ### <dU_M/dlambda>_M ###
 
@@ -191,27 +297,22 @@ flag is set, the calculations will be done according to Ferrenberg-Swendsen'''
         if not reweighting:
 
             # Model energies and weights are stored in the ensemble
-            model_energies_in_model_ensemble = model_ensemble.get_energies()
+            sample_table = self.get_sample_table(model_evaluator_path, parameters, model_ensemble,
+                                                 weight=reweight_weights)
 
         else :
 
-            # Evaluate the model energies and weights with the new parameters
-            model_energies_in_model_ensemble = model_ensemble.calculate_energies(parameters, model_evaluator_path)
-
-            # The weights occording to the original model ensemble
-            model_energies_reference = model_ensemble.get_energies()
-
-            # Truncate so that all vectors agree on indices
-            (model_energies_reference, 
-             reweight_weights,
-             model_energies_in_model_ensemble) = self.truncate_to_common_iteration_range(model_energies_reference,
-                                                                                         reweight_weights,
-                                                                                         model_energies_in_model_ensemble)
+            # Evaluate the model energies and weights with the new parameters.
+            # The table holds the samples for which all values are available.
+            sample_table = self.get_sample_table(model_evaluator_path, parameters, model_ensemble,
+                                                 weight=reweight_weights,
+                                                 energy=model_ensemble.get_energies(),
+                                                 reweighted_energy=model_ensemble.calculate_energies(parameters,
+                                                                                                     model_evaluator_path))
 
             # The reweighting weights (the negative sign is because we use log-weights 
             # instead of energies: lnw = -betaE)
-            w = copy.copy(model_energies_reference)
-            w[:,1] = numpy.exp(model_ensemble.get_beta()*(model_energies_reference[:,1] - model_energies_in_model_ensemble[:,1]))
+            w = numpy.exp(model_ensemble.get_beta()*(sample_table.column("energy") - sample_table.column("reweighted_energy")))
 
             if not self.reweighting_support(w):
                 raise ReweightingException
@@ -219,27 +320,282 @@ flag is set, the calculations will be done according to Ferrenberg-Swendsen'''
             # The two types of reweighting can be combined. In order to avoid
             # problems with the normalization constant, the original weights must be
             # normalized first
-            reweight_weights[:,1]/float(sum(reweight_weights[:,1]))
-            reweight_weights[:,1] *= w[:,1]
+            weights = sample_table.column("weight")
+            weights /= numpy.sum(weights)
+            weights *= w
 
         # Average of derivatives over model ensemble
         model_derivatives_avg = self.calculate_first_derivative_averages(model_evaluator_path, 
                                                                          parameters, 
                                                                          model_ensemble,
-                                                                         weights=reweight_weights)
+                                                                         return_errors=return_errors,
+                                                                         sample_table=sample_table)
+
+        if return_errors:
+            (target_derivatives_avg, target_derivatives_error) = target_derivatives_avg
+            (model_derivatives_avg, model_derivatives_error) = model_derivatives_avg
 
         S_rel_derivative = beta*(target_derivatives_avg - model_derivatives_avg)
 
         if self.log_level >= 2:
             print "target_beta_derivatives_avg=",target_derivatives_avg,"\tmodel_beta_derivatives_avg=",model_derivatives_avg
 
-        return S_rel_derivative
+        if not return_errors:
+            return S_rel_derivative
+
+        # The target and model averages are estimated from independent simulations
+        S_rel_derivative_error = abs(beta)*numpy.sqrt(target_derivatives_error**2 + model_derivatives_error**2)
+
+        if self.log_level >= 2:
+            print "target_derivatives_error=",target_derivatives_error,"\tmodel_derivatives_error=",model_derivatives_error
+
+        return S_rel_derivative, S_rel_derivative_error
+
+
+    def linear_parameters_only(self, ensembles):
+        '''Whether all parameters are linear in all the given ensembles'''
+        for ensemble in ensembles:
+            for parameter in ensemble.read_parameter_values(self.parameter_names):
+                if parameter._type != 'linear':
+                    return False
+        return True
+
+
+    @traced("calculate_packed_S_rel_derivatives")
+    def calculate_packed_S_rel_derivatives(self, packed, parameters=None, return_errors=False):
+        '''Calculate the derivatives of the relative entropy for all parameters
+and all ids packed by EnsembleCollection.get_packed_samples, as
+calculate_S_rel_derivative does for a single id. If parameters are given, the
+model ensembles are reweighted to these parameter values, and ReweightingException
+is raised if there is not support enough for any of them. Returns the derivatives
+of each id (id_count x P), and, if return_errors is set, their standard errors.
+The packed samples are only read.'''
+
+        model_samples = packed["model"]
+        beta = packed["beta"]
+        chunk_size = self.get_chunk_size(len(self.parameter_names))
+
+        ### <dU_M/dlambda>_T ###
+
+        # The derivatives of linear parameters do not change with the parameter
+        # values, so the target averages were calculated when packing
+        target_derivatives_avg = packed["target_derivatives_avg"]
+
+        ### <dU_M/dlambda>_M ###
+
+        log_weights = model_samples.log_weights
+        if parameters != None:
+
+            # The reweighting log-weights -beta*(E(lambda) - E(lambda_M)) of
+            # all samples, extrapolating the energies linearly
+            parameter_deltas = numpy.array([parameter.get_value() for parameter in parameters]) - packed["parameter_values"]
+            reweighting_log_weights = -beta[model_samples.segments]*model_samples.energy_differences(parameter_deltas,
+                                                                                                     chunk_size)
+
+            fractions = model_samples.effective_fractions(model_samples.relative_weights(reweighting_log_weights))
+            if self.log_level >= 2:
+                print "fraction=", fractions
+            if not numpy.all(fractions > 0.5):
+                raise ReweightingException
+
+            log_weights = log_weights + reweighting_log_weights
+
+        model_weights = model_samples.relative_weights(log_weights)
+        model_derivatives_avg = model_samples.weighted_averages(model_weights, chunk_size)
+
+        S_rel_derivatives = beta[:,numpy.newaxis]*(target_derivatives_avg - model_derivatives_avg)
+
+        if self.log_level >= 2:
+            print "target_beta_derivatives_avg=",target_derivatives_avg,"\tmodel_beta_derivatives_avg=",model_derivatives_avg
+
+        if not return_errors:
+            return S_rel_derivatives
+
+        # The target and model averages are estimated from independent simulations
+        target_derivatives_error = packed["target_derivatives_error"]
+        model_derivatives_error = model_samples.bootstrap_errors(model_weights, self.bootstrap_samples, chunk_size,
+                                                                 bootstrap_random_state(self.bootstrap_seed))
+        S_rel_derivative_errors = numpy.abs(beta)[:,numpy.newaxis]*numpy.sqrt(target_derivatives_error**2 +
+                                                                             model_derivatives_error**2)
+
+        if self.log_level >= 2:
+            print "target_derivatives_error=",target_derivatives_error,"\tmodel_derivatives_error=",model_derivatives_error
+
+        return S_rel_derivatives, S_rel_derivative_errors
+
+
+    def record_trajectory(self, parameters, S_rel_derivative):
+        '''Add the relative entropy derivative at the given parameters to the
+trajectory'''
+        self.trajectory.append(([parameter.get_value() for parameter in parameters],
+                                numpy.array(S_rel_derivative)))
+
+
+    def gradient_within_noise(self, gradient, gradient_error):
+        '''Check whether all components of the gradient are within noise_threshold
+standard errors of zero, in which case the gradient cannot be distinguished from
+sampling noise. Always false if no noise_threshold is set.'''
+
+        if self.noise_threshold == None:
+            return False
+
+        return numpy.all(numpy.abs(gradient) <= self.noise_threshold*gradient_error)
+
+
+
+    def scan(self, ensemble_collection, parameter_grid):
+        '''Evaluate the relative entropy derivatives at each row of parameter_grid,
+a K x P array with the values of the P parameters (in the order of add_parameter)
+at K grid points. All points are evaluated by reweighting the latest model ensemble
+of each id. Returns a dictionary of arrays containing the derivatives (K x P) and the
+change in relative entropy relative to the parameters of the model ensembles (K),
+summed over ids, together with the same quantities and the effective sample size of
+the reweighted model ensemble for each id.'''
+
+        parameter_grid = numpy.atleast_2d(numpy.asarray(parameter_grid, dtype=float))
+        if parameter_grid.shape[1] != len(self.parameter_names):
+            raise ValueError("Parameter grid has %d columns, but there are %d parameters" % (parameter_grid.shape[1],
+                                                                                           len(self.parameter_names)))
+
+        names = ensemble_collection.get_model_ids()
+
+        ensembles = []
+        for name in names:
+            ensembles += [ensemble_collection.ensembles[name]["target"], ensemble_collection.ensembles[name]["model"][-1]]
+        self.classify_parameters(ensemble_collection, ensembles)
+        self.detect_iteration_ranges(ensemble_collection, ensembles)
+
+        point_count = len(parameter_grid)
+        S_rel_derivatives = numpy.zeros((len(names), point_count, len(self.parameter_names)))
+        S_rel_differences = numpy.zeros((len(names), point_count))
+        effective_sample_sizes = numpy.zeros((len(names), point_count))
+
+        for i, name in enumerate(names):
+            with tracer.span("scan", id=name, points=point_count):
+                (S_rel_derivatives[i],
+                 S_rel_differences[i],
+                 effective_sample_sizes[i]) = self.scan_ensemble_pair(parameter_grid,
+                                                                      ensemble_collection,
+                                                                      ensemble_collection.ensembles[name]["model"][-1],
+                                                                      ensemble_collection.ensembles[name]["target"])
+
+        return {"parameter_names": numpy.array(self.parameter_names),
+                "parameters": parameter_grid,
+                "ids": numpy.array(names),
+                "S_rel_derivative": numpy.sum(S_rel_derivatives, axis=0),
+                "delta_S_rel": numpy.sum(S_rel_differences, axis=0),
+                "S_rel_derivative_per_id": S_rel_derivatives,
+                "delta_S_rel_per_id": S_rel_differences,
+                "effective_sample_size_per_id": effective_sample_sizes}
+
+
+    def scan_ensemble_pair(self, parameter_grid, ensemble_collection, model_ensemble, target_ensemble):
+        '''Evaluate the relative entropy derivatives, the change in relative entropy
+and the effective sample size of the reweighted model ensemble at all rows of
+parameter_grid, for a single pair of ensembles. The derivatives and weights are
+loaded once, and the grid points are evaluated together with matrix operations.
+For nonlinear parameters, the model energies at all grid points are calculated
+with evaluator runs that are submitted together, and the change in the target
+average of the energy is approximated to first order.'''
+
+        model_evaluator_path = ensemble_collection.evaluators.get(model_ensemble.simulation_type)
+        target_evaluator_path = ensemble_collection.evaluators.get(target_ensemble.simulation_type)
+
+        beta = model_ensemble.get_beta()
+
+        parameters = model_ensemble.read_parameter_values(self.parameter_names)
+        parameter_deltas = parameter_grid - numpy.array([parameter.get_value() for parameter in parameters])
+
+        names = [parameter.get_name() for parameter in parameters]
+
+        ### <dU_M/dlambda>_T ###
+        target_derivatives_avg = self.calculate_first_derivative_averages(target_evaluator_path, parameters,
+                                                                          target_ensemble,
+                                                                          weights=target_ensemble.get_reweight_weights())
+
+        ### <dU_M/dlambda>_M at all grid points ###
+        sample_table = self.get_sample_table(model_evaluator_path, parameters, model_ensemble,
+                                             weight=model_ensemble.get_reweight_weights(),
+                                             energy=model_ensemble.get_energies())
+        derivative_values = sample_table.get_columns(names)
+
+        sample_count = len(sample_table)
+        point_count = len(parameter_grid)
+
+        # Energy differences to the reference parameters, for each sample (rows)
+        # and grid point (columns)
+        if reduce(lambda x,y : x and y, [(parameter._type == 'linear') for parameter in parameters]):
+            energy_differences = None
+        else:
+            parameter_sets = []
+            for k in range(point_count):
+                point_parameters = copy.deepcopy(parameters)
+                for i, parameter in enumerate(point_parameters):
+                    parameter.set_value(parameter_grid[k,i])
+                parameter_sets.append(point_parameters)
+
+            # Surrogate energies need no evaluator runs, and platforms without
+            # batched evaluation calculate the energies point by point
+            if model_ensemble.surrogate_tolerance == None and hasattr(model_ensemble, "evaluate_energies"):
+                point_energies = model_ensemble.evaluate_energies(model_evaluator_path, parameter_sets)
+            else:
+                point_energies = [model_ensemble.calculate_energies(point_parameters, model_evaluator_path)
+                                  for point_parameters in parameter_sets]
+
+            energy_differences = numpy.empty((sample_count, point_count))
+            for k, energies in enumerate(point_energies):
+                energy_differences[:,k] = (sample_table.values_at(energies[:,0], energies[:,1])
+                                           - sample_table.column("energy"))
+
+        with numpy.errstate(divide='ignore'):
+            log_reference_weights = numpy.log(sample_table.column("weight"))
+        log_reference_normalization = log_sum_exp(log_reference_weights)
+
+        S_rel_derivatives = numpy.empty((point_count, len(parameters)))
+        S_rel_differences = numpy.empty(point_count)
+        effective_sample_sizes = numpy.empty(point_count)
+
+        # Grid points are processed in blocks whose samples x points
+        # temporaries fit within the memory budget
+        block_size = point_count
+        if self.memory_budget != None:
+            block_size = max(1, int(self.memory_budget/(3*numpy.dtype(numpy.float64).itemsize*sample_count)))
+
+        for start in range(0, point_count, block_size):
+            block = slice(start, min(start+block_size, point_count))
+
+            if energy_differences is None:
+                block_energy_differences = numpy.dot(derivative_values, parameter_deltas[block].T)
+            else:
+                block_energy_differences = energy_differences[:,block]
+
+            # Normalized weights of the reweighted model ensemble at each grid point
+            log_weights = log_reference_weights[:,numpy.newaxis] - beta*block_energy_differences
+            log_normalizations = log_sum_exp(log_weights, axis=0)
+            weights = numpy.exp(log_weights - log_normalizations)
+            del log_weights, block_energy_differences
+
+            model_derivatives_avg = numpy.dot(weights.T, derivative_values)
+            S_rel_derivatives[block] = beta*(target_derivatives_avg - model_derivatives_avg)
+
+            # S_rel = beta<U>_T + ln Z_M, where the ratio of partition functions
+            # is estimated from the reweighting weights
+            S_rel_differences[block] = (beta*numpy.dot(parameter_deltas[block], target_derivatives_avg)
+                                        + log_normalizations - log_reference_normalization)
+
+            effective_sample_sizes[block] = 1.0/numpy.sum(weights**2, axis=0)
+
+        if self.log_level >= 2:
+            print "Scanned %d parameter points for %s" % (point_count, model_ensemble.directory)
+
+        return S_rel_derivatives, S_rel_differences, effective_sample_sizes
 
 
 
     @abstractmethod
     def optimize(self, ensemble_collection):
-        '''Main method. This method must be overrided by derived classes'''
+        '''Main method. Returns the optimized parameters. This method must be
+overrided by derived classes'''
         pass    
 
 
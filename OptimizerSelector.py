@@ -0,0 +1,84 @@
+# OptimizerSelector.py --- Factory for constructing optimizers of specific type
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import importlib
+
+class UnknownOptimizerException(Exception):
+    '''Exception used when confronted with an unknown optimization algorithm.'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class OptimizerSelector:
+    '''Factory class for constructing optimizers of specific type. Optimizers
+are registered by name together with the module containing their implementation,
+which is only imported when an optimizer of that type is first constructed.'''
+
+    # Maps optimizer name to a dictionary with the module name, class name
+    # and description of the optimizer, and the class itself once it is imported
+    optimizers = {}
+
+    @classmethod
+    def register_optimizer(self, name, module_name, class_name, description=""):
+        '''Register an optimization algorithm. The description is used for
+the command line help without importing the optimizer module.'''
+        self.optimizers[name] = {"module_name": module_name,
+                                 "class_name": class_name,
+                                 "description": description,
+                                 "class": None}
+
+    @classmethod
+    def get_optimizer_names(self):
+        '''Names of all registered optimizers.'''
+        return sorted(self.optimizers.keys())
+
+    @classmethod
+    def get_description(self, name):
+        '''Description of a registered optimizer.'''
+        if not self.optimizers.has_key(name):
+            raise UnknownOptimizerException(name)
+        return self.optimizers[name]["description"]
+
+    @classmethod
+    def get_optimizer_class(self, name):
+        '''Retrieve the Optimizer class registered under name, importing its
+module on first use.'''
+        if not self.optimizers.has_key(name):
+            raise UnknownOptimizerException(name)
+
+        optimizer = self.optimizers[name]
+        if optimizer["class"] == None:
+            module = importlib.import_module(optimizer["module_name"])
+            optimizer["class"] = getattr(module, optimizer["class_name"])
+        return optimizer["class"]
+
+    @classmethod
+    def get_optimizer(self, name, log_level=0, **optimizer_args):
+        '''Construct an optimizer. The optimizer_args are passed on to
+the constructor of the optimizer class.'''
+        return self.get_optimizer_class(name)(log_level, **optimizer_args)
+
+
+# Built-in optimizers
+OptimizerSelector.register_optimizer("steepest_descent", "SteepestDescentOptimizer", "SteepestDescentOptimizer",
+                                     "Steepest descent, using reweighting to continue beyond the sampled parameters")
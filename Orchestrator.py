@@ -0,0 +1,207 @@
+# Orchestrator.py --- Closed loop of simulation, registration and optimization
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+from Executor import SerialExecutor, PoolExecutor, ExecutorException
+
+
+class Orchestrator:
+    '''Runs the optimization cycle without manual intervention. In each round,
+the optimized parameters are written to the settings file of a new model
+ensemble directory for each id, and the simulation command is started there
+through the simulation executor. While the simulations run, the new ensembles are
+registered as soon as they contain data, and the parameters are refined by
+reweighting with the data available so far. When the simulations have finished,
+the optimization continues from the refined parameters with the complete data,
+and the next round starts from the result.
+
+The simulations have an executor of their own, so that they do not occupy the
+workers running evaluator jobs. It must run jobs in the background: the serial
+executor, which runs each job when it is submitted, is not accepted.'''
+
+    def __init__(self, nettuno, simulation_command, simulation_executor=None, rounds=1,
+                 directory_pattern="%(id)s_model%(round)d", poll_interval=60.0, refine_iterations=20,
+                 log_level=0):
+        '''Constructor. The simulation command is run in the new ensemble
+directory, after substituting %(directory)s, %(id)s and %(round)d. New
+directories are named according to directory_pattern, which supports the same
+substitutions except %(directory)s. By default, simulations are run by a pool
+executor with a worker for each id. Each refinement while the simulations run
+is limited to refine_iterations iterations of the optimizer, so that finished
+simulations are noticed in time.'''
+        if isinstance(simulation_executor, SerialExecutor):
+            raise ExecutorException("The serial executor cannot run simulations in the background")
+        self.nettuno = nettuno
+        self.simulation_command = simulation_command
+        self.simulation_executor = simulation_executor
+        self.rounds = rounds
+        self.directory_pattern = directory_pattern
+        self.poll_interval = poll_interval
+        self.refine_iterations = refine_iterations
+        self.log_level = log_level
+
+
+    def create_ensemble_directory(self, id, model_ensemble, parameters):
+        '''Create the directory for the next model ensemble of id, with a
+settings file containing parameters. Returns the directory and the settings
+with which it should be registered.'''
+
+        round = len(self.nettuno.get_ensemble_collection().ensembles[id]["model"])
+        directory = self.directory_pattern % {"id": id, "round": round}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        model_ensemble.write_parameter_values(parameters, directory)
+
+        # The new ensemble inherits all settings except the directory and the
+        # iteration range, which referred to the previous simulation
+        settings = dict(model_ensemble.get_settings())
+        settings["directory"] = directory
+        settings["iteration_range"] = None
+        settings["simulation_type"] = model_ensemble.simulation_type
+
+        return directory, settings
+
+
+    def has_data(self, model_ensemble, settings):
+        '''Whether the simulation in the ensemble directory has produced
+samples. This only checks the size of the data files, which are written with
+the settings of the previous model ensemble.'''
+        return model_ensemble.has_samples(settings["directory"])
+
+
+    def register(self, id, settings):
+        '''Add the new model ensemble to the collection. The collection is saved
+to the init file once per round.'''
+        self.nettuno.get_ensemble_collection().add_model_ensemble(id=id, **settings)
+        if self.log_level >= 1:
+            print "Registered model ensemble: ", settings["directory"]
+
+
+    def refine(self, parameters):
+        '''Optimize using the data available so far, continuing from the given
+parameters. The result is discarded if the data is incomplete, for instance when
+the last line of a data file is still being written.'''
+        try:
+            refined_parameters = self.nettuno.optimize(max_iterations=self.refine_iterations,
+                                                       initial_parameter_values=self.get_values(parameters))
+        except (EnvironmentError, ValueError, IndexError), e:
+            if self.log_level >= 1:
+                print "Refinement skipped, the data is incomplete: ", e
+            return parameters
+
+        if refined_parameters == None:
+            return parameters
+        return refined_parameters
+
+
+    def get_values(self, parameters):
+        '''Values of a list of parameters'''
+        return [parameter.get_value() for parameter in parameters]
+
+
+    def run(self):
+        '''Run the rounds of simulation and optimization. Returns the final
+parameters.'''
+
+        parameters = self.nettuno.optimize()
+        if parameters == None:
+            print "No parameters to simulate with. Aborting."
+            return None
+
+        simulation_executor = self.simulation_executor
+        if simulation_executor == None:
+            simulation_executor = PoolExecutor(max(1, len(self.nettuno.get_ensemble_collection().ensembles)))
+        try:
+            return self.run_rounds(parameters, simulation_executor)
+        finally:
+            if self.simulation_executor == None:
+                simulation_executor.shutdown()
+
+
+    def run_rounds(self, parameters, simulation_executor):
+        '''Run the rounds of simulation and optimization, starting from the
+given parameters. Returns the final parameters.'''
+
+        for round in range(self.rounds):
+
+            if self.log_level >= 1:
+                print "Starting simulations with parameters: ", parameters
+
+            # Start a simulation for each id
+            ensemble_collection = self.nettuno.get_ensemble_collection()
+            simulations = {}
+            for id in ensemble_collection.get_model_ids():
+                model_ensemble = ensemble_collection.ensembles[id]["model"][-1]
+                directory, settings = self.create_ensemble_directory(id, model_ensemble, parameters)
+                command_line = self.simulation_command % {"directory": os.path.abspath(directory),
+                                                          "id": id,
+                                                          "round": len(ensemble_collection.ensembles[id]["model"])}
+                job = simulation_executor.submit(command_line, os.path.abspath(directory))
+                simulations[id] = (job, settings, model_ensemble)
+
+            # Refine the parameters while the simulations run
+            registered = set()
+            refined = False
+            while True:
+                finished = True
+                for id, (job, settings, model_ensemble) in simulations.items():
+                    if hasattr(simulation_executor, "poll"):
+                        simulation_executor.poll(job)
+                    if not job.is_finished():
+                        finished = False
+                    if id not in registered and not job.is_finished() and self.has_data(model_ensemble, settings):
+                        self.register(id, settings)
+                        registered.add(id)
+
+                if finished:
+                    break
+
+                if len(registered) > 0:
+                    parameters = self.refine(parameters)
+                    refined = True
+                    if self.log_level >= 1:
+                        print "Refined parameters: ", parameters
+
+                time.sleep(self.poll_interval)
+
+            # Check for failures, and register the remaining ensembles
+            for id, (job, settings, model_ensemble) in simulations.items():
+                try:
+                    simulation_executor.collect(job)
+                except ExecutorException, e:
+                    print "Simulation for %s failed: %s. Aborting." % (id, e)
+                    return parameters
+
+                if id not in registered:
+                    self.register(id, settings)
+            self.nettuno.output_init_file(self.nettuno.init_filename)
+
+            # Finish the optimization from the refined parameters. Without
+            # refinements, it starts from the parameters of the new ensembles.
+            initial_parameter_values = None
+            if refined:
+                initial_parameter_values = self.get_values(parameters)
+            parameters = self.nettuno.optimize(initial_parameter_values=initial_parameter_values)
+
+            if self.log_level >= 1:
+                print "Parameters after round %d: %s" % (round+1, parameters)
+
+        return parameters
@@ -0,0 +1,120 @@
+# Prefetcher.py --- Background loading of ensemble data
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+class Prefetcher:
+    '''Loads the data of a sequence of ensembles in a background thread, in the
+order in which they will be used, so that reading files for the next ensembles
+overlaps with the calculations on the current one. The memory_budget (in bytes,
+as estimated by Ensemble.estimate_memory) limits how far ahead the prefetcher
+reads: an ensemble is only loaded when the ensembles loaded but not yet released
+leave room for it. An ensemble that is waited for is always loaded, regardless
+of the budget.'''
+
+    def __init__(self, ensembles, memory_budget=None, log_level=0):
+        '''Constructor. ensembles is the list of ensembles in the order in which
+they will be used.'''
+        self.ensembles = list(ensembles)
+        self.memory_budget = memory_budget
+        self.log_level = log_level
+
+        self.condition = threading.Condition()
+        self.loaded_events = [threading.Event() for ensemble in self.ensembles]
+        self.memory_estimates = [0]*len(self.ensembles)
+        self.released = [False]*len(self.ensembles)
+        self.memory_in_use = 0
+        self.stopped = False
+
+        # Index of the furthest ensemble waited for by the consumer
+        self.waiting_for = -1
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+
+    def start(self):
+        '''Start loading in the background'''
+        self.thread.start()
+        return self
+
+
+    def run(self):
+        '''Main loop of the background thread'''
+        for i, ensemble in enumerate(self.ensembles):
+
+            with self.condition:
+                # The same ensemble may appear more than once in the list
+                if self.released[i]:
+                    self.loaded_events[i].set()
+                    continue
+
+                memory_estimate = ensemble.estimate_memory()
+
+                # Wait until there is room within the memory budget
+                while (not self.stopped and self.memory_budget != None and i > self.waiting_for and
+                       self.memory_in_use > 0 and self.memory_in_use + memory_estimate > self.memory_budget):
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                self.memory_estimates[i] = memory_estimate
+                self.memory_in_use += memory_estimate
+
+            if self.log_level >= 3:
+                print "Prefetching ensemble data: ", ensemble.directory
+
+            # Errors are not handled here. The ensemble will encounter the
+            # same error when the data is requested from the main thread.
+            try:
+                ensemble.prefetch()
+            except Exception:
+                pass
+
+            self.loaded_events[i].set()
+
+
+    def wait(self, ensemble):
+        '''Wait until the data of ensemble has been loaded'''
+        for i, prefetched_ensemble in enumerate(self.ensembles):
+            if prefetched_ensemble is ensemble and not self.released[i]:
+                with self.condition:
+                    self.waiting_for = max(self.waiting_for, i)
+                    self.condition.notify_all()
+                self.loaded_events[i].wait()
+                return
+
+
+    def release(self, ensemble):
+        '''Signal that the calculations on ensemble are done, freeing its part
+of the memory budget for ensembles further ahead'''
+        with self.condition:
+            for i, prefetched_ensemble in enumerate(self.ensembles):
+                if prefetched_ensemble is ensemble and not self.released[i]:
+                    self.released[i] = True
+                    self.memory_in_use -= self.memory_estimates[i]
+                    self.memory_estimates[i] = 0
+            self.condition.notify_all()
+
+
+    def stop(self):
+        '''Stop prefetching. Ensembles already being loaded are completed.'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
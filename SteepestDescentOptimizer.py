@@ -19,17 +19,48 @@
 import copy
 import numpy
 from Optimizer import Optimizer, ReweightingException
+from tracing import tracer
 
 class SteepestDescentOptimizer(Optimizer):
     '''Steepest descent optimization class. Works on an EnsembleCollection object'''
 
-    def __init__(self, log_level=0):
-        '''Constructor'''
-        Optimizer.__init__(self, log_level)
+    def __init__(self, log_level=0, noise_threshold=None, prefetch_memory=None, memory_budget=None,
+                 auto_iteration_range=False, initial_parameter_values=None, step_size=0.25, step_decay=0.0,
+                 max_iterations=1000, step_tolerance=None, gradient_tolerance=None):
+        '''Constructor. The step taken in iteration i is step_size/(1 + step_decay*i)
+times the relative entropy derivative. If initial_parameter_values are given, the
+descent starts from these values (in the order of the parameters) rather than from
+a step away from the parameters of the model ensembles.
+
+The descent stops after max_iterations evaluations of the derivatives, when no
+component of a step exceeds step_tolerance, or when no component of the relative
+entropy derivative exceeds gradient_tolerance (if these are set).'''
+        Optimizer.__init__(self, log_level, noise_threshold, prefetch_memory, memory_budget, auto_iteration_range,
+                           initial_parameter_values, max_iterations)
+        self.step_size = step_size
+        self.step_decay = step_decay
+        self.step_tolerance = step_tolerance
+        self.gradient_tolerance = gradient_tolerance
+
+
+    def get_step_size(self, iteration):
+        '''Step size in the given iteration'''
+        return self.step_size/(1.0 + self.step_decay*iteration)
+
+
+    def converged(self, gradient, step):
+        '''Whether the relative entropy derivative or the step is within its
+tolerance'''
+        if self.gradient_tolerance != None and numpy.all(numpy.abs(gradient) <= self.gradient_tolerance):
+            return True
+        if self.step_tolerance != None and numpy.all(numpy.abs(step) <= self.step_tolerance):
+            return True
+        return False
 
 
     def optimize(self, ensemble_collection):
-        '''Optimizes parameters given an ensemble collection'''
+        '''Optimizes parameters given an ensemble collection. Returns the
+optimized parameters.'''
 
         model_selection_index = -1
 
@@ -37,122 +68,238 @@ class SteepestDescentOptimizer(Optimizer):
 
         model_ln_weights_reference = {}
 
+        self.trajectory = []
 
-        # Remove targets with no models
-        for name in ensemble_collection.ensembles.keys():
-            if len(ensemble_collection.ensembles[name]["model"]) == 0:
-                del ensemble_collection.ensembles[name]
+        # Only ids with models are used. The others are left in the
+        # collection, which may be kept between optimizations
+        names = ensemble_collection.get_model_ids()
 
         active_models = {}
-        for name in ensemble_collection.ensembles.keys():
-            model_ensembles = ensemble_collection.ensembles[name]["model"]
-            if len(model_ensembles) > 0:
-                active_models[name] = model_ensembles[-1]
+        for name in names:
+            active_models[name] = ensemble_collection.ensembles[name]["model"][-1]
 
 
         parameters_reference = None
         parameter_delta = numpy.zeros(len(self.parameter_names))
+        parameter_delta_variance = numpy.zeros(len(self.parameter_names))
+
+        # Error estimates are only needed when stopping on noise
+        return_errors = (self.noise_threshold != None)
 
-        print "Before deriv calc. ",ensemble_collection.ensembles.keys()
+        print "Before deriv calc. ",names
+
+        # Determine which parameters are linear, and drop burn-in and
+        # correlated samples before any evaluator runs
+        ensembles = []
+        for name in names:
+            ensembles += [ensemble_collection.ensembles[name]["target"], active_models[name]]
+        self.classify_parameters(ensemble_collection, ensembles)
+        self.detect_iteration_ranges(ensemble_collection, ensembles)
+
+        # Load the data of the next ensembles while the current ones are processed
+        prefetcher = self.start_prefetching(ensemble_collection,
+                                            [(ensemble_collection.ensembles[name]["target"], active_models[name])
+                                             for name in names])
             
         # In the first iteration, we evaluate the averages over the ensembles
-        for name in ensemble_collection.ensembles.keys():
+        with tracer.span("optimizer_iteration", iteration=0):
+
+            # With linear parameters only, the derivatives of all ids are
+            # calculated together in each iteration, from the samples of all
+            # ids packed into concatenated arrays by the collection
+            packed_samples = None
+            if len(names) > 0 and self.linear_parameters_only([active_models[name] for name in names]):
+                packed_samples = ensemble_collection.get_packed_samples(self.parameter_names, prefetcher,
+                                                                        self.bootstrap_samples,
+                                                                        self.get_chunk_size(len(self.parameter_names)),
+                                                                        self.bootstrap_seed)
+
+                S_rel_derivatives = self.calculate_packed_S_rel_derivatives(packed_samples,
+                                                                            return_errors=return_errors)
+                if return_errors:
+                    (S_rel_derivatives, S_rel_derivative_errors) = S_rel_derivatives
+                    parameter_delta_variance += numpy.sum(S_rel_derivative_errors**2, axis=0)
+
+                if self.log_level >= 2:
+                    for name, S_rel_derivative in zip(names, S_rel_derivatives):
+                        print "S_rel_derivative: " , S_rel_derivative, " for id: ", name
+
+                parameter_delta += numpy.sum(S_rel_derivatives, axis=0)
+
+                # Parameters of the last model ensemble, as in the loop below
+                parameters = active_models[names[-1]].read_parameter_values(self.parameter_names)
 
+            else:
+                for name in names:
 
-            target_ensemble = ensemble_collection.ensembles[name]["target"]
-            model_ensemble = active_models.get(name)
 
-            # Read parameters from ensemble directory
-            parameters = model_ensemble.read_parameter_values(self.parameter_names)
+                    target_ensemble = ensemble_collection.ensembles[name]["target"]
+                    model_ensemble = active_models.get(name)
 
-            print "trying to calculate first deriv"
-            S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
-                                                               ensemble_collection,
-                                                               model_ensemble,
-                                                               target_ensemble,
-                                                               reweighting=False)
+                    if prefetcher != None:
+                        prefetcher.wait(target_ensemble)
+                        prefetcher.wait(model_ensemble)
+
+                    # Read parameters from ensemble directory
+                    parameters = model_ensemble.read_parameter_values(self.parameter_names)
+
+                    print "trying to calculate first deriv"
+                    S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
+                                                                       ensemble_collection,
+                                                                       model_ensemble,
+                                                                       target_ensemble,
+                                                                       reweighting=False,
+                                                                       return_errors=return_errors)
+                    if return_errors:
+                        (S_rel_derivative, S_rel_derivative_error) = S_rel_derivative
+                        parameter_delta_variance += S_rel_derivative_error**2
             
             
-            if self.log_level >= 2:
-                print "S_rel_derivative: " , S_rel_derivative, " at parameter: ", parameters
+                    if self.log_level >= 2:
+                        print "S_rel_derivative: " , S_rel_derivative, " at parameter: ", parameters
 
 
-            # print "Starting to reweight"
-            # for i in range(1,15):
-            #     for i,parameter in enumerate(parameters):
-            #         parameter.set_value(parameter.get_value() + 0.1)
+                    # print "Starting to reweight"
+                    # for i in range(1,15):
+                    #     for i,parameter in enumerate(parameters):
+                    #         parameter.set_value(parameter.get_value() + 0.1)
 
-            #     for name in ensemble_collection.ensembles.keys():
+                    #     for name in ensemble_collection.ensembles.keys():
 
-            #         target_ensemble = ensemble_collection.ensembles[name]["target"]
-            #         model_ensemble = active_models[name]
+                    #         target_ensemble = ensemble_collection.ensembles[name]["target"]
+                    #         model_ensemble = active_models[name]
 
-            #         try:
-            #             S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
-            #                                                            ensemble_collection,
-            #                                                            model_ensemble,
-            #                                                            target_ensemble,
-            #                                                            reweighting=True)
-            #         except ReweightingException:
-            #             return
+                    #         try:
+                    #             S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
+                    #                                                            ensemble_collection,
+                    #                                                            model_ensemble,
+                    #                                                            target_ensemble,
+                    #                                                            reweighting=True)
+                    #         except ReweightingException:
+                    #             return
 
-            #         if self.log_level >= 2:
-            #             print "S_rel_derivative_reweighted: " , S_rel_derivative, " at parameter: ", parameters
+                    #         if self.log_level >= 2:
+                    #             print "S_rel_derivative_reweighted: " , S_rel_derivative, " at parameter: ", parameters
                 
 
-            parameters_reference = copy.copy(parameters)
+                    parameters_reference = copy.copy(parameters)
 
-            for i,parameter in enumerate(parameters):
-                parameter_delta[i] += S_rel_derivative[i]
+                    for i,parameter in enumerate(parameters):
+                        parameter_delta[i] += S_rel_derivative[i]
 
+                    if prefetcher != None:
+                        prefetcher.release(target_ensemble)
+                        prefetcher.release(model_ensemble)
+
+            if prefetcher != None:
+                prefetcher.stop()
         
 
-        # Update Parameters
-        parameter_delta = parameter_delta / len(parameter_delta)
-        for name in ensemble_collection.ensembles.keys():        
-            model_ensemble = active_models.get(name)
-            parameters = model_ensemble.read_parameter_values(self.parameter_names)
-            for i,parameter in enumerate(parameters):
-                parameter.set_value(parameter.get_value() - 0.25*parameter_delta[i])
-            if self.log_level >= 2:
-                print "parameters: ", parameters
+            self.record_trajectory(parameters, parameter_delta)
+
+            # Stop if the gradient cannot be distinguished from sampling noise
+            if (return_errors and self.initial_parameter_values == None and
+                self.gradient_within_noise(parameter_delta, numpy.sqrt(parameter_delta_variance))):
+                if self.log_level >= 1:
+                    print "S_rel derivative is within its error bars: %s +/- %s. Longer simulations are needed to improve the parameters." % (parameter_delta, numpy.sqrt(parameter_delta_variance))
+                return parameters
+
+            # Update Parameters
+            parameter_delta = parameter_delta / len(parameter_delta)
+            for name in names:
+                model_ensemble = active_models.get(name)
+                parameters = model_ensemble.read_parameter_values(self.parameter_names)
+                for i,parameter in enumerate(parameters):
+                    if self.initial_parameter_values == None:
+                        parameter.set_value(parameter.get_value() - self.get_step_size(0)*parameter_delta[i])
+                    else:
+                        parameter.set_value(float(self.initial_parameter_values[i]))
+                if self.log_level >= 2:
+                    print "parameters: ", parameters
 
         # Continue as long as we have enough support for reweighting
+        iteration = 0
         while True:
-            parameter_delta = numpy.zeros(len(self.parameter_names))
+            iteration += 1
 
-            # In the remaining iterations, we use reweighting to estimate the derivatives
-            for name in ensemble_collection.ensembles.keys():
+            if self.max_iterations != None and iteration >= self.max_iterations:
+                if self.log_level >= 1:
+                    print "Maximum number of iterations (%d) reached. Stopping at parameters: %s" % (self.max_iterations, parameters)
+                return parameters
 
-                target_ensemble = ensemble_collection.ensembles[name]["target"]
-                model_ensemble = active_models[name]
+            with tracer.span("optimizer_iteration", iteration=iteration):
+                parameter_delta = numpy.zeros(len(self.parameter_names))
+                parameter_delta_variance = numpy.zeros(len(self.parameter_names))
 
-                try:
-                    S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
-                                                                       ensemble_collection,
-                                                                       model_ensemble,
-                                                                       target_ensemble,
-                                                                       reweighting=True)
-                except ReweightingException:
-                    return
+                # In the remaining iterations, we use reweighting to estimate the derivatives
+                if packed_samples != None:
+                    try:
+                        S_rel_derivatives = self.calculate_packed_S_rel_derivatives(packed_samples, parameters,
+                                                                                    return_errors=return_errors)
+                    except ReweightingException:
+                        return parameters
 
-                if self.log_level >= 2:
-                    print "S_rel_derivative_reweighted: " , S_rel_derivative
+                    if return_errors:
+                        (S_rel_derivatives, S_rel_derivative_errors) = S_rel_derivatives
+                        parameter_delta_variance += numpy.sum(S_rel_derivative_errors**2, axis=0)
 
+                    if self.log_level >= 2:
+                        for name, S_rel_derivative in zip(packed_samples["ids"], S_rel_derivatives):
+                            print "S_rel_derivative_reweighted: " , S_rel_derivative, " for id: ", name
 
-                for i,parameter in enumerate(parameters):
-                    parameter_delta[i] += S_rel_derivative[i]
+                    parameter_delta += numpy.sum(S_rel_derivatives, axis=0)
+
+                else:
+                    for name in names:
+
+                        target_ensemble = ensemble_collection.ensembles[name]["target"]
+                        model_ensemble = active_models[name]
+
+                        try:
+                            S_rel_derivative = self.calculate_S_rel_derivative(parameters, 
+                                                                               ensemble_collection,
+                                                                               model_ensemble,
+                                                                               target_ensemble,
+                                                                               reweighting=True,
+                                                                               return_errors=return_errors)
+                        except ReweightingException:
+                            return parameters
+
+                        if return_errors:
+                            (S_rel_derivative, S_rel_derivative_error) = S_rel_derivative
+                            parameter_delta_variance += S_rel_derivative_error**2
+
+                        if self.log_level >= 2:
+                            print "S_rel_derivative_reweighted: " , S_rel_derivative
+
+
+                        for i,parameter in enumerate(parameters):
+                            parameter_delta[i] += S_rel_derivative[i]
 
 #                for i,parameter in enumerate(parameters):
 #                    parameter.set_value(parameter.get_value() - 0.25*S_rel_derivative[i])
 
-        # Update Parameters
-            parameter_delta = parameter_delta / len(parameter_delta)
-            for name in ensemble_collection.ensembles.keys():        
-                model_ensemble = active_models.get(name)
+                self.record_trajectory(parameters, parameter_delta)
+
+                # Stop when the reweighted gradient is dominated by sampling noise
+                if return_errors and self.gradient_within_noise(parameter_delta, numpy.sqrt(parameter_delta_variance)):
+                    if self.log_level >= 1:
+                        print "Reweighted S_rel derivative is within its error bars: %s +/- %s. Stopping at parameters: %s" % (parameter_delta, numpy.sqrt(parameter_delta_variance), parameters)
+                    return parameters
+
+                # Stop when the descent has converged
+                if self.converged(parameter_delta, self.get_step_size(iteration)*parameter_delta/len(parameter_delta)):
+                    if self.log_level >= 1:
+                        print "S_rel derivative %s is within tolerance. Stopping at parameters: %s" % (parameter_delta, parameters)
+                    return parameters
+
+            # Update Parameters
+                parameter_delta = parameter_delta / len(parameter_delta)
+                for name in names:
+                    model_ensemble = active_models.get(name)
    #             parameters = model_ensemble.read_parameter_values(self.parameter_names)
-                for i,parameter in enumerate(parameters):
-                    parameter.set_value(parameter.get_value() - 0.25*parameter_delta[i])
-                if self.log_level >= 2:
-                    print "parameters: ", parameters
+                    for i,parameter in enumerate(parameters):
+                        parameter.set_value(parameter.get_value() - self.get_step_size(iteration)*parameter_delta[i])
+                    if self.log_level >= 2:
+                        print "parameters: ", parameters
  
@@ -0,0 +1,312 @@
+# error_estimation.py --- Statistical uncertainty of ensemble averages
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+
+# Seed of the random number generator used for block bootstrap resampling,
+# unless another generator is given
+default_bootstrap_seed = 0
+
+
+def weighted_average(values, weights, chunk_size=None):
+    '''Weighted average of each column of values (an N x P array) with the
+weights given as an array of length N. The sums are accumulated in double
+precision, converting at most chunk_size rows of values at a time, so that values
+stored in single precision are never converted as a whole.'''
+
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    if chunk_size == None:
+        chunk_size = len(weights)
+    chunk_size = max(1, chunk_size)
+
+    weighted_sum = numpy.zeros(values.shape[1:], dtype=numpy.float64)
+    for start in range(0, len(weights), chunk_size):
+        end = min(start+chunk_size, len(weights))
+        weighted_sum += numpy.dot(weights[start:end], values[start:end].astype(numpy.float64, copy=False))
+
+    return weighted_sum/numpy.sum(weights)
+
+
+def segment_sums(values, starts, weights=None, chunk_size=None):
+    '''Sums of the rows of values (an array of length N, or an N x P array)
+within consecutive segments, where segment k consists of rows starts[k] up to
+the start of the next segment (or N). The rows are optionally multiplied by
+weights (an array of length N) first. All segments are reduced together with
+numpy.add.reduceat, converting at most chunk_size rows of values at a time.
+Empty segments sum to zero.'''
+
+    values = numpy.asarray(values)
+    starts = numpy.asarray(starts, dtype=int)
+    ends = numpy.append(starts[1:], len(values))
+    sums = numpy.zeros((len(starts),) + values.shape[1:], dtype=numpy.float64)
+
+    if chunk_size == None:
+        chunk_size = len(values)
+    chunk_size = max(1, chunk_size)
+
+    for start in range(0, len(values), chunk_size):
+        end = min(start+chunk_size, len(values))
+
+        # Non-empty segments overlapping the chunk, and where they start in it
+        segments = numpy.flatnonzero((starts < end) & (ends > start) & (ends > starts))
+        chunk_starts = numpy.maximum(starts[segments], start) - start
+
+        chunk_values = values[start:end].astype(numpy.float64, copy=False)
+        if weights is not None:
+            if chunk_values.ndim == 1:
+                chunk_values = chunk_values*weights[start:end]
+            else:
+                chunk_values = chunk_values*weights[start:end,numpy.newaxis]
+        sums[segments] += numpy.add.reduceat(chunk_values, chunk_starts, axis=0)
+
+    return sums
+
+
+def default_block_size(sample_count):
+    '''Block size used when none is specified: the square root of the number of
+samples, which grows with the length of the simulation while still leaving
+enough blocks for the error estimate'''
+    return max(1, int(numpy.sqrt(sample_count)))
+
+
+def block_sums(values, weights, block_size, chunk_size=None):
+    '''Sum weighted values and weights within consecutive blocks of samples.
+values is an N x P array (one column per observable) and weights is an array of
+length N. Samples that do not fill up a complete block at the end are discarded.
+The sums are accumulated in double precision, processing at most chunk_size
+samples (rounded to whole blocks) at a time.
+Returns the (block_count x P) weighted value sums and the block_count weight sums'''
+
+    values = numpy.asarray(values)
+    if values.ndim == 1:
+        values = values[:,numpy.newaxis]
+    weights = numpy.asarray(weights, dtype=float)
+
+    block_count = len(weights)/block_size
+    length = block_count*block_size
+
+    if chunk_size == None:
+        chunk_size = length
+    chunk_size = max(1, chunk_size/block_size)*block_size
+
+    weighted_value_sums = numpy.empty((block_count, values.shape[1]))
+    for start in range(0, length, chunk_size):
+        end = min(start+chunk_size, length)
+        weighted_values = values[start:end]*weights[start:end,numpy.newaxis]
+        weighted_value_sums[start/block_size:end/block_size] = weighted_values.reshape(-1, block_size, values.shape[1]).sum(axis=1)
+    weight_sums = weights[:length].reshape(block_count, block_size).sum(axis=1)
+
+    return weighted_value_sums, weight_sums
+
+
+def block_average_errors(values, weights, block_size=None, chunk_size=None):
+    '''Standard error of the weighted averages of each column of values,
+estimated by block averaging. Blocks must be longer than the correlation time
+of the samples for the estimate to be reliable.'''
+
+    if block_size == None:
+        block_size = default_block_size(len(weights))
+
+    weighted_value_sums, weight_sums = block_sums(values, weights, block_size, chunk_size)
+    block_count = len(weight_sums)
+    if block_count < 2:
+        return numpy.repeat(numpy.nan, weighted_value_sums.shape[1])
+
+    # Weighted block averages and their deviation from the overall average
+    total_weight = numpy.sum(weight_sums)
+    average = numpy.sum(weighted_value_sums, axis=0)/total_weight
+    deviations = weighted_value_sums - weight_sums[:,numpy.newaxis]*average
+
+    # Variance of a ratio estimator over the blocks
+    variance = numpy.sum(deviations**2, axis=0)/(total_weight**2) * block_count/float(block_count-1)
+
+    return numpy.sqrt(variance)
+
+
+def bootstrap_random_state(seed=None):
+    '''Random number generator for the resampling of a block bootstrap. The
+global numpy generator is not used, so that error estimates are reproducible
+and independent of other users of random numbers.'''
+    if seed == None:
+        seed = default_bootstrap_seed
+    return numpy.random.RandomState(seed)
+
+
+def block_bootstrap_errors(values, weights, block_size=None, bootstrap_samples=200, random_state=None,
+                           chunk_size=None):
+    '''Standard error of the weighted averages of each column of values,
+estimated by a block bootstrap. All bootstrap samples for all columns are
+calculated as a single matrix product between a (bootstrap_samples x block_count)
+resampling matrix and the block sums. The resampling is drawn from random_state
+(a numpy RandomState), by default seeded with default_bootstrap_seed.'''
+
+    if block_size == None:
+        block_size = default_block_size(len(weights))
+
+    if random_state == None:
+        random_state = bootstrap_random_state()
+
+    weighted_value_sums, weight_sums = block_sums(values, weights, block_size, chunk_size)
+    return bootstrap_block_sums(weighted_value_sums, weight_sums, bootstrap_samples, random_state)
+
+
+def bootstrap_block_sums(weighted_value_sums, weight_sums, bootstrap_samples, random_state):
+    '''Block bootstrap standard errors of the weighted averages, given the
+block sums of block_sums'''
+
+    block_count = len(weight_sums)
+    if block_count < 2:
+        return numpy.repeat(numpy.nan, weighted_value_sums.shape[1])
+
+    # Each row contains how many times each block is drawn in one bootstrap sample
+    resampling = random_state.multinomial(block_count, [1.0/block_count]*block_count,
+                                          size=bootstrap_samples).astype(float)
+
+    bootstrap_averages = numpy.dot(resampling, weighted_value_sums) / numpy.dot(resampling, weight_sums)[:,numpy.newaxis]
+
+    return numpy.std(bootstrap_averages, axis=0, ddof=1)
+
+
+def segment_block_bootstrap_errors(values, weights, offsets, bootstrap_samples=200, random_state=None,
+                                   chunk_size=None):
+    '''Block bootstrap standard errors of the weighted averages of each column
+of values, for each of the segments of samples offsets[k]:offsets[k+1]. Each
+segment is divided into blocks as by block_bootstrap_errors with the default
+block size, and the block sums of all segments are calculated together with
+segment_sums. Returns a (segment_count x P) array. The resampling is drawn
+from random_state as by block_bootstrap_errors.'''
+
+    if random_state == None:
+        random_state = bootstrap_random_state()
+
+    values = numpy.asarray(values)
+    if values.ndim == 1:
+        values = values[:,numpy.newaxis]
+    weights = numpy.asarray(weights, dtype=float)
+    offsets = numpy.asarray(offsets, dtype=int)
+
+    sample_counts = numpy.diff(offsets)
+    block_sizes = numpy.maximum(1, numpy.sqrt(sample_counts).astype(int))
+    block_counts = sample_counts/block_sizes
+
+    # Start of each block, followed by the start of the incomplete block at
+    # the end of each segment, whose sums are discarded
+    segments = numpy.repeat(numpy.arange(len(sample_counts)), block_counts+1)
+    first_entries = numpy.cumsum(block_counts+1) - (block_counts+1)
+    block_indices = numpy.arange(len(segments)) - first_entries[segments]
+    starts = offsets[segments] + block_indices*block_sizes[segments]
+
+    weighted_value_sums = segment_sums(values, starts, weights, chunk_size)
+    weight_sums = segment_sums(weights, starts)
+
+    errors = numpy.empty((len(sample_counts), values.shape[1]))
+    for k in range(len(sample_counts)):
+        blocks = slice(first_entries[k], first_entries[k]+block_counts[k])
+        errors[k] = bootstrap_block_sums(weighted_value_sums[blocks], weight_sums[blocks], bootstrap_samples,
+                                         random_state)
+    return errors
+
+
+def autocorrelation(values):
+    '''Normalized autocorrelation function of each column of values (an N x P
+array, or a single series of length N), calculated with FFTs. Columns without
+fluctuations have an autocorrelation of zero beyond lag zero.'''
+
+    values = numpy.asarray(values, dtype=float)
+    single_series = (values.ndim == 1)
+    if single_series:
+        values = values[:,numpy.newaxis]
+
+    sample_count = values.shape[0]
+    deviations = values - numpy.mean(values, axis=0)
+
+    # Zero padding to avoid circular correlations
+    fft_size = 1
+    while fft_size < 2*sample_count:
+        fft_size *= 2
+    transform = numpy.fft.rfft(deviations, n=fft_size, axis=0)
+    covariance = numpy.fft.irfft(transform*numpy.conjugate(transform), n=fft_size, axis=0)[:sample_count]
+
+    # Normalize by the number of terms in each lag, and by the variance
+    covariance /= (sample_count - numpy.arange(sample_count))[:,numpy.newaxis]
+    variance = covariance[0].copy()
+    variance[variance <= 0] = numpy.inf
+    correlation = covariance/variance
+
+    if single_series:
+        return correlation[:,0]
+    return correlation
+
+
+def statistical_inefficiency(values):
+    '''Statistical inefficiency g = 1 + 2*tau of each column of values, where
+tau is the integrated autocorrelation time in units of samples. The sum over
+lags is truncated where the autocorrelation first drops to zero. Consecutive
+samples separated by g are approximately uncorrelated.'''
+
+    correlation = autocorrelation(values)
+    single_series = (correlation.ndim == 1)
+    if single_series:
+        correlation = correlation[:,numpy.newaxis]
+
+    sample_count = correlation.shape[0]
+    lags = numpy.arange(sample_count)
+
+    # Only include lags before the first non-positive correlation
+    non_positive = correlation <= 0
+    non_positive[0] = False
+    non_positive[-1] = True
+    cutoffs = numpy.argmax(non_positive, axis=0)
+    included = lags[:,numpy.newaxis] < cutoffs[numpy.newaxis,:]
+    included[0] = False
+
+    terms = (1.0 - lags/float(sample_count))[:,numpy.newaxis]*correlation*included
+    inefficiency = numpy.maximum(1.0, 1.0 + 2.0*numpy.sum(terms, axis=0))
+
+    if single_series:
+        return inefficiency[0]
+    return inefficiency
+
+
+def detect_equilibration(values, candidate_count=50):
+    '''Detect the end of the equilibration period of a series of values as the
+start index that maximizes the number of effectively uncorrelated samples
+remaining, (N-start)/g. Candidate starts are spread evenly over the first half
+of the series. Returns the start index and the statistical inefficiency of the
+remaining values.'''
+
+    values = numpy.asarray(values, dtype=float)
+    sample_count = len(values)
+    if sample_count < 4:
+        return 0, 1.0
+
+    candidates = numpy.unique(numpy.linspace(0, sample_count/2, candidate_count).astype(int))
+
+    best_start = 0
+    best_inefficiency = 1.0
+    best_effective_count = -1.0
+    for start in candidates:
+        inefficiency = statistical_inefficiency(values[start:])
+        effective_count = (sample_count - start)/inefficiency
+        if effective_count > best_effective_count:
+            best_start = start
+            best_inefficiency = inefficiency
+            best_effective_count = effective_count
+
+    return best_start, best_inefficiency
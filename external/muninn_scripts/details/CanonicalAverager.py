@@ -27,62 +27,48 @@ from numpy import exp, log, sum, min, array
 from utils import log_sum_exp
 
 class CanonicalAverager(CanonicalBase):
-    def __init__(self, statics_log_filename, which=-1):
-        CanonicalBase.__init__(self, statics_log_filename, which)
+    def __init__(self, statics_log_filename, which=-1, cache_dir=None):
+        CanonicalBase.__init__(self, statics_log_filename, which, cache_dir)
 
-    def calc_bin(self, energy):
+    def fixed_energies(self, energies):
         """
-        Calculate the bin number for the given energy. A value of -1
-        or len(self.binning), mean that the energy falls outside the
-        bin boundaries.
+        Make a CanonicalAveragerFixedEnergies for the energies, which
+        shares the lnG estimate of this object.
         """
-        return numpy.searchsorted(self.binning, energy, side='right') - 1       
+        return CanonicalAveragerFixedEnergies(None, energies, estimate=self)
 
-    def calc_weights(self, energies, beta=1.0):
+    def calc_log_weights_multi(self, energies, betas):
         """
-        Calculate the canonical weights to be in a canonical average
-        for a list of energies.
+        Calculate the logarithm of the canonical weights for a list of
+        energies at each beta in the array betas. Returns an array of
+        shape (len(betas), len(energies)), where energies without
+        support have the log-weight -inf.
         """
+        bin_numbers = self.calc_bin_numbers(energies)
+        log_P = self.calc_log_bin_weights(self.calc_histogram(energies), betas)
+        return log_P[:,bin_numbers]
 
-        # Make a histogram of the energies
-        histogram = numpy.histogram(energies, bins=self.binning)[0]
-
-        # In some versions of numpy, there will be an extra bin, with
-        # values faling outside the histogram
-        if len(histogram)==len(self.lnG_support)+1:
-            histogram = histogram[:-1]
-
-        # Calculate the support between lnG and the histogram
-        support = self.lnG_support & (histogram>0)
-
-        if (numpy.any(support)):
-            # Calculate the probability of each bin according to the
-            # canonical ensemble within the common support
-            lnGs = self.lnG[support]
-            Es = self.bin_centers[support]
-
-            lnZ = log_sum_exp(lnGs - beta*Es)
-
-            P = numpy.zeros(support.shape)
-            P[support] = exp(lnGs - beta*Es - lnZ)
-
-            # Normalize the probabilities by the counts in the histogram
-            P[support] /=  histogram[support]
-
-            # Calculate the weight for each energy
-            weights = []
-
-            for energy in energies:
-                bin_number = self.calc_bin(energy)
+    def calc_weights_multi(self, energies, betas):
+        """
+        Calculate the canonical weights for a list of energies at each
+        beta in the array betas. Returns an array of shape
+        (len(betas), len(energies)).
+        """
+        return exp(self.calc_log_weights_multi(energies, betas))
 
-                if 0 <= bin_number < len(self.bin_centers):
-                    weights.append(P[bin_number])
-                else:
-                    weights.append(0.0)
+    def calc_log_weights(self, energies, beta=1.0):
+        """
+        Calculate the logarithm of the canonical weights for a list
+        of energies.
+        """
+        return self.calc_log_weights_multi(energies, [beta])[0]
 
-            return weights
-        else:
-            return [0.0 for energy in energies]
+    def calc_weights(self, energies, beta=1.0):
+        """
+        Calculate the canonical weights to be in a canonical average
+        for a list of energies.
+        """
+        return exp(self.calc_log_weights(energies, beta))
 
 
     def calc_average(self, energies, values, beta=1.0):
@@ -96,75 +82,51 @@ class CanonicalAverager(CanonicalBase):
 
 
 class CanonicalAveragerFixedEnergies(CanonicalBase):
-    def __init__(self, statics_log_filename, energies, which=-1):
-        CanonicalBase.__init__(self, statics_log_filename, which)
+    def __init__(self, statics_log_filename, energies, which=-1, cache_dir=None, estimate=None):
+        if estimate!=None:
+            self.copy_estimate(estimate)
+        else:
+            CanonicalBase.__init__(self, statics_log_filename, which, cache_dir)
 
         # Save the energies
         self.energies = energies
 
         # Make a histogram of the energies
-        self.histogram = numpy.histogram(energies, bins=self.binning)[0]
-
-        # In some versions of numpy, there will be an extra bin, with
-        # values faling outside the histogram
-        if len(self.histogram)==len(self.lnG_support)+1:
-            self.histogram = self.histogram[:-1]
+        self.histogram = self.calc_histogram(energies)
 
-        # Calculate the support between lnG and the histogram
-        self.support = self.lnG_support & (self.histogram>0)
+        # Calculate the bin number for each energy
+        self.bin_number_for_energies = self.calc_bin_numbers(energies)
 
-        if (numpy.any(self.support)):
-            # Calculate the bin number for each energy
-            self.bin_number_for_energies = []
-
-            for energy in self.energies:
-                bin_number = self.calc_bin(energy)
+    def calc_log_weights_multi(self, betas):
+        """
+        Calculate the logarithm of the canonical weights for the fixed
+        energies at each beta in the array betas. Returns an array of
+        shape (len(betas), len(energies)).
+        """
+        log_P = self.calc_log_bin_weights(self.histogram, betas)
+        return log_P[:,self.bin_number_for_energies]
 
-                if 0 <= bin_number < len(self.bin_centers):
-                    self.bin_number_for_energies.append(bin_number)
-                else:
-                    self.bin_number_for_energies.append(-1)
+    def calc_weights_multi(self, betas):
+        """
+        Calculate the canonical weights for the fixed energies at each
+        beta in the array betas. Returns an array of shape
+        (len(betas), len(energies)).
+        """
+        return exp(self.calc_log_weights_multi(betas))
 
-    def calc_bin(self, energy):
+    def calc_log_weights(self, beta=1.0):
         """
-        Calculate the bin number for the given energy. A value of -1
-        or len(self.binning), mean that the energy falls outside the
-        bin boundaries.
+        Calculate the logarithm of the canonical weights for the
+        fixed energies.
         """
-        return numpy.searchsorted(self.binning, energy, side='right') - 1       
+        return self.calc_log_weights_multi([beta])[0]
 
     def calc_weights(self, beta=1.0):
         """
         Calculate the canonical weights to be in a canonical average
         for a list of energies.
         """
-
-        if (numpy.any(self.support)):
-            # Calculate the probability of each bin according to the
-            # canonical ensemble within the common support
-            lnGs = self.lnG[self.support]
-            Es = self.bin_centers[self.support]
-
-            lnZ = log_sum_exp(lnGs - beta*Es)
-
-            P = numpy.zeros(self.support.shape)
-            P[self.support] = exp(lnGs - beta*Es - lnZ)
-
-            # Normalize the probabilities by the counts in the histogram
-            P[self.support] /=  self.histogram[self.support]
-
-            # Calculate the weight for each energy
-            weights = []
-
-            for bin_number in self.bin_number_for_energies:
-                if 0 <= bin_number:
-                    weights.append(P[bin_number])
-                else:
-                    weights.append(0.0)
-
-            return weights
-        else:
-            return [0.0 for energy in self.energies]
+        return exp(self.calc_log_weights(beta))
 
     def calc_average(self, values, beta=1.0):
         """
@@ -21,8 +21,9 @@
 # to endorse or promote products derived from this software without
 # specific prior written permission.
 
-from parse_statics_log import parse_statics_log, convert_log_entry
+from StaticsLogIndex import StaticsLogIndex
 
+import numpy
 from numpy import exp, log, sum, min
 from utils import log_sum_exp
 
@@ -33,8 +34,16 @@ class CanonicalException(Exception):
 
 class CanonicalBase:
 
-    def __init__(self, statics_log_filename, which=-1):
-        result = parse_statics_log(statics_log_filename, which)
+    def __init__(self, statics_log_filename, which=-1, cache_dir=None):
+        index = StaticsLogIndex(statics_log_filename, cache_dir)
+        names = ['lnG', 'lnG_support', 'binning', 'bin_widths']
+
+        if which<0:
+            # Only the last entries are needed, so avoid indexing
+            # the entire log
+            result = index.find_latest(names, -which)
+        else:
+            result = dict((name, index.select(name, which)) for name in names)
 
         # Chech that the wanted information is in there
         if not (result.has_key('lnG') and len(result['lnG'])>=1):
@@ -47,9 +56,88 @@ class CanonicalBase:
             raise CanonicalException("binning not found in statics log")
 
         # Save the read variables
-        (self.number, self.fullname, self.lnG) = convert_log_entry(result['lnG'][0])
-        self.lnG_support = convert_log_entry(result['lnG_support'][0])[2]
-        self.binning = convert_log_entry(result['binning'][0])[2]
-        self.bin_widths = convert_log_entry(result['bin_widths'][0])[2]
+        (self.number, self.fullname, self.lnG) = index.convert_entry(result['lnG'][0])
+        self.lnG_support = index.convert_entry(result['lnG_support'][0])[2]
+        self.binning = index.convert_entry(result['binning'][0])[2]
+        self.bin_widths = index.convert_entry(result['bin_widths'][0])[2]
         self.bin_centers = self.binning[:-1] + 0.5*(self.binning[1:]-self.binning[:-1])
 
+        # Number of bytes read from the statics log
+        self.bytes_read = index.bytes_read
+
+    def copy_estimate(self, other):
+        """
+        Share the lnG estimate read by another object, instead of
+        reading it from the statics log.
+        """
+        self.number = other.number
+        self.fullname = other.fullname
+        self.lnG = other.lnG
+        self.lnG_support = other.lnG_support
+        self.binning = other.binning
+        self.bin_widths = other.bin_widths
+        self.bin_centers = other.bin_centers
+        self.bytes_read = 0
+
+    def calc_bin(self, energy):
+        """
+        Calculate the bin number for the given energy. A value of -1
+        or len(self.binning), mean that the energy falls outside the
+        bin boundaries.
+        """
+        return numpy.searchsorted(self.binning, energy, side='right') - 1
+
+    def calc_bin_numbers(self, energies):
+        """
+        Calculate the bin numbers for an array of energies. Energies
+        falling outside the bin boundaries are given the bin number -1.
+        """
+        bin_numbers = self.calc_bin(numpy.asarray(energies, dtype=float))
+        bin_numbers[bin_numbers >= len(self.bin_centers)] = -1
+        return bin_numbers
+
+    def calc_histogram(self, energies):
+        """
+        Make a histogram of the energies using the binning of the lnG
+        estimate.
+        """
+        histogram = numpy.histogram(energies, bins=self.binning)[0]
+
+        # In some versions of numpy, there will be an extra bin, with
+        # values faling outside the histogram
+        if len(histogram)==len(self.lnG_support)+1:
+            histogram = histogram[:-1]
+
+        return histogram
+
+    def calc_log_bin_weights(self, histogram, betas):
+        """
+        Calculate the logarithm of the canonical weight of a single
+        sample in each bin, for an array of betas. Returns an array
+        of shape (len(betas), number of bins + 1), where the last
+        column is -inf, such that bin number -1 can be used as index
+        for energies outside the bin boundaries. Bins outside the
+        common support between lnG and the histogram are also -inf.
+        """
+        betas = numpy.atleast_1d(numpy.asarray(betas, dtype=float))
+
+        # Calculate the support between lnG and the histogram
+        support = self.lnG_support & (histogram>0)
+
+        log_P = numpy.empty((len(betas), len(support)+1))
+        log_P.fill(-numpy.inf)
+
+        if (numpy.any(support)):
+            # Calculate the log probability of each bin according to
+            # the canonical ensemble within the common support, for
+            # all betas at once
+            lnGs = self.lnG[support]
+            Es = self.bin_centers[support]
+
+            ll = lnGs - numpy.outer(betas, Es)
+            lnZ = log_sum_exp(ll, axis=1)
+
+            # Normalize the probabilities by the counts in the histogram
+            log_P[:,:-1][:,support] = ll - lnZ[:,numpy.newaxis] - log(histogram[support])
+
+        return log_P
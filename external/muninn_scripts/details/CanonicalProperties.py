@@ -22,13 +22,14 @@
 # specific prior written permission.
 
 from CanonicalBase import CanonicalBase, CanonicalException
+import numpy
 from numpy import exp, log, sum, min
 from utils import log_sum_exp
 
 
 class CanonicalProperties(CanonicalBase):
-    def __init__(self, statics_log_filename, which=-1):
-        CanonicalBase.__init__(self, statics_log_filename, which)
+    def __init__(self, statics_log_filename, which=-1, cache_dir=None):
+        CanonicalBase.__init__(self, statics_log_filename, which, cache_dir)
 
         # Save lnG only where there is support
         self.lnGs = self.lnG[self.lnG_support]
@@ -90,11 +91,64 @@ class CanonicalProperties(CanonicalBase):
         Calculates the heat capacity normalized by the bolztmann constant at beta
         """
 
-        E = self.E(beta)
-        Esq = self.Esq(beta)
+        PE = self.PE(beta)
+        E = sum(self.Es * PE)
+        Esq = sum(self.Es*self.Es * PE)
 
         return beta*beta*(Esq-E*E)
 
+    def curves(self, betas):
+        """
+        Calculates lnZ, betaF, E, Esq, S and C for an array of betas in
+        one pass. Returns a dictionary from the name of each quantity
+        to an array with a value for each beta.
+        """
+        betas = numpy.asarray(betas, dtype=float)
+
+        # The log-likelihood of each energy bin for each beta
+        ll = self.lnGs - numpy.outer(betas, self.Es)
+        lnZ = log_sum_exp(ll, axis=1)
+        PE = exp(ll - lnZ[:,numpy.newaxis])
+
+        E = numpy.dot(PE, self.Es)
+        Esq = numpy.dot(PE, self.Es*self.Es)
+
+        return {'lnZ': lnZ,
+                'betaF': -lnZ,
+                'E': E,
+                'Esq': Esq,
+                'S': betas*E + lnZ,
+                'C': betas*betas*(Esq-E*E)}
+
+    def C_peak(self, betas):
+        """
+        Finds the maximum of the heat capacity over an array of betas.
+        The location of the maximum on the grid is refined by fitting
+        a parabola through the neighbouring grid points. Returns the
+        tuple (beta, C) at the maximum.
+        """
+        betas = numpy.asarray(betas, dtype=float)
+        C = self.curves(betas)['C']
+
+        i = numpy.argmax(C)
+
+        # Maximum at the boundary of the grid, no refinement possible
+        if i==0 or i==len(betas)-1:
+            return (betas[i], C[i])
+
+        # Vertex of the parabola through the three points around the maximum
+        x = betas[i-1:i+2]
+        y = C[i-1:i+2]
+        denominator = (x[0]-x[1])*(x[0]-x[2])*(x[1]-x[2])
+        a = (x[2]*(y[1]-y[0]) + x[1]*(y[0]-y[2]) + x[0]*(y[2]-y[1])) / denominator
+        b = (x[2]*x[2]*(y[0]-y[1]) + x[1]*x[1]*(y[2]-y[0]) + x[0]*x[0]*(y[1]-y[2])) / denominator
+
+        if a>=0:
+            return (betas[i], C[i])
+
+        beta_peak = -b/(2*a)
+        return (beta_peak, self.C(beta_peak))
+
 
 class CanonicalPropertiesFromArrays(CanonicalProperties):
     def __init__(self, lnG, binning, lnG_support=None):
@@ -0,0 +1,338 @@
+# StaticsLogHistory.py
+# Copyright (c) 2010 Jes Frellsen
+#
+# This file is part of Muninn.
+#
+# Muninn is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Muninn is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Muninn.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The following additional terms apply to the Muninn software:
+# Neither the names of its contributors nor the names of the
+# organizations they are, or have been, associated with may be used
+# to endorse or promote products derived from this software without
+# specific prior written permission.
+
+import os
+import mmap
+import numpy
+import multiprocessing
+from parse_tarrays import text_to_array
+from StaticsLogIndex import StaticsLogIndex
+
+# Approximate number of bytes of text decoded by a worker process at
+# a time
+chunk_bytes = 1<<22
+
+
+class EntryHistory:
+    """
+    All entries with the same name in a Muninn statics log, stacked
+    into a single two dimensional array with a row for each entry
+    (iteration) and a column for each bin.
+
+    Entries can have different numbers of bins (the binning grows
+    during a run), so the rows are padded with zeros, and the number
+    of values in each row is kept in lengths. Multi dimensional arrays
+    are stored flattened in Fortran order.
+
+    Iterating over a history gives log entries on the form
+    (number, fullname, array), as returned by convert_log_entries.
+    """
+
+    def __init__(self, name, numbers, values, lengths):
+        self.name = name
+        self.numbers = numpy.asarray(numbers, dtype=int)
+        self.values = values
+        self.lengths = numpy.asarray(lengths, dtype=int)
+
+    @classmethod
+    def from_arrays(cls, name, numbers, arrays):
+        """
+        Stack a list of arrays with the given numbers.
+        """
+        (values, lengths) = stack_arrays(arrays)
+        return cls(name, numbers, values, lengths)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Make a history from a list of converted log entries.
+        """
+        entries = list(entries)
+        if len(entries)==0:
+            return cls(None, [], numpy.zeros((0, 0)), [])
+        name = entries[0][1][:len(entries[0][1])-len(str(entries[0][0]))]
+        return cls.from_arrays(name, [entry[0] for entry in entries], [entry[2] for entry in entries])
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        for i in range(len(self.numbers)):
+            yield self.entry(i)
+
+    def entry(self, i):
+        """
+        Return row i as a log entry (number, fullname, array).
+        """
+        return (self.numbers[i], "%s%d" % (self.name, self.numbers[i]), self.values[i,:self.lengths[i]])
+
+    def mask(self):
+        """
+        Boolean array which is true for the values of each row that are
+        not padding.
+        """
+        return numpy.arange(self.values.shape[1]) < self.lengths[:,numpy.newaxis]
+
+    def select(self, start=None, end=None, indices=[]):
+        """
+        Return the history of the selected entries, using the same
+        selection rules as parse_statics_log.
+        """
+        assert((start==None and end==None) or indices==[])
+
+        selected = numpy.ones(len(self.numbers), dtype=bool)
+        if start!=None and start>=0:
+            selected &= (self.numbers>=start)
+        if end!=None:
+            selected &= (self.numbers<end)
+        if indices!=[]:
+            selected &= numpy.in1d(self.numbers, indices)
+
+        rows = numpy.flatnonzero(selected)
+        if start!=None and start<0:
+            rows = rows[start:]
+
+        return EntryHistory(self.name, self.numbers[rows], self.values[rows], self.lengths[rows])
+
+    def append(self, other):
+        """
+        Return the history with the entries of other added at the end.
+        """
+        if len(self)==0:
+            return other
+        if len(other)==0:
+            return self
+        width = max(self.values.shape[1], other.values.shape[1])
+        dtype = numpy.result_type(self.values, other.values)
+        values = numpy.zeros((len(self)+len(other), width), dtype=dtype)
+        values[:len(self),:self.values.shape[1]] = self.values
+        values[len(self):,:other.values.shape[1]] = other.values
+        return EntryHistory(self.name, numpy.concatenate((self.numbers, other.numbers)), values,
+                            numpy.concatenate((self.lengths, other.lengths)))
+
+    def take(self, rows, width, fill=0):
+        """
+        Return the given rows, padded with fill (or truncated) to the
+        given number of columns.
+        """
+        values = numpy.empty((len(rows), width), dtype=self.values.dtype)
+        values[:] = fill
+        columns = min(width, self.values.shape[1])
+        values[:,:columns] = self.values[rows,:columns]
+        values[numpy.arange(width) >= self.lengths[rows][:,numpy.newaxis]] = fill
+        return values
+
+    def aligned_rows(self, numbers, lengths=None, fallback=True):
+        """
+        Find the rows of this history for the entries with the given
+        numbers. If fallback is set and there is no row with the same
+        number, but the history has a single row, that is used for all
+        entries. If lengths are given, rows are only used if their
+        lengths are equal to these. Returns the row index of each entry,
+        and a boolean array telling whether a row was found.
+        """
+        rows = numpy.zeros(len(numbers), dtype=int)
+        found = numpy.zeros(len(numbers), dtype=bool)
+        if len(self)==0:
+            return rows, found
+
+        order = numpy.argsort(self.numbers)
+        positions = numpy.minimum(numpy.searchsorted(self.numbers[order], numbers), len(order)-1)
+        rows = order[positions]
+        found = (self.numbers[rows]==numbers)
+        if fallback and len(self)==1:
+            rows[:] = 0
+            found[:] = True
+        if lengths is not None:
+            found &= (self.lengths[rows]==lengths)
+        return rows, found
+
+
+def as_history(entries):
+    """
+    Make a history from a list of log entries, either as returned by
+    parse_statics_log or converted, unless it already is a history.
+    """
+    if isinstance(entries, EntryHistory):
+        return entries
+    if entries==None:
+        entries = []
+    entries = list(entries)
+    if len(entries)>0 and isinstance(entries[0][2], str):
+        entries = [(number, fullname, text_to_array(tarray)) for (number, fullname, tarray) in entries]
+    return EntryHistory.from_entries(entries)
+
+
+def stack_arrays(arrays):
+    """
+    Stack arrays (flattened in Fortran order) into the rows of a zero
+    padded two dimensional array. Returns the array and the lengths of
+    the rows.
+    """
+    arrays = [numpy.ravel(a, order='F') for a in arrays]
+    lengths = numpy.array([len(a) for a in arrays], dtype=int)
+    width = 0
+    if len(arrays)>0:
+        width = lengths.max()
+    dtype = float
+    if len(arrays)>0:
+        dtype = numpy.result_type(*arrays)
+    values = numpy.zeros((len(arrays), width), dtype=dtype)
+    for i, a in enumerate(arrays):
+        values[i,:len(a)] = a
+    return values, lengths
+
+
+def decode_chunk(arguments):
+    """
+    Decode the TArrays at the given (offset, length) positions of a
+    file, and stack them. Runs in a worker process.
+    """
+    (filename, positions) = arguments
+    fh = open(filename, 'rb')
+    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = [text_to_array(data[offset:offset+length]) for (offset, length) in positions]
+    data.close()
+    fh.close()
+    return stack_arrays(arrays)
+
+
+def decode_entries(filename, index_entries_dict, processes=None):
+    """
+    Decode the TArrays of the index entries (see StaticsLogIndex) in a
+    dictionary from name to list of index entries. The entries are
+    divided into chunks of about chunk_bytes bytes of text, which are
+    decoded by a pool of worker processes if there is more than one.
+    Returns a dictionary from name to the stacked values and the
+    lengths of the rows.
+    """
+    chunks = []
+    chunk_names = []
+    for name, index_entries in index_entries_dict.items():
+        positions = []
+        size = 0
+        for entry in index_entries:
+            positions.append((entry[2], entry[3]))
+            size += entry[3]
+            if size >= chunk_bytes:
+                chunks.append((filename, positions))
+                chunk_names.append(name)
+                positions = []
+                size = 0
+        if len(positions)>0:
+            chunks.append((filename, positions))
+            chunk_names.append(name)
+
+    if processes==None:
+        processes = multiprocessing.cpu_count()
+
+    if len(chunks)<=1 or processes<=1:
+        results = map(decode_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(min(processes, len(chunks)))
+        try:
+            results = pool.map(decode_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    decoded = {}
+    for name in index_entries_dict.keys():
+        name_results = [result for (result, chunk_name) in zip(results, chunk_names) if chunk_name==name]
+        if len(name_results)==0:
+            decoded[name] = (numpy.zeros((0, 0)), numpy.zeros(0, dtype=int))
+            continue
+        width = max([values.shape[1] for (values, lengths) in name_results])
+        dtype = numpy.result_type(*[values for (values, lengths) in name_results])
+        stacked = numpy.zeros((sum([len(values) for (values, lengths) in name_results]), width), dtype=dtype)
+        row = 0
+        for (values, lengths) in name_results:
+            stacked[row:row+len(values),:values.shape[1]] = values
+            row += len(values)
+        decoded[name] = (stacked, numpy.concatenate([lengths for (values, lengths) in name_results]))
+    return decoded
+
+
+def load_statics_log_history(filename, names, start=None, end=None, indices=[], processes=None,
+                             cache_filename=None):
+    """
+    Load the entries with the given names from a statics log, as a
+    dictionary from name to EntryHistory. The entries are selected as
+    in parse_statics_log, and decoded in parallel by several worker
+    processes.
+
+    If a cache filename is given, the histories of all entries of the
+    names are stored there in numpy .npz format. When the log has
+    grown since, only the new entries are decoded. The cache is
+    rebuilt if the log has been replaced or truncated.
+    """
+
+    index = StaticsLogIndex(filename)
+    histories = {}
+
+    if cache_filename!=None:
+        stat = os.stat(filename)
+        if os.path.exists(cache_filename):
+            cache = numpy.load(cache_filename)
+            (inode, indexed_size) = cache["stamp"]
+            if inode==stat.st_ino and indexed_size<=stat.st_size:
+                for name in names:
+                    if "numbers_%s" % name in cache.files:
+                        histories[name] = EntryHistory(name, cache["numbers_%s" % name], cache["values_%s" % name],
+                                                       cache["lengths_%s" % name])
+                # Only index the part of the log written since
+                if len(histories)==len(names):
+                    index.indexed_size = int(indexed_size)
+                else:
+                    histories = {}
+            cache.close()
+
+    index.update()
+
+    index_entries_dict = {}
+    for name in names:
+        if cache_filename!=None:
+            index_entries_dict[name] = index.select(name)
+        else:
+            index_entries_dict[name] = index.select(name, start, end, indices)
+
+    decoded = decode_entries(filename, index_entries_dict, processes)
+    for name in names:
+        (values, lengths) = decoded[name]
+        new_history = EntryHistory(name, [entry[0] for entry in index_entries_dict[name]], values, lengths)
+        histories[name] = histories.get(name, EntryHistory(name, [], numpy.zeros((0, 0)), [])).append(new_history)
+
+    if cache_filename!=None:
+        arrays = {"stamp": numpy.array([stat.st_ino, index.indexed_size])}
+        for name, history in histories.items():
+            arrays["numbers_%s" % name] = history.numbers
+            arrays["values_%s" % name] = history.values
+            arrays["lengths_%s" % name] = history.lengths
+        cache_file = open(cache_filename, 'wb')
+        numpy.savez(cache_file, **arrays)
+        cache_file.close()
+
+        for name in names:
+            histories[name] = histories[name].select(start, end, indices)
+
+    return histories
@@ -0,0 +1,268 @@
+# StaticsLogIndex.py
+# Copyright (c) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Muninn.
+#
+# Muninn is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Muninn is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Muninn.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The following additional terms apply to the Muninn software:
+# Neither the names of its contributors nor the names of the
+# organizations they are, or have been, associated with may be used
+# to endorse or promote products derived from this software without
+# specific prior written permission.
+
+import os
+import re
+import mmap
+import numpy
+from parse_tarrays import text_to_array
+
+# Same entry format as used by parse_statics_log, but matched in
+# multiline mode so it can be applied to the whole file at once
+re_entry = re.compile("^[ ]*(([a-zA-Z_]+)([0-9]+))[ ]*=[ ]*(TArray\([^\n]+\))\n", re.MULTILINE)
+
+# Size of the blocks read when scanning the file backwards
+block_size = 1<<20
+
+
+class StaticsLogIndex:
+    """
+    Offset index of the entries in a Muninn statics log.
+
+    Rather than parsing the log line by line, the index stores the
+    byte offset and length of each
+
+      name<number> = TArray(...)
+
+    entry, such that individual entries can be read and decoded on
+    demand. The index is extended incrementally when the log grows.
+    The latest entries can be found without building the index, by
+    scanning backwards from the end of the file.
+
+    If a cache directory is given, decoded arrays are stored there in
+    numpy binary format, and read from there on later requests.
+    """
+
+    def __init__(self, statics_log_filename, cache_dir=None):
+        self.filename = statics_log_filename
+        self.cache_dir = cache_dir
+
+        # Dictionary from name to list of (number, fullname, offset, length)
+        self.entries = {}
+
+        # Number of bytes of the file covered by the index
+        self.indexed_size = 0
+
+        # Number of bytes read from the file so far
+        self.bytes_read = 0
+
+        if self.cache_dir!=None:
+            self.validate_cache()
+
+    def update(self):
+        """
+        Extend the index with entries appended to the log since the
+        last update.
+        """
+        fh = open(self.filename, 'rb')
+        size = os.fstat(fh.fileno()).st_size
+
+        # The file has been rewritten, start over
+        if size < self.indexed_size:
+            self.entries = {}
+            self.indexed_size = 0
+
+        # An empty file cannot be mapped, and has an empty index
+        if size == 0 or size == self.indexed_size:
+            fh.close()
+            return
+
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        end = self.indexed_size
+        for match in re_entry.finditer(data, self.indexed_size):
+            (fullname, name, number, tarray) = match.groups()
+            entry = (int(number), fullname, match.start(4), match.end(4)-match.start(4))
+            self.entries.setdefault(name, []).append(entry)
+            end = match.end()
+
+        # Only complete lines are indexed. Continue from the last
+        # newline, since the end of the file might be half written
+        last_newline = data.rfind("\n", end)
+        if last_newline >= 0:
+            end = last_newline + 1
+        self.bytes_read += size - self.indexed_size
+        self.indexed_size = end
+
+        data.close()
+        fh.close()
+
+    def names(self):
+        """
+        Return the names of the indexed entries.
+        """
+        self.update()
+        return self.entries.keys()
+
+    def select(self, name, start=None, end=None, indices=[]):
+        """
+        Return the index entries for a name, using the same selection
+        rules as parse_statics_log.
+        """
+        assert((start==None and end==None) or indices==[])
+
+        self.update()
+
+        selected = []
+        for entry in self.entries.get(name, []):
+            number = entry[0]
+            if (start==None or start<0 or start<=number) and (end==None or number<end) and (indices==[] or (number in indices)):
+                selected.append(entry)
+
+        if start!=None and start<0:
+            selected = selected[start:]
+
+        return selected
+
+    def find_latest(self, names, count=1):
+        """
+        Find the last count entries for each of the given names by
+        scanning the file backwards from the end. Returns a dictionary
+        from name to a list of index entries in file order.
+        """
+        found = dict((name, []) for name in names)
+        missing = set(names)
+
+        fh = open(self.filename, 'rb')
+        fh.seek(0, os.SEEK_END)
+        position = fh.tell()
+
+        # Bytes of an incomplete line at the start of the previous block
+        remainder = ""
+
+        # A half written last line is ignored
+        ignore_last_line = True
+
+        while position > 0 and len(missing) > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            fh.seek(position)
+            block = fh.read(read_size) + remainder
+            self.bytes_read += read_size
+
+            lines = block.split("\n")
+
+            # The first line might continue in the previous block
+            if position > 0:
+                remainder = lines.pop(0)
+                line_offset = position + len(remainder) + 1
+            else:
+                remainder = ""
+                line_offset = 0
+
+            # Offsets of all lines in the block
+            offsets = []
+            for line in lines:
+                offsets.append(line_offset)
+                line_offset += len(line) + 1
+
+            if ignore_last_line and len(lines) > 0:
+                lines.pop()
+                offsets.pop()
+                ignore_last_line = False
+
+            for line, offset in reversed(zip(lines, offsets)):
+                if "TArray" not in line:
+                    continue
+
+                match = re_entry.match(line + "\n")
+                if match==None:
+                    continue
+
+                (fullname, name, number, tarray) = match.groups()
+                if name in missing:
+                    entry = (int(number), fullname, offset + match.start(4), match.end(4)-match.start(4))
+                    found[name].insert(0, entry)
+                    if len(found[name]) >= count:
+                        missing.remove(name)
+
+        fh.close()
+        return found
+
+    def read_text(self, entry):
+        """
+        Read the TArray text of an index entry.
+        """
+        (number, fullname, offset, length) = entry
+        fh = open(self.filename, 'rb')
+        fh.seek(offset)
+        text = fh.read(length)
+        fh.close()
+        self.bytes_read += length
+        return text
+
+    def read_array(self, entry):
+        """
+        Read and decode the TArray of an index entry, using the binary
+        cache if available.
+        """
+        (number, fullname, offset, length) = entry
+
+        cache_filename = None
+        if self.cache_dir!=None:
+            cache_filename = os.path.join(self.cache_dir, "%s_%d.npy" % (fullname, offset))
+            if os.path.exists(cache_filename):
+                return numpy.load(cache_filename)
+
+        a = text_to_array(self.read_text(entry))
+
+        if cache_filename!=None and a is not None:
+            numpy.save(cache_filename, a)
+
+        return a
+
+    def convert_entry(self, entry):
+        """
+        Convert an index entry to a log entry on the form
+        (number, fullname, array), as returned by convert_log_entry.
+        """
+        return (entry[0], entry[1], self.read_array(entry))
+
+    def validate_cache(self):
+        """
+        Make sure that the cache directory belongs to the current
+        version of the statics log. The cache is keyed by offset, which
+        is stable as long as the log is only appended to, so it is
+        cleared if the log has been replaced or truncated.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        stat = os.stat(self.filename)
+        stamp_filename = os.path.join(self.cache_dir, "stamp")
+
+        valid = False
+        if os.path.exists(stamp_filename):
+            stamp_file = open(stamp_filename)
+            (inode, size) = map(int, stamp_file.read().split())
+            stamp_file.close()
+            valid = (inode==stat.st_ino and size<=stat.st_size)
+
+        if not valid:
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, filename))
+
+        stamp_file = open(stamp_filename, 'w')
+        stamp_file.write("%d %d\n" % (stat.st_ino, stat.st_size))
+        stamp_file.close()
@@ -21,32 +21,42 @@
 # to endorse or promote products derived from this software without
 # specific prior written permission.
 
-from numpy import array
+from numpy import array, fromstring
 import re
 
 re_float_pattern = "(?:[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)"
 re_TArray_pattern =  "TArray\(\s*\[(\s*(?:\[|\]|%s\s*)*)\]\s*,\s*type\s*=\s*(\w+)\s*,\s*shape=\s*\[(\s*(?:[0-9]+\s*))\]\s*\)" % re_float_pattern
 
+# Looser pattern used for fast conversion, where the data part is
+# parsed by numpy in bulk rather than validated by the regular expression
+re_TArray_fast = re.compile("TArray\(\s*\[(.*)\]\s*,\s*type\s*=\s*(\w+)\s*,\s*shape\s*=\s*\[([0-9\s]*)\]\s*\)", re.DOTALL)
+
 data_types = {'i':int, 'j':int, 'b':lambda val: bool(int(val)), 'd':float}
 
+# Numpy types used when parsing the data in bulk
+numpy_data_types = {'i':int, 'j':int, 'b':int, 'd':float}
+
 def text_to_array(text):
     """
     Convert a TArray from text representation to a numpy array
     """
-    match = re.search(re_TArray_pattern, text)
+    match = re_TArray_fast.search(text)
     if match!=None:
         (data_string, type_string, shape_string) = match.groups()
 
-        # Determine the type conversion
-        dtype = data_types.get(type_string, float)
+        # Convert the data in one go, nested brackets only separate
+        # the dimensions
+        if "[" in data_string:
+            data_string = data_string.replace("[", " ").replace("]", " ")
+        a = fromstring(data_string, dtype=numpy_data_types.get(type_string, float), sep=" ")
 
-        # Convert the data and shape to values
-        data = map(dtype, data_string.split())
-        shape = map(int, shape_string.split())
+        if type_string=='b':
+            a = a.astype(bool)
 
-        # Make the numpy array and reshape it
-        a = array(data)
-        a.reshape(shape, order='F')
+        # Reshape the array
+        shape = tuple(map(int, shape_string.split()))
+        if len(shape)>1:
+            a = a.reshape(shape, order='F')
 
         return a
         
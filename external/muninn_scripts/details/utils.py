@@ -21,12 +21,20 @@
 # to endorse or promote products derived from this software without
 # specific prior written permission.
 
-from numpy import max, sum, exp, log
+from numpy import max, sum, exp, log, expand_dims
 from cPickle import load, dump
 
-def log_sum_exp(summands):
-    m = max(summands)
-    s = sum(exp(summands-m))
+def log_sum_exp(summands, axis=None):
+    """
+    Calculate log(sum(exp(summands))) in a numerically stable way. If
+    axis is given, the sum is only taken along that axis.
+    """
+    if axis==None:
+        m = max(summands)
+        s = sum(exp(summands-m))
+    else:
+        m = max(summands, axis=axis)
+        s = sum(exp(summands-expand_dims(m, axis)), axis=axis)
     return m + log(s)
 
 def pickle_to_file(obj, file_name, protocol=2):
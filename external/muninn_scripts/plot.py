@@ -32,6 +32,7 @@ from numpy import array, log, zeros
 from re import findall
 from details.myhist import myhist, myhist2d
 from details.utils import pickle_to_file
+from details.StaticsLogHistory import as_history, load_statics_log_history
 
 
 
@@ -97,46 +98,66 @@ def plot_bin_widths(entries, log_space=False, main=None):
             r.plot(range(len(tarray)), tarray, xlab="bin number", ylab=ylab, main=this_main)
 
 
+def reference_history(entries, entries_dict):
+    """
+    History of the entries used as reference (binning, bin widths or
+    support) for other entries, preferring the dictionary if given.
+    """
+    if entries_dict!=None and len(entries_dict)>0:
+        return as_history(sorted(entries_dict.values()))
+    return as_history(entries)
+
 def plot_entry_list(log_entry_list, binning=None, binning_dict=None, bin_widths=None, bin_widths_dict=None,
                     support_dict=None, xlab=None, ylab="", normalize_log_space=True, xmin=None, xmax=None,
                     main=None, bin_numbers=True):
-    entries = convert_log_entries(log_entry_list)
+    history = as_history(log_entry_list)
 
     points = []
 
-    for entry in entries:
-        number, fullname, tarray = entry
-        this_ylab = ylab
+    if len(history)==0:
+        return points
 
-        # Decide on which binning to use
-        if binning_dict!=None and binning_dict.has_key(number):
-            bins = binning_dict[number][2]
-        elif binning!=None and len(binning)==1 and len(binning[0][2])-1==len(tarray):
-            bins = binning[0][2]
-        else:
-            bins = None
+    width = history.values.shape[1]
 
-        # Normalize by bin width, if the binwidh is available 
-        if bin_widths_dict!=None and bin_widths_dict.has_key(number):
-            widths = bin_widths_dict[number][2]
-        elif bin_widths!=None and len(bin_widths)==1 and len(bin_widths[0][2])==len(tarray):
-            widths = bin_widths[0][2]
-        else:
-            widths = None
+    # Decide on which binning to use
+    binning_history = reference_history(binning, binning_dict)
+    binning_rows, has_binning = binning_history.aligned_rows(history.numbers, history.lengths+1)
 
-        if widths!=None:
-            if normalize_log_space:
-                tarray -= log(widths)
-                this_ylab = r("expression(%s - ln(Delta[bin]))" % ylab)
-            else:
-                tarray = tarray/widths  # Note, /= worn't work, since tarray might be an int array
-                this_ylab = r("expression(%s / Delta[bin])" % ylab)
+    # Normalize by bin width, if the binwidh is available. All entries
+    # are normalized together.
+    widths_history = reference_history(bin_widths, bin_widths_dict)
+    widths_rows, has_widths = widths_history.aligned_rows(history.numbers, history.lengths)
 
-        # Decide on which support to use
-        if support_dict!=None and support_dict.has_key(number):
-            support = support_dict[number][2]
+    values = history.values
+    if has_widths.any():
+        widths = widths_history.take(widths_rows, width, fill=1.0)
+        if normalize_log_space:
+            normalized = values - log(widths)
+            widths_ylab = r("expression(%s - ln(Delta[bin]))" % ylab)
         else:
-            support = None
+            normalized = values/widths
+            widths_ylab = r("expression(%s / Delta[bin])" % ylab)
+        values = numpy.where(has_widths[:,numpy.newaxis], normalized, values)
+
+    # Decide on which support to use
+    support_history = reference_history(None, support_dict)
+    support_rows, has_support = support_history.aligned_rows(history.numbers, fallback=False)
+
+    for i in range(len(history)):
+        (number, fullname, tarray) = history.entry(i)
+        tarray = values[i,:history.lengths[i]]
+
+        bins = None
+        if has_binning[i]:
+            bins = binning_history.entry(binning_rows[i])[2]
+
+        this_ylab = ylab
+        if has_widths[i]:
+            this_ylab = widths_ylab
+
+        support = None
+        if has_support[i]:
+            support = support_history.entry(support_rows[i])[2]
 
         # Do the plotting
         p = plot_name_array(fullname, tarray, 1, counts=False, bins=bins, support=support, makenewplot=True,
@@ -147,62 +168,82 @@ def plot_entry_list(log_entry_list, binning=None, binning_dict=None, bin_widths=
 
     return points
 
+def align_binnings(bins, binning_history, rows, max_block_size=1<<24):
+    """
+    Find the offset in the newest binning, bins, of the binning of each
+    of the given rows of binning_history, as the offset for which the
+    bin centers are closest. Rows with the same number of bins are
+    aligned together. Returns the offsets and the distance of the
+    binnings at the offsets, which is infinite for rows with more bins
+    than bins.
+    """
+    offsets = zeros(len(rows), dtype=int)
+    distances = numpy.empty(len(rows))
+    distances[:] = numpy.inf
+
+    bin_lengths = binning_history.lengths[rows]
+    for length in numpy.unique(bin_lengths):
+        size_diff = bins.shape[0] - length
+        if size_diff < 0:
+            continue
+
+        # All alignments of a binning with this length in the newest binning
+        windows = bins[numpy.arange(size_diff+1)[:,numpy.newaxis] + numpy.arange(length)]
+
+        group = numpy.flatnonzero(bin_lengths==length)
+        block_size = max(1, max_block_size//(windows.size))
+        for block_start in range(0, len(group), block_size):
+            block = group[block_start:block_start+block_size]
+            this_bins = binning_history.values[rows[block],:length]
+            norms = numpy.sqrt(numpy.sum((windows[numpy.newaxis,:,:] - this_bins[:,numpy.newaxis,:])**2, axis=2))
+            offsets[block] = numpy.argmin(norms, axis=1)
+            distances[block] = norms[numpy.arange(len(block)), offsets[block]]
+
+    return offsets, distances
+
 def plot_sum_N(log_entry_list, binning=None, binning_dict=None, bin_widths=None, bin_widths_dict=None,
                     support_dict=None, xlab=None, ylab="", normalize_log_space=True, xmin=None, xmax=None, main=None, bin_numbers=True):
-    entries = convert_log_entries(log_entry_list)
+    history = as_history(log_entry_list)
 
     if binning!=None and binning_dict!=None and len(binning_dict)>0:
         newest = sorted(binning_dict.keys())[-1]
 
         # Added up the entries in the entry list
         bins = binning_dict[newest][2]
-        sums = zeros(bins.shape[0]-1, dtype=entries[0][2].dtype)
-        
-        for entry in entries:
-            number, fullname, tarray = entry
-
-            # See if we need to align the binning
-            if binning_dict.has_key(number):
-                this_bins = binning_dict[number][2]
-
-                size_diff = bins.shape[0] - this_bins.shape[0]
-
-                # Check that this is not larger than the bins array
-                if size_diff < 0:
-                    print "Error aligning binning arrays: The newest array is smaller than a previous array."
-                    return
-
-                # Find the best alignment
-                norm = lambda v: numpy.sqrt(numpy.dot(v,v))
-                minimal = None
-
-
-                for i in range(size_diff+1):
-                    alignment_diff = norm(bins[i:bins.shape[0]-(size_diff-i)] - this_bins)
-
-                    if minimal==None or alignment_diff < minimal[0]:
-                        minimal = (alignment_diff, i)
-
-                if minimal[0]>0.1:
-                    print "Error aligning binning arrays: No good alignment found."
-                    return
-                    
-                # Check that the count array has the right shape
-                if (this_bins.shape[0]-1) != tarray.shape[0]:
-                    print "Mismatch in size for binning and count array for iteration %d" % number
+        nbins = bins.shape[0]-1
+
+        # See if we need to align the binning
+        binning_history = reference_history(None, binning_dict)
+        binning_rows, has_binning = binning_history.aligned_rows(history.numbers, fallback=False)
+
+        # Find the best alignment of all binnings at once. Entries without
+        # binning are not aligned.
+        offsets = zeros(len(history), dtype=int)
+        distances = zeros(len(history))
+        aligned = numpy.flatnonzero(has_binning)
+        offsets[aligned], distances[aligned] = align_binnings(bins, binning_history, binning_rows[aligned])
+
+        # Check that the binnings are not larger than the bins array, that
+        # they are aligned, and that the count arrays have the right shape
+        expected_lengths = numpy.where(has_binning, binning_history.lengths[binning_rows]-1, nbins)
+        errors = [(numpy.isinf(distances), "Error aligning binning arrays: The newest array is smaller than a previous array."),
+                  (distances>0.1, "Error aligning binning arrays: No good alignment found."),
+                  (history.lengths!=expected_lengths, "Mismatch in size for binning and count array for iteration %d")]
+        failed = numpy.any([error for (error, message) in errors], axis=0)
+        if failed.any():
+            first = numpy.flatnonzero(failed)[0]
+            for (error, message) in errors:
+                if error[first]:
+                    if "%d" in message:
+                        message = message % history.numbers[first]
+                    print message
                     return
 
-                # Add the counts to the sum
-                sums[minimal[1]:((bins.shape[0]-1)-(size_diff-minimal[1]))] += tarray
-
-            else:
-                # No alignment needed
-                # Check that the count array has the right shape
-                if (bins.shape[0]-1) != tarray.shape[0]:
-                    print "Mismatch in size for binning and count array for iteration %d" % number
-                    return
-
-                sums += tarray
+        # Add the counts to the sum
+        mask = history.mask()
+        columns = offsets[:,numpy.newaxis] + numpy.arange(history.values.shape[1])
+        sums = numpy.bincount(columns[mask], weights=history.values[mask], minlength=nbins)[:nbins]
+        sums = sums.astype(history.values.dtype)
 
         # Normalize by bin width, if the binwidh is available 
         if bin_widths_dict!=None and bin_widths_dict.has_key(newest):
@@ -235,7 +276,6 @@ def plot_sum_N(log_entry_list, binning=None, binning_dict=None, bin_widths=None,
 
 if __name__ == "__main__":
     import os
-    from details.parse_statics_log import parse_statics_log, convert_log_entries
 
     from optparse import OptionParser
     parser = OptionParser("usage: %prog [options]")
@@ -275,6 +315,10 @@ if __name__ == "__main__":
                       help="Set a different label on the x-axis than 'E'.")
     parser.add_option("--no-bins", dest="bin_numbers", action="store_false", default=True,
                       help="Disable bin numbers on the x-axis.")
+    parser.add_option("--processes", dest="processes", metavar="VAL", type="int", default=None,
+                      help="Number of processes decoding the log entries [default: number of processors].")
+    parser.add_option("--cache", dest="cache", metavar="FILE", type="string", default=None,
+                      help="Store the decoded log entries in this file (numpy .npz format), and only decode entries added to the log since on later runs.")
 
     (options, args) = parser.parse_args()
 
@@ -315,14 +359,18 @@ if __name__ == "__main__":
             parser.error("Invalid index value used with option -i.")
 
             
-    # Parse the log file
-    log_dict = parse_statics_log(options.muninn_log_file, options.start, options.end, options.indices)
-
-    # Convert the binning from strings to arrays and make a dictionary
-    binning = convert_log_entries(log_dict.get('binning', []))
+    # Load and decode the entries of the log file in parallel, as
+    # arrays with a row for each iteration
+    log_dict = load_statics_log_history(options.muninn_log_file,
+                                        ['binning', 'bin_widths', 'lnG', 'lnG_support', 'lnw', 'N'],
+                                        options.start, options.end, options.indices,
+                                        processes=options.processes, cache_filename=options.cache)
+
+    # Make dictionaries of the binning
+    binning = log_dict['binning']
     binning_dict = dict(map(lambda entry: (entry[0], entry), binning))
 
-    bin_widths = convert_log_entries(log_dict.get('bin_widths', []))
+    bin_widths = log_dict['bin_widths']
     bin_widths_dict = dict(map(lambda entry: (entry[0], entry), bin_widths))
 
 
@@ -336,7 +384,7 @@ if __name__ == "__main__":
     points = []
         
     if options.lng:
-        support = convert_log_entries(log_dict.get('lnG_support', []))
+        support = log_dict['lnG_support']
         support_dict = dict(map(lambda entry: (entry[0], entry), support))
         p = plot_entry_list(log_dict.get('lnG', []), binning, binning_dict, bin_widths, bin_widths_dict, support_dict,
                             xlab=options.xlab, ylab="ln(G)", xmin=xmin, xmax=xmax, main=options.main,
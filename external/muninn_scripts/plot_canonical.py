@@ -25,7 +25,8 @@ from details.CanonicalProperties import CanonicalProperties, CanonicalException
 
 if __name__ == "__main__":
     import os
-    from numpy import arange, vectorize
+    import sys
+    from numpy import arange
     from details.utils import pickle_to_file
     from details.parse_statics_log import parse_statics_log, convert_log_entries
 
@@ -40,17 +41,19 @@ if __name__ == "__main__":
     parser.add_option("--width", dest="width", metavar="FLOAT", type="float", default=7., help="The width of the graphics region in inches [default %default].")
     parser.add_option("--height", dest="height", metavar="FLOAT", type="float", default=7., help="The height of the graphics region in inches [default %default].")
     parser.add_option("--cex", dest="cex", metavar="FLOAT", type="float", default=1, help="Scaling factor for the font size [default %default].")
+    parser.add_option("--peak", dest="peak", default=False, action="store_true", help="Only print the location of the heat capacity maximum, without plotting. Additional statics-log filenames can be given as arguments.")
 
     (options, args) = parser.parse_args()
 
     # Check that rpy is present
-    try:
-        from rpy import r
-    except ImportError:
-        parser.error("rpy is not install.")
+    if not options.peak:
+        try:
+            from rpy import r
+        except ImportError:
+            parser.error("rpy is not install.")
 
     # Check arguments
-    if len(args)>0:
+    if len(args)>0 and not options.peak:
         parser.error("No additional arguments should be given.")
 
     # Check options
@@ -60,6 +63,21 @@ if __name__ == "__main__":
     if not os.access(options.muninn_log_file, os.R_OK):
         parser.error("File '" + options.muninn_log_file + "' not accessible.")
 
+    inv_beta = arange(options.inv_beta_min, options.inv_beta_max, 0.01)
+    beta = 1.0/inv_beta
+
+    # Only locate the heat capacity maximum for each of the logs
+    if options.peak:
+        for muninn_log_file in [options.muninn_log_file] + args:
+            try:
+                cp = CanonicalProperties(muninn_log_file, options.which)
+            except CanonicalException, e:
+                print parser.error(e)
+
+            (beta_peak, C_peak) = cp.C_peak(beta)
+            print "%s (%s): C peak at 1/beta = %g, C = %g" % (muninn_log_file, cp.fullname, 1.0/beta_peak, C_peak)
+        sys.exit(0)
+
     # Make the CanonicalProperties
     try:
         cp = CanonicalProperties(options.muninn_log_file, options.which)
@@ -72,31 +90,30 @@ if __name__ == "__main__":
     # Print which is used
     print "Using:", cp.fullname
 
+    # Evaluate all curves at once
+    curves = cp.curves(beta)
 
     # Plot the required output
     r.pdf(options.output, width=options.width, height=options.height)      
     r.par(cex=options.cex)
 
-    inv_beta = arange(options.inv_beta_min, options.inv_beta_max, 0.01)
-    beta = 1.0/inv_beta
-
-    lnZ = vectorize(cp.lnZ)(beta)
+    lnZ = curves['lnZ']
     r.plot(inv_beta, lnZ, type='l', xlab=r("expression(beta**-1)"), ylab=r("""expression(paste("ln ", Z(beta)))"""))
     data.append((cp.number, "lnZ", (inv_beta, lnZ)))
 
-    betaF = vectorize(cp.betaF)(beta)
+    betaF = curves['betaF']
     r.plot(inv_beta, betaF, type='l', xlab=r("expression(beta**-1)"), ylab=r("expression(F(beta) * beta)"))
     data.append((cp.number, "betaF", (inv_beta, betaF)))
 
-    S = vectorize(cp.S)(beta)
+    S = curves['S']
     r.plot(inv_beta, S, type='l', xlab=r("expression(beta**-1)"), ylab=r("expression(S(beta) / k[B])"))
     data.append((cp.number, "S", (inv_beta, S)))
 
-    E = vectorize(cp.E)(beta)
+    E = curves['E']
     r.plot(inv_beta, E, type='l', xlab=r("expression(beta**-1)"), ylab=r("expression(bar(E)(beta))"))
     data.append((cp.number, "E", (inv_beta, E)))
 
-    C = vectorize(cp.C)(beta)
+    C = curves['C']
     r.plot(inv_beta, C, type='l', xlab=r("expression(beta**-1)"), ylab=r("expression(C(beta)/k[B])"))
     data.append((cp.number, "C", (inv_beta, C)))
     
@@ -0,0 +1,133 @@
+# finite_differences.py --- Derivatives of frame energies by finite differences
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import numpy
+
+
+class FiniteDifferenceDerivatives:
+    '''Calculates the derivative of the energy of each frame with respect to
+parameters by finite differences of evaluator runs. The runs for all parameters
+are submitted together (using evaluate_energies of the ensemble), and a single run
+at the unperturbed parameters is shared by all of them.
+
+The step size of each parameter is chosen adaptively. If the rounding error,
+due to the limited precision with which the evaluator writes energies, is too
+large, the step is increased. Otherwise, the step is halved until two consecutive
+estimates agree to within the tolerance, relative to the largest derivative.'''
+
+    # Offsets (in units of the step size) and coefficients of the difference
+    # formulas, by order of accuracy. The zero offset uses the shared base run.
+    stencils = {1: ([0, 1], [-1.0, 1.0]),
+                2: ([1, -1], [0.5, -0.5]),
+                4: ([2, 1, -1, -2], [-1.0/12, 8.0/12, -8.0/12, 1.0/12])}
+
+    def __init__(self, order=2, relative_step=0.01, tolerance=0.01, output_precision=1e-6,
+                 max_refinements=4, log_level=0):
+        '''Constructor. The initial step is relative_step times the parameter
+value (or times one, for values below one). The output_precision is the relative
+precision of the energies written by the evaluator.'''
+        if not self.stencils.has_key(order):
+            raise ValueError("Unsupported finite difference order: %s" % order)
+        self.order = order
+        self.relative_step = relative_step
+        self.tolerance = tolerance
+        self.output_precision = output_precision
+        self.max_refinements = max_refinements
+        self.log_level = log_level
+
+
+    def calculate(self, ensemble, evaluator_path, parameters):
+        '''Calculate the derivatives of the energies of the frames of the
+ensemble with respect to each of the parameters, at their current values.
+Returns a list of two-column (iteration, derivative) arrays, one for each
+parameter.'''
+
+        offsets, coefficients = self.stencils[self.order]
+        steps = [self.relative_step*max(abs(parameter.get_value()), 1.0) for parameter in parameters]
+        previous_estimates = [None]*len(parameters)
+        results = [None]*len(parameters)
+        base_energies = None
+
+        for refinement in range(self.max_refinements+1):
+
+            pending = [i for i in range(len(parameters)) if results[i] is None]
+            if len(pending) == 0:
+                break
+
+            # All runs of this round are submitted together
+            parameter_sets = []
+            if base_energies is None:
+                parameter_sets.append([])
+            for i in pending:
+                for offset in offsets:
+                    if offset != 0:
+                        perturbed_parameter = copy.copy(parameters[i])
+                        perturbed_parameter.set_value(parameters[i].get_value() + offset*steps[i])
+                        parameter_sets.append([perturbed_parameter])
+            energies = ensemble.evaluate_energies(evaluator_path, parameter_sets)
+            if base_energies is None:
+                base_energies = energies.pop(0)
+            energy_scale = numpy.max(numpy.abs(base_energies[:,1]))
+
+            for i in pending:
+                estimate = numpy.zeros(len(base_energies))
+                for offset, coefficient in zip(offsets, coefficients):
+                    if offset == 0:
+                        offset_energies = base_energies
+                    else:
+                        offset_energies = energies.pop(0)
+                    if len(offset_energies) != len(base_energies):
+                        raise ValueError("Evaluator runs for finite differences returned different numbers of frames")
+                    estimate += coefficient*offset_energies[:,1]
+                estimate /= steps[i]
+
+                derivative_scale = max(numpy.max(numpy.abs(estimate)), numpy.finfo(float).tiny)
+                rounding_error = (self.output_precision*energy_scale*numpy.sum(numpy.abs(coefficients))
+                                  /steps[i]/derivative_scale)
+                last_refinement = (refinement == self.max_refinements)
+
+                if previous_estimates[i] is None:
+                    if rounding_error > self.tolerance and not last_refinement:
+                        steps[i] *= 4.0
+                    elif last_refinement:
+                        results[i] = estimate
+                    else:
+                        previous_estimates[i] = estimate
+                        steps[i] /= 2.0
+                else:
+                    difference = numpy.max(numpy.abs(estimate - previous_estimates[i]))/derivative_scale
+                    if difference <= self.tolerance or last_refinement:
+                        results[i] = estimate
+                    elif rounding_error > difference:
+                        # Smaller steps would only increase the error
+                        results[i] = previous_estimates[i]
+                    else:
+                        previous_estimates[i] = estimate
+                        steps[i] /= 2.0
+
+                if self.log_level >= 2 and results[i] is not None:
+                    print "Finite difference derivative for %s with step %s" % (parameters[i].get_name(), steps[i])
+
+        derivatives = []
+        for result in results:
+            values = numpy.empty((len(base_energies), 2))
+            values[:,0] = base_energies[:,0]
+            values[:,1] = result
+            derivatives.append(values)
+        return derivatives
@@ -0,0 +1,89 @@
+# nettuno_client.py --- Command line client for the Nettuno server
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import optparse
+import json
+import sys
+
+from NettunoClient import NettunoClient
+from utils import option_list_to_dict
+
+
+if __name__ == "__main__":
+
+    usage = '''%prog [options] COMMAND [ARGUMENTS]
+
+Sends a command to a Nettuno server started with nettuno_optimizer.py --serve.
+
+Commands:
+  register target|model simulation_type:SIMULATION_TYPE id:ID directory:DIRECTORY [platform-specific-options]
+  optimize [--max_iterations N]
+  scan GRIDFILE
+  status
+  shutdown
+'''
+
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--socket", dest="socket", default=".nettuno.socket",
+                      help="Unix socket on which the server listens")
+    parser.add_option("--max_iterations", dest="max_iterations", type="int", default=None,
+                      help="Maximum number of iterations of the optimizer for optimize")
+    parser.add_option("--scan_output", dest="scan_output", default=None,
+                      help="File in which the server saves the results of scan (numpy .npz format)")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    command = args[0]
+    arguments = {}
+    if command == "register":
+        if len(args) < 2:
+            parser.error("register requires target or model, followed by the ensemble options")
+        arguments["role"] = args[1]
+        arguments["options"] = option_list_to_dict(args[2:])
+    elif command == "optimize":
+        if options.max_iterations != None:
+            arguments["max_iterations"] = options.max_iterations
+    elif command == "scan":
+        if len(args) < 2:
+            parser.error("scan requires a file with the parameter grid")
+        import numpy
+        arguments["parameter_grid"] = numpy.loadtxt(args[1], ndmin=2).tolist()
+        arguments["output_filename"] = options.scan_output
+
+    client = NettunoClient(options.socket)
+    try:
+        result = client.send(command, **arguments)
+    except (RuntimeError, IOError), e:
+        print "ERROR:", e
+        sys.exit(1)
+    finally:
+        client.close()
+
+    if command == "scan":
+        print "%-30s %14s %14s %14s" % ("parameters", "delta_S_rel", "|S_rel'|", "min. ESS")
+        for k in range(len(result["parameters"])):
+            print "%-30s %14.5g %14.5g %14.1f" % (" ".join(["%g" % value for value in result["parameters"][k]]),
+                                                  result["delta_S_rel"][k],
+                                                  numpy.linalg.norm(result["S_rel_derivative"][k]),
+                                                  numpy.min(numpy.array(result["effective_sample_size_per_id"])[:,k]))
+    elif result != None:
+        print json.dumps(result, indent=2, sort_keys=True)
@@ -19,31 +19,57 @@
 import optparse
 import utils
 import sys
+import datetime
+import shutil
 
 from EnsembleCollection import EnsembleCollection
-from SteepestDescentOptimizer import SteepestDescentOptimizer
+from OptimizerSelector import OptimizerSelector
 from platforms.PlatformSelector import PlatformSelector
-from platforms.Ensemble import Ensemble
+import Executor
+from tracing import tracer
 
 
 class Nettuno:
     '''Main Nettuno class containing EnsembleCollection and Optimizer objects'''
 
-    def __init__(self, optimizer, init_filename=".nettuno", log_level=0):
+    def __init__(self, optimizer, init_filename=".nettuno", log_level=0, noise_threshold=None,
+                 prefetch_memory=None, memory_budget=None, auto_iteration_range=False, max_iterations=None,
+                 step_tolerance=None, gradient_tolerance=None):
         self.init_filename = init_filename
         self.ensemble_collection = EnsembleCollection(log_level)
-        # self.optimizer = Optimizer()
-        if optimizer == "steepest_descent":
-            self.optimizer = SteepestDescentOptimizer(log_level)
-        else:
+        if optimizer not in OptimizerSelector.get_optimizer_names():
             print "Unknown optimization algorithm: %s. Aborting." % optimizer
             sys.exit(1)
+
+        # The optimizer is constructed on first use
+        self.optimizer_name = optimizer
+        self.optimizer_args = {"noise_threshold": noise_threshold,
+                               "prefetch_memory": prefetch_memory,
+                               "memory_budget": memory_budget,
+                               "auto_iteration_range": auto_iteration_range,
+                               "max_iterations": max_iterations,
+                               "step_tolerance": step_tolerance,
+                               "gradient_tolerance": gradient_tolerance}
+        self.optimizer = None
+        self.log_level = log_level
         self.read_init_file()
 
     def read_init_file(self):
         '''Reads configuration file'''
         self.ensemble_collection.read_init_file(self.init_filename)
-        self.optimizer.read_init_file(self.init_filename)
+
+        # The parameter names are also read here, so that the settings can be
+        # written without constructing the optimizer
+        self.parameter_names = []
+        init_file = open(self.init_filename)
+        for line in init_file.readlines():
+            line_split = line.strip().split()
+            if len(line_split) > 1 and line_split[0] == "add_parameter":
+                self.parameter_names.append(line_split[1])
+        init_file.close()
+
+        if self.optimizer != None:
+            self.optimizer.read_init_file(self.init_filename)
     
     def output_init_file(self, init_file_output):
         '''Writes configuration file'''
@@ -56,8 +82,11 @@ class Nettuno:
             print repr(self),
             print "###############################"
         else :
-            init_file = open(self.init_filename, "w")
-            init_file.write(repr(self))
+            # The settings are generated before the file is truncated, since
+            # the optimizer may still need to read it
+            output = repr(self)
+            init_file = open(init_file_output, "w")
+            init_file.write(output)
             init_file.close()
 
     def get_ensemble_collection(self):
@@ -66,15 +95,68 @@ class Nettuno:
 
     def get_optimizer(self):
         '''Retrieve Optimizer object'''
+        if self.optimizer == None:
+            self.optimizer = OptimizerSelector.get_optimizer(self.optimizer_name, self.log_level,
+                                                             **self.optimizer_args)
+            self.optimizer.read_init_file(self.init_filename)
         return self.optimizer
 
-    def optimize(self):
-        '''Start optimization procedure'''
-        if len(self.ensemble_collection) > 0:
-            self.optimizer.optimize(self.ensemble_collection)
+    def optimize(self, max_iterations=None, initial_parameter_values=None):
+        '''Start optimization procedure. Returns the optimized parameters. If
+max_iterations is given, it replaces the iteration limit of the optimizer for this
+optimization, and if initial_parameter_values are given, the optimization starts
+from these values rather than from the parameters of the model ensembles.'''
+        if len(self.ensemble_collection.get_model_ids()) == 0:
+            return None
+        optimizer = self.get_optimizer()
+
+        overrides = {}
+        if max_iterations != None:
+            overrides["max_iterations"] = max_iterations
+        if initial_parameter_values != None:
+            overrides["initial_parameter_values"] = initial_parameter_values
+        defaults = dict((name, getattr(optimizer, name)) for name in overrides)
+        for name, value in overrides.items():
+            setattr(optimizer, name, value)
+        try:
+            return optimizer.optimize(self.ensemble_collection)
+        finally:
+            for name, value in defaults.items():
+                setattr(optimizer, name, value)
+
+    def multi_start(self, starts, threads=None):
+        '''Run several optimizations concurrently on the ensembles, given a
+list of dictionaries of optimizer arguments (see read_starts_file), which may
+name the optimizer under "optimizer". Returns the results of all optimizers and
+the index of the best one (see MultiStartOptimizer.optimize).'''
+        from MultiStartOptimizer import MultiStartOptimizer
+        optimizers = []
+        for start in starts:
+            optimizer_args = dict(self.optimizer_args)
+            optimizer_args.update(start)
+            name = optimizer_args.pop("optimizer", self.optimizer_name)
+            optimizer = OptimizerSelector.get_optimizer(name, self.log_level, **optimizer_args)
+            optimizer.read_init_file(self.init_filename)
+            optimizers.append(optimizer)
+        return MultiStartOptimizer(optimizers, threads, self.log_level).optimize(self.ensemble_collection)
+
+    def scan(self, parameter_grid, output_filename=None):
+        '''Evaluate the relative entropy derivatives at a grid of parameter
+values, given as an array with a row of parameter values for each grid point.
+Returns a dictionary of result arrays (see Optimizer.scan), which are optionally
+saved to output_filename in numpy .npz format.'''
+        import numpy
+        results = self.get_optimizer().scan(self.ensemble_collection, parameter_grid)
+        if output_filename != None:
+            numpy.savez(output_filename, **results)
+        return results
 
     def __repr__(self):
-        return repr(self.optimizer) + "\n" + repr(self.ensemble_collection)
+        if self.optimizer != None:
+            optimizer_output = repr(self.optimizer)
+        else:
+            optimizer_output = "".join(["add_parameter %s \n" % parameter for parameter in self.parameter_names])
+        return optimizer_output + "\n" + repr(self.ensemble_collection)
 
 
 
@@ -91,6 +173,8 @@ Strategy:
 5. Optimize (using --optimize option).
 6. Repeat 3-6 with the parameter values found by 5.
 
+Steps 3-6 can be automated with the --simulation_command option.
+
 '''
 
     # Output for general platform options
@@ -98,12 +182,16 @@ Strategy:
     ensemble_option_help += str(utils.SubOptions({'id':'ID (connects target and model ensembles)',
                                                   'directory': 'Directory containing simulation data',
                                                   'beta': 'Inverse temperature at which analysis should be done',
-                                                  'iteration_range': 'Range used in analysis:\n\t[start_index, end_index, interval]'}))
+                                                  'iteration_range': 'Range used in analysis:\n\t[start_index:end_index:interval], \n\twith the interval counted in samples, \n\tor auto to detect it from the samples'}))
 
-    # Platform specific options are retrieved from classes
+    # Platform specific options are retrieved from the platform registry
     ensemble_option_help += "\nPlatform specific options:\n"
-    for cls in Ensemble.__subclasses__():
-        ensemble_option_help += "\n"+cls.simulation_type + "\t" + cls.get_option_help()
+    for simulation_type in PlatformSelector.get_simulation_types():
+        ensemble_option_help += "\n"+simulation_type + "\t" + str(utils.SubOptions(PlatformSelector.get_option_help(simulation_type)))
+
+    optimizer_help = "Which optimization algorithm to use:"
+    for optimizer_name in OptimizerSelector.get_optimizer_names():
+        optimizer_help += "\n%s: %s" % (optimizer_name, OptimizerSelector.get_description(optimizer_name))
 
 
     # Option definitions
@@ -120,16 +208,132 @@ Strategy:
                       help="File in which to read optimization settings.")
     parser.add_option("--init_file_output", dest="init_file_output", default="stdout",
                       help="File/stream in which to write optimization settings.")
-    parser.add_option("--optimizer", dest="optimizer", type='choice', choices=['steepest_descent'], 
+    parser.add_option("--optimizer", dest="optimizer", type='choice', choices=OptimizerSelector.get_optimizer_names(), 
                       default="steepest_descent",
-                      help="Which optimization algorithm to use")
-    parser.add_option("--log_level", dest="log_level", default="1",
+                      help=optimizer_help)
+    parser.add_option("--log_level", dest="log_level", type="int", default=1,
                       help="How much information to output to screen")
+    parser.add_option("--optimize", dest="optimize", action="store_true", default=False,
+                      help="Optimize parameters. Without this option, ensembles are only registered.")
+    parser.add_option("--scan", dest="scan", default=None,
+                      help="Evaluate the relative entropy derivatives at a grid of parameter values, read from this text file with a row of values (in the order of the parameters) for each grid point")
+    parser.add_option("--scan_output", dest="scan_output", default="scan.npz",
+                      help="File in which to save the results of --scan (numpy .npz format)")
+    parser.add_option("--multi_start", dest="multi_start", default=None,
+                      help="Run several optimizations concurrently, sharing the loaded ensemble data, and report the best result. Each line of this file describes one optimization with options such as optimizer:NAME start:VALUE,VALUE,... step_size:STEP step_decay:DECAY max_iterations:N step_tolerance:TOL gradient_tolerance:TOL")
+    parser.add_option("--multi_start_threads", dest="multi_start_threads", type="int", default=None,
+                      help="Number of optimizations of --multi_start running at the same time (default: all)")
+    parser.add_option("--max_iterations", dest="max_iterations", type="int", default=1000,
+                      help="Stop optimizing after this many evaluations of the relative entropy derivatives")
+    parser.add_option("--step_tolerance", dest="step_tolerance", type="float", default=None,
+                      help="Stop optimizing when no parameter changes by more than this in a step")
+    parser.add_option("--gradient_tolerance", dest="gradient_tolerance", type="float", default=None,
+                      help="Stop optimizing when no relative entropy derivative exceeds this in absolute value")
+    parser.add_option("--noise_threshold", dest="noise_threshold", type="float", default=None,
+                      help="Stop optimizing when the relative entropy derivatives are within this many (block bootstrap) standard errors of zero")
+
+    parser.add_option("--prefetch_memory", dest="prefetch_memory", type="float", default=None,
+                      help="Load ensemble data in the background, reading ahead as far as this memory budget (in MB) allows")
+    parser.add_option("--auto_iteration_range", dest="auto_iteration_range", action="store_true", default=False,
+                      help="Detect the equilibration period and the statistical inefficiency of ensembles without an iteration_range, and use them as start and stride (in samples). Can also be requested per ensemble with iteration_range:auto.")
+    parser.add_option("--memory_budget", dest="memory_budget", type="float", default=None,
+                      help="Memory-bounded mode: only read the rt columns that are used, and calculate averages in chunks fitting within this budget (in MB)")
+    parser.add_option("--single_precision", dest="single_precision", action="store_true", default=False,
+                      help="Store derivatives in single precision. Averages are still accumulated in double precision.")
+    parser.add_option("--surrogate_tolerance", dest="surrogate_tolerance", type="float", default=None,
+                      help="For nonlinear parameters, approximate the energy of each frame by a second-order expansion in the parameters, fitted from evaluator runs. The expansion is refitted when its error on a subset of the frames exceeds this tolerance (in kT).")
+    parser.add_option("--surrogate_step", dest="surrogate_step", type="float", default=0.05,
+                      help="Distance of the evaluator runs used to fit the energy surrogate, relative to the parameter values")
+    parser.add_option("--finite_difference_order", dest="finite_difference_order", type="choice", choices=["1", "2", "4"], default="2",
+                      help="Order of accuracy of the finite differences used for the derivatives of nonlinear parameters without analytical derivatives: 1 (forward), 2 or 4 (central)")
+    parser.add_option("--finite_difference_step", dest="finite_difference_step", type="float", default=0.01,
+                      help="Initial step of finite differences, relative to the parameter values. The step is adapted to the precision of the evaluator output.")
+    parser.add_option("--full_evaluation", dest="full_evaluation", action="store_true", default=False,
+                      help="Let the evaluator calculate all energy terms when parameters change, rather than only the terms depending on the parameters")
+    parser.add_option("--executor", dest="executor", type='choice', choices=Executor.get_executor_names(), default="serial",
+                      help="How evaluator jobs are run: serial (local, one at a time), pool (local, concurrently), batch (submitted to a batch queue system) or local_batch (local stand-in for a batch queue system). Choices: " + ", ".join(Executor.get_executor_names()))
+    parser.add_option("--executor_workers", dest="executor_workers", type="int", default=None,
+                      help="Number of concurrent jobs for the pool executor (default: number of processors)")
+    parser.add_option("--batch_submit_command", dest="batch_submit_command", default="sbatch",
+                      help="Command used to submit job scripts for the batch executor")
+    parser.add_option("--batch_poll_interval", dest="batch_poll_interval", type="float", default=None,
+                      help="Seconds between checks for completed jobs for the batch executors")
+    parser.add_option("--scratch_directory", dest="scratch_directory", default=None,
+                      help="Directory for the working directories of evaluator jobs. For the batch executor, this must be shared with the compute nodes.")
+    parser.add_option("--simulation_command", dest="simulation_command", default=None,
+                      help="Orchestrator mode: after optimizing, write the parameters to a new model ensemble directory for each id, run this command there through the executor, register the new ensembles and optimize again, refining the parameters while the simulations run. %(directory)s, %(id)s and %(round)d are substituted.")
+    parser.add_option("--simulation_executor", dest="simulation_executor", type='choice',
+                      choices=[name for name in Executor.get_executor_names() if name != "serial"], default="pool",
+                      help="How simulations are run in orchestrator mode. They have their own executor, so that evaluator jobs do not wait for them, which must run them in the background. Choices: " + ", ".join([name for name in Executor.get_executor_names() if name != "serial"]))
+    parser.add_option("--simulation_workers", dest="simulation_workers", type="int", default=None,
+                      help="Number of concurrent simulations for the pool simulation executor (default: one per id)")
+    parser.add_option("--refine_iterations", dest="refine_iterations", type="int", default=20,
+                      help="Maximum number of optimizer iterations of each refinement while simulations run in orchestrator mode")
+    parser.add_option("--rounds", dest="rounds", type="int", default=1,
+                      help="Number of rounds of simulation and optimization in orchestrator mode")
+    parser.add_option("--ensemble_directory_pattern", dest="ensemble_directory_pattern", default="%(id)s_model%(round)d",
+                      help="Name of new model ensemble directories in orchestrator mode. %(id)s and %(round)d are substituted.")
+    parser.add_option("--poll_interval", dest="poll_interval", type="float", default=60.0,
+                      help="Seconds between refinements while simulations run in orchestrator mode")
+    parser.add_option("--serve", dest="serve", default=None, metavar="SOCKET",
+                      help="Server mode: keep the ensembles and caches in memory and execute register, optimize, scan and status commands sent to this Unix socket by nettuno_client.py, until it sends shutdown")
+    parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                      help="Time the stages of the optimization and print a summary at the end")
+    parser.add_option("--trace_file", dest="trace_file", default=None,
+                      help="Write timings, child process resource usage and bytes read per file to this JSON file (implies --profile)")
 
     (options, args) = parser.parse_args()
 
+    if options.profile or options.trace_file != None:
+        tracer.enable()
+
+    prefetch_memory = None
+    if options.prefetch_memory != None:
+        prefetch_memory = int(options.prefetch_memory*1024*1024)
+
+    memory_budget = None
+    if options.memory_budget != None:
+        memory_budget = int(options.memory_budget*1024*1024)
+
+    def create_executor(name, workers):
+        '''Construct the executor with the given name from the options'''
+        executor_args = {}
+        if name == "pool":
+            executor_args["workers"] = workers
+        elif name in ["batch", "local_batch"]:
+            if name == "batch":
+                executor_args["submit_command"] = options.batch_submit_command
+            if options.batch_poll_interval != None:
+                executor_args["poll_interval"] = options.batch_poll_interval
+        executor = Executor.get_executor(name, **executor_args)
+        if options.scratch_directory != None:
+            executor.scratch_directory = options.scratch_directory
+        return executor
+
+    # Ensemble data is only read by the commands below that optimize or scan.
+    # Registering ensembles does not import the numerical modules.
+    reads_data = (options.optimize or options.scan != None or options.multi_start != None or
+                  options.simulation_command != None or options.serve != None)
+
+    executor = None
+    if reads_data:
+        from platforms.Ensemble import Ensemble
+
+        Ensemble.set_memory_mode(memory_bounded=(memory_budget != None),
+                                 single_precision=options.single_precision)
+
+        Ensemble.set_surrogate_mode(options.surrogate_tolerance, options.surrogate_step)
+        Ensemble.set_term_restricted_evaluation(not options.full_evaluation)
+        Ensemble.set_finite_difference_mode(int(options.finite_difference_order), options.finite_difference_step)
+
+        # Executor for evaluator jobs
+        executor = create_executor(options.executor, options.executor_workers)
+        Ensemble.set_executor(executor)
+
     # Allocate main object
-    nettuno = Nettuno(options.optimizer, options.init_file, int(options.log_level))
+    nettuno = Nettuno(options.optimizer, options.init_file, options.log_level, options.noise_threshold,
+                      prefetch_memory, memory_budget, options.auto_iteration_range, options.max_iterations,
+                      options.step_tolerance, options.gradient_tolerance)
 
     # Add ensembles specified from command line
     for target_ensemble_tuple in options.new_target_ensembles:
@@ -140,10 +344,50 @@ Strategy:
         option_dict = EnsembleCollection.option_list_to_ensemble_option_dict(model_ensemble_tuple)
         nettuno.get_ensemble_collection().add_model_ensemble(**option_dict)
 
-    # Optionally write out settings to file or stdout
+    # Call optimization
+    if options.serve != None:
+        from NettunoServer import NettunoServer
+        init_file_output = None
+        if options.init_file_output != "stdout":
+            init_file_output = options.init_file_output
+        NettunoServer(options.serve, nettuno, init_file_output, options.log_level).run()
+    elif options.simulation_command != None:
+        from Orchestrator import Orchestrator
+        simulation_executor = None
+        if options.simulation_executor != "pool" or options.simulation_workers != None:
+            simulation_executor = create_executor(options.simulation_executor, options.simulation_workers)
+        Orchestrator(nettuno, options.simulation_command, simulation_executor, options.rounds,
+                     options.ensemble_directory_pattern, options.poll_interval, options.refine_iterations,
+                     options.log_level).run()
+        if simulation_executor != None:
+            simulation_executor.shutdown()
+    elif options.multi_start != None:
+        from MultiStartOptimizer import read_starts_file
+        nettuno.multi_start(read_starts_file(options.multi_start), options.multi_start_threads)
+    elif options.optimize:
+        nettuno.optimize()
+
+    if options.scan != None:
+        import numpy
+        results = nettuno.scan(numpy.loadtxt(options.scan, ndmin=2), options.scan_output)
+        if options.log_level >= 1:
+            print "%-30s %14s %14s %14s" % ("parameters", "delta_S_rel", "|S_rel'|", "min. ESS")
+            for k in range(len(results["parameters"])):
+                print "%-30s %14.5g %14.5g %14.1f" % (" ".join(["%g" % value for value in results["parameters"][k]]),
+                                                      results["delta_S_rel"][k],
+                                                      numpy.linalg.norm(results["S_rel_derivative"][k]),
+                                                      numpy.min(results["effective_sample_size_per_id"][:,k]))
+
+    # Optionally write out settings to file or stdout. This is done after
+    # optimization to include settings detected during the optimization.
     if options.init_file_output != "stdout" or options.log_level >=1:
         nettuno.output_init_file(options.init_file_output)
 
+    if executor != None:
+        executor.shutdown()
 
-    # Call optimization
-    nettuno.optimize()
+    # Output timings
+    if tracer.enabled:
+        print tracer.format_summary()
+        if options.trace_file != None:
+            tracer.write_json(options.trace_file)
@@ -19,6 +19,20 @@
 
 from abc import ABCMeta, abstractmethod
 import copy
+import numpy
+
+from Executor import SerialExecutor
+from error_estimation import detect_equilibration
+
+class EvaluatorException(Exception):
+    '''Exception raised when an evaluator run fails.'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
 
 class Ensemble:
     '''Ensemble base class. All platform specific Ensemble implementations
@@ -29,11 +43,55 @@ should derive from this.'''
 
     simulation_type = ""
 
+    # In memory-bounded mode, only the columns that are actually used are
+    # read from data files
+    memory_bounded = False
+
+    # Type used to store derivative values. Averages are always accumulated
+    # in double precision.
+    derivative_dtype = numpy.float64
+
+    # Executor through which external programs such as evaluators are run
+    executor = SerialExecutor()
+
+    # Maximal error (in units of kT) of the energy surrogate used for nonlinear
+    # parameters, None to always run the evaluator on all frames
+    surrogate_tolerance = None
+
+    # Distance of the points used to fit the surrogate, relative to the
+    # parameter values (or absolute, for values below 1)
+    surrogate_step = 0.05
+
+    # Number of frames on which the surrogate is validated
+    surrogate_validation_frames = 20
+
+    # Whether evaluator runs for new parameter values only calculate the energy
+    # terms depending on the parameters, when the platform supports it
+    term_restricted_evaluation = True
+
+    # Order of accuracy and initial relative step of finite difference
+    # derivatives, used for nonlinear parameters without analytical derivatives
+    finite_difference_order = 2
+    finite_difference_step = 0.01
+
     def __init__(self, log_level=0):
         '''Constructor'''
         self.log_level = log_level
 
 
+    @classmethod
+    def set_memory_mode(cls, memory_bounded=False, single_precision=False):
+        '''Select how ensemble data is held in memory, for all ensembles of this
+class and its subclasses. If memory_bounded is set, only the columns used are
+read from data files. If single_precision is set, derivatives are stored as
+single precision floats.'''
+        cls.memory_bounded = memory_bounded
+        if single_precision:
+            cls.derivative_dtype = numpy.float32
+        else:
+            cls.derivative_dtype = numpy.float64
+
+
     def set_settings(self, directory, reweight_beta, iteration_range, **platform_specific_args):
         '''Initialize with object with current settings, and saves them
 for future retrieval. This method is separated from the constructor to 
@@ -53,9 +111,9 @@ containing platform specific settings.'''
         for item in self.settings.items():
             setattr(self, item[0], item[1])
 
-        # Overwrite iteration range if None
+        # Overwrite iteration range if None or auto (see detect_iteration_range)
         # Note, it still has original value in settings attribute
-        if self.iteration_range == None:
+        if self.iteration_range == None or self.iteration_range == "auto":
             self.iteration_range = [None, None,1]
         else:
             iteration_range = [None, None, 1]
@@ -68,21 +126,116 @@ containing platform specific settings.'''
             self.iteration_range = iteration_range
 
     
+    @classmethod
+    def set_surrogate_mode(cls, tolerance=None, step=0.05):
+        '''Select whether energies at new values of nonlinear parameters are
+approximated by a surrogate of the energy of each frame, for all ensembles of
+this class and its subclasses. The surrogate is refitted when its error on a
+subset of the frames exceeds tolerance (in units of kT). None disables it.'''
+        cls.surrogate_tolerance = tolerance
+        cls.surrogate_step = step
+
+
+    @classmethod
+    def set_finite_difference_mode(cls, order=2, step=0.01):
+        '''Select the order of accuracy (1, 2 or 4) and the initial relative
+step size of finite difference derivatives, for all ensembles of this class and
+its subclasses'''
+        cls.finite_difference_order = order
+        cls.finite_difference_step = step
+
+
+    @classmethod
+    def set_term_restricted_evaluation(cls, term_restricted_evaluation=True):
+        '''Select whether evaluator runs for new parameter values only calculate
+the energy terms depending on the parameters, for all ensembles of this class and
+its subclasses'''
+        cls.term_restricted_evaluation = term_restricted_evaluation
+
+
+    @classmethod
+    def set_executor(cls, executor):
+        '''Select the executor used to run external programs, for all ensembles
+of this class and its subclasses.'''
+        cls.executor = executor
+
+
     def get_settings(self):
         '''Retrieve settings stored by set_settings'''
         return self.settings
 
 
+    def set_iteration_range(self, start, end, every):
+        '''Change the range of iterations used in the analysis. The start and
+end are iteration indices, while every counts samples: every'th sample from
+the start is used, whatever the spacing of the iteration indices. The new range
+is also stored in the settings.'''
+        self.iteration_range = [start, end, every]
+        self.settings["iteration_range"] = "[%s]" % ":".join([str(value) if value != None else ""
+                                                              for value in self.iteration_range])
+
+
+    def detect_iteration_range(self, evaluator_path, parameters):
+        '''Choose the start and stride of the iteration range from the
+samples. The start is the end of the equilibration period, and the stride is
+the statistical inefficiency of the equilibrated samples, detected for the
+energies and the derivatives of linear parameters (which do not require
+evaluator runs). The most conservative choice over these observables is used.
+The start is an iteration index, while the stride counts samples, since the
+statistical inefficiency is measured in samples. The end of the iteration range
+is kept.'''
+
+        end = self.iteration_range[1]
+
+        # Analyse all samples
+        self.set_iteration_range(None, end, 1)
+        series = [self.get_energies()]
+        for parameter in parameters:
+            if getattr(parameter, "_type", None) == 'linear':
+                series.append(self.get_parameter_derivative_values(evaluator_path, parameter))
+
+        start = None
+        every = 1
+        for values in series:
+            start_index, inefficiency = detect_equilibration(values[:,1])
+            if len(values) > 0 and (start == None or values[start_index,0] > start):
+                start = values[start_index,0]
+            every = max(every, int(numpy.ceil(inefficiency)))
+
+        if start != None:
+            start = int(start)
+        self.set_iteration_range(start, end, every)
+
+
     def get_parameters(self, requested_parameter_list):
         '''Retrieve current force field parameters'''
         parameters = []
         for requested_parameter in requested_parameter_list:
-            for cls in self.__class__.ParameterClass.__subclasses__():
+            for cls in self.get_parameter_classes():
                 if cls.get_name() == requested_parameter:
                     parameters.append(cls(self.directory))
+                    break
 
         return parameters        
 
+    def get_parameter_classes(self):
+        '''All classes derived from the parameter class of the platform,
+direct subclasses first'''
+        classes = []
+        bases = [self.__class__.ParameterClass]
+        while len(bases) > 0:
+            subclasses = []
+            for base in bases:
+                subclasses += base.__subclasses__()
+            classes += subclasses
+            bases = subclasses
+        return classes
+
+    def classify_parameters(self, evaluator_path, parameters):
+        '''Determine the type (linear or nonlinear) of parameters whose type
+is not known in advance. Platforms with such parameters should override this.'''
+        pass
+
     @abstractmethod
     def get_option_help(self):
         '''Output for ensemble options used by command line parser. This is an abstract
@@ -97,9 +250,10 @@ method that must be overridden by derived classes.'''
         pass    
 
     @abstractmethod
-    def write_parameter_values(self, requested_parameter_list):
-        '''Write current parameter values in platform specific syntax. This is an abstract
-method that must be overridden by derived classes.'''
+    def write_parameter_values(self, parameters, directory=None):
+        '''Write parameter values in platform specific syntax, to the ensemble's
+directory or the specified directory. This is an abstract method that must be
+overridden by derived classes.'''
         pass
 
     @abstractmethod
@@ -108,10 +262,24 @@ method that must be overridden by derived classes.'''
 method that must be overridden by derived classes.'''
         pass
     
+    def prepare_parameter_derivatives(self, evaluator_path, parameters):
+        '''Called before the derivatives of several parameters are retrieved,
+allowing platforms to calculate them together'''
+        pass
+
+    def get_parameter_derivative_columns(self, evaluator_path, parameter):
+        '''Calculate the derivatives for a particular parameter, returned as a
+tuple of arrays of iteration indices and derivative values. The arrays may be
+shared with caches of the ensemble, and must not be modified. Platforms that
+cache derivatives should override this to avoid copying.'''
+        values = self.get_parameter_derivative_values(evaluator_path, parameter)
+        return values[:,0], values[:,1]
+
     @abstractmethod
     def get_energies(self, directory=None):
         '''Retrieve energies for all samples in the ensemble. Note that this
-method does conduct any new evaluations but simply retrieves values. This is an abstract
+method does conduct any new evaluations but simply retrieves values. The returned
+array belongs to the caller, who is free to modify it. This is an abstract
 method that must be overridden by derived classes.'''
         pass
 
@@ -151,12 +319,23 @@ the ensembles own beta.'''
         else:
             return self.get_beta()
 
-    def scalar_to_ensemble_array(self, scalar):
-        '''Turn a scalar into an array that is compatible with
-the format that energies and weights are reported in: two columns
-where the first contains the indices'''
-        
-        # Use energies as a template
-        energies = copy.copy(self.get_energies())
-        energies[:,1] = scalar
-        return energies
+    def get_data_filenames(self):
+        '''Files from which the data of the ensemble is read. Data derived
+from the ensemble must be recalculated when any of them is modified.'''
+        return []
+
+    def has_samples(self, directory=None):
+        '''Whether a simulation with the settings of this ensemble has written
+samples to directory (by default the directory of the ensemble). This is checked
+without reading the data, so it can be polled while the simulation runs.
+Platforms that do not write their samples to files always have samples.'''
+        return True
+
+    def prefetch(self):
+        '''Load the data of the ensemble into memory ahead of its use, typically
+from a background thread. Platforms that cache their data should override this.'''
+        pass
+
+    def estimate_memory(self):
+        '''Estimate of the memory in bytes used by prefetch().'''
+        return 0
@@ -0,0 +1,74 @@
+# EnsembleDescriptor.py --- Lightweight placeholder for an ensemble
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from PlatformSelector import PlatformSelector
+
+class EnsembleDescriptor(object):
+    '''Stores the settings of an ensemble without constructing it. The
+ensemble (and the platform module implementing it) is only created when one
+of its attributes or methods is first used, after which the descriptor acts
+as the ensemble itself. Settings can be retrieved without constructing the
+ensemble.'''
+
+    def __init__(self, simulation_type, directory, reweight_beta, iteration_range, log_level=0,
+                 platform_specific_args={}):
+        '''Constructor. Takes the same arguments as PlatformSelector.get_ensemble.'''
+        self.simulation_type = simulation_type
+        self.descriptor_settings = {"directory": directory,
+                                    "reweight_beta": reweight_beta,
+                                    "iteration_range": iteration_range}
+        self.platform_specific_args = platform_specific_args
+        self.log_level = log_level
+        self.ensemble = None
+
+    def get_ensemble(self):
+        '''Retrieve the ensemble, constructing it on first use.'''
+        if self.ensemble == None:
+            self.ensemble = PlatformSelector.get_ensemble(self.simulation_type,
+                                                          self.descriptor_settings["directory"],
+                                                          self.descriptor_settings["reweight_beta"],
+                                                          self.descriptor_settings["iteration_range"],
+                                                          self.log_level,
+                                                          self.platform_specific_args)
+        return self.ensemble
+
+    def is_constructed(self):
+        '''Whether the ensemble has been constructed.'''
+        return self.ensemble != None
+
+    def get_settings(self):
+        '''Retrieve settings. Settings which have not been specified explicitly
+only appear once the ensemble has been constructed.'''
+        if self.ensemble != None:
+            return self.ensemble.get_settings()
+
+        settings = dict(self.descriptor_settings)
+        settings.update(self.platform_specific_args)
+        return settings
+
+    def __getattr__(self, name):
+        '''Forward everything else to the ensemble. Only called for attributes
+not found on the descriptor itself.'''
+
+        # Avoid constructing the ensemble for special attributes, and
+        # infinite recursion on partially initialized descriptors (copy, pickle)
+        if name.startswith("__") or name in ("ensemble", "descriptor_settings", "platform_specific_args"):
+            raise AttributeError(name)
+
+        return getattr(self.get_ensemble(), name)
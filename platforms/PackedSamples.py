@@ -0,0 +1,150 @@
+# PackedSamples.py --- Samples of several ensembles in concatenated arrays
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+from error_estimation import segment_sums, segment_block_bootstrap_errors
+
+
+class PackedSamples:
+    '''Derivatives and log-weights of the samples of several ensembles, packed
+into concatenated arrays, so that averages over all ensembles are calculated
+with a few segmented reductions rather than a small calculation for each
+ensemble. The samples of ensemble k (segment k) are the rows
+offsets[k]:offsets[k+1] of the arrays. The derivatives have a column for each
+parameter, and are stored in the precision of the sample tables they come from.
+
+Ensembles are added one at a time with append, and pack must be called when
+all have been added.'''
+
+    def __init__(self, names):
+        '''Constructor. The names are the names of the derivative columns.'''
+        self.names = list(names)
+        self.offsets = numpy.zeros(1, dtype=int)
+        self.derivatives = numpy.zeros((0, len(self.names)))
+        self.log_weights = numpy.zeros(0)
+        self.segments = numpy.zeros(0, dtype=int)
+
+        # Columns of the ensembles appended since the last call to pack
+        self.appended_derivatives = []
+        self.appended_log_weights = []
+
+
+    def append(self, sample_table):
+        '''Add the samples of a SampleTable (see SampleTable.from_ensemble) as
+a new segment'''
+        self.appended_derivatives.append(sample_table.get_columns(self.names))
+        with numpy.errstate(divide='ignore'):
+            self.appended_log_weights.append(numpy.log(sample_table.column("weight")))
+
+
+    def pack(self):
+        '''Concatenate the samples of the appended ensembles'''
+        if len(self.appended_derivatives) == 0:
+            return
+        sample_counts = [len(log_weights) for log_weights in self.appended_log_weights]
+        self.offsets = numpy.append(self.offsets, self.offsets[-1] + numpy.cumsum(sample_counts))
+        if len(self.log_weights) == 0:
+            # Keep the precision of the appended derivatives
+            self.derivatives = numpy.concatenate(self.appended_derivatives)
+        else:
+            self.derivatives = numpy.concatenate([self.derivatives] + self.appended_derivatives)
+        self.log_weights = numpy.concatenate([self.log_weights] + self.appended_log_weights)
+        self.appended_derivatives = []
+        self.appended_log_weights = []
+
+        # Segment of each sample
+        self.segments = numpy.repeat(numpy.arange(self.segment_count()), numpy.diff(self.offsets))
+
+
+    def __len__(self):
+        return len(self.log_weights)
+
+
+    def segment_count(self):
+        '''Number of packed ensembles'''
+        return len(self.offsets)-1
+
+
+    def sample_counts(self):
+        '''Number of samples of each ensemble'''
+        return numpy.diff(self.offsets)
+
+
+    def segment_sums(self, values, weights=None, chunk_size=None):
+        '''Sum of the (weighted) values of the samples of each ensemble'''
+        return segment_sums(values, self.offsets[:-1], weights, chunk_size)
+
+
+    def segment_maxima(self, values):
+        '''Largest value of the samples of each ensemble (-inf if it has none)'''
+        maxima = numpy.repeat(-numpy.inf, self.segment_count())
+        non_empty = numpy.flatnonzero(self.sample_counts() > 0)
+        if len(non_empty) > 0:
+            maxima[non_empty] = numpy.maximum.reduceat(values, self.offsets[non_empty])
+        return maxima
+
+
+    def relative_weights(self, log_weights):
+        '''Weights given their logarithms, scaled so that the largest weight of
+each ensemble is one'''
+        maxima = self.segment_maxima(log_weights)
+        maxima[numpy.isinf(maxima)] = 0.0
+        return numpy.exp(log_weights - maxima[self.segments])
+
+
+    def effective_fractions(self, weights):
+        '''Effective number of samples (the exponential of the entropy of the
+normalized weights) relative to the number of samples, for each ensemble'''
+        p = weights/self.segment_sums(weights)[self.segments]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            entropies = -self.segment_sums(numpy.log(p)*p)
+        return numpy.exp(entropies)/self.sample_counts()
+
+
+    def energy_differences(self, parameter_deltas, chunk_size=None):
+        '''Change in energy of each sample when the parameters of its ensemble
+change by the corresponding row of parameter_deltas (segment_count x P), for
+parameters on which the energy depends linearly'''
+        parameter_deltas = numpy.asarray(parameter_deltas, dtype=numpy.float64)
+        if chunk_size == None:
+            chunk_size = len(self)
+        chunk_size = max(1, chunk_size)
+
+        differences = numpy.empty(len(self))
+        for start in range(0, len(self), chunk_size):
+            end = min(start+chunk_size, len(self))
+            differences[start:end] = numpy.einsum('ij,ij->i',
+                                                  self.derivatives[start:end].astype(numpy.float64, copy=False),
+                                                  parameter_deltas[self.segments[start:end]])
+        return differences
+
+
+    def weighted_averages(self, weights, chunk_size=None):
+        '''Weighted averages of the derivatives over each ensemble
+(segment_count x P)'''
+        return (self.segment_sums(self.derivatives, weights, chunk_size) /
+                self.segment_sums(weights)[:,numpy.newaxis])
+
+
+    def bootstrap_errors(self, weights, bootstrap_samples=200, chunk_size=None, random_state=None):
+        '''Block bootstrap standard errors of the weighted averages of the
+derivatives over each ensemble (segment_count x P)'''
+        return segment_block_bootstrap_errors(self.derivatives, weights, self.offsets,
+                                              bootstrap_samples=bootstrap_samples, random_state=random_state,
+                                              chunk_size=chunk_size)
@@ -17,7 +17,7 @@
 # along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from profasi.ProfasiEnsemble import ProfasiEnsemble
+import importlib
 
 class UnknownPlatformException(Exception):
     '''Exception used when confronted with an unknown ensemble type.'''
@@ -30,7 +30,49 @@ class UnknownPlatformException(Exception):
 
 
 class PlatformSelector:
-    '''Factory class for constructing ensembles of specific type.'''
+    '''Factory class for constructing ensembles of specific type. Platforms
+are registered by name together with the module containing their Ensemble
+implementation, which is only imported when an ensemble of that type is
+first constructed.'''
+
+    # Maps simulation type to a dictionary with the module name, class name
+    # and option help of the platform, and the class itself once it is imported
+    platforms = {}
+
+    @classmethod
+    def register_platform(self, simulation_type, module_name, class_name, option_help={}):
+        '''Register a platform. The option_help dictionary contains (name,
+description) pairs for the platform specific options, and is used for the
+command line help without importing the platform module.'''
+        self.platforms[simulation_type] = {"module_name": module_name,
+                                           "class_name": class_name,
+                                           "option_help": option_help,
+                                           "class": None}
+
+    @classmethod
+    def get_simulation_types(self):
+        '''Names of all registered platforms.'''
+        return sorted(self.platforms.keys())
+
+    @classmethod
+    def get_option_help(self, simulation_type):
+        '''Dictionary of platform specific options and their descriptions.'''
+        if not self.platforms.has_key(simulation_type):
+            raise UnknownPlatformException(simulation_type)
+        return self.platforms[simulation_type]["option_help"]
+
+    @classmethod
+    def get_ensemble_class(self, simulation_type):
+        '''Retrieve the Ensemble class of a platform, importing its module
+on first use.'''
+        if not self.platforms.has_key(simulation_type):
+            raise UnknownPlatformException(simulation_type)
+
+        platform = self.platforms[simulation_type]
+        if platform["class"] == None:
+            module = importlib.import_module(platform["module_name"])
+            platform["class"] = getattr(module, platform["class_name"])
+        return platform["class"]
 
     @classmethod
     def get_ensemble(self, simulation_type, directory, beta, iteration_range, log_level=0, platform_specific_args={}):
@@ -38,10 +80,17 @@ class PlatformSelector:
 are common to all ensembles, while platform_specific_args is a dictionary containing
 platform-specific options.'''
 
-        if simulation_type == "PROFASI":
-            ensemble = ProfasiEnsemble(log_level)
-            ensemble.set_settings(directory, beta, iteration_range, **platform_specific_args)
-            return ensemble
-        else:
-            raise UnknownPlatformException(simulation_type)
-    
+        ensemble = self.get_ensemble_class(simulation_type)(log_level)
+        ensemble.set_settings(directory, beta, iteration_range, **platform_specific_args)
+        return ensemble
+
+
+# Built-in platforms
+PlatformSelector.register_platform("PROFASI", "platforms.profasi.ProfasiEnsemble", "ProfasiEnsemble",
+                                   {'simulation_index':'Which simulation directory (n?) \n\tto use',
+                                    'temperature_index':'The index of the temperature \n\tto use for the analysis'})
+PlatformSelector.register_platform("PROFASI_REPLICAS", "platforms.profasi.ProfasiReplicaEnsemble", "ProfasiReplicaEnsemble",
+                                   {'temperature_index':'The index of the temperature \n\tto use for the analysis, \n\tunless reweight_beta is given',
+                                    'loader_threads':'Number of threads reading \n\tthe replicas (default: up to 8)'})
+PlatformSelector.register_platform("ARRAY", "platforms.array.ArrayEnsemble", "ArrayEnsemble",
+                                   {'beta':'The beta=1/(k_bT) at which \n\tthe samples were drawn \n\t(the directory is an .npz file)'})
@@ -0,0 +1,142 @@
+# SampleTable.py --- Named columns of values over the samples of an ensemble
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+from error_estimation import weighted_average
+
+
+class SampleTable:
+    '''Values of several quantities (energies, weights, derivatives) for the
+samples of an ensemble, sharing a single array of iteration indices. Columns
+are stored in blocks, each a matrix of a single type, and are accessed by name
+as views into their block. Columns added together can be retrieved together as
+a matrix view, which allows averages of all of them to be calculated in a single
+weighted reduction.'''
+
+    def __init__(self, iterations):
+        '''Constructor. The iteration indices must be in increasing order.'''
+        self.iterations = numpy.asarray(iterations)
+        self.blocks = []
+
+        # Maps column name to the index of its block and its index in the block
+        self.column_positions = {}
+
+
+    @staticmethod
+    def common_iterations(*iteration_arrays):
+        '''Iteration indices present in all of the given arrays'''
+        iterations = iteration_arrays[0]
+        for other_iterations in iteration_arrays[1:]:
+            if len(other_iterations) != len(iterations) or numpy.any(other_iterations != iterations):
+                iterations = numpy.intersect1d(iterations, other_iterations)
+        return iterations
+
+
+    @classmethod
+    def from_ensemble(cls, evaluator_path, parameters, ensemble, **vectors):
+        '''Collect the derivatives of all parameters over the ensemble in a
+SampleTable, together with the two-column (iteration, value) vectors given as
+keyword arguments, such as weight and energy. The table covers the samples
+present in all of them. If no weight vector is given, all samples get weight 1.
+The derivatives are stored as a single block, in the precision selected for the
+ensemble, with columns named after the parameters.'''
+
+        ensemble.prepare_parameter_derivatives(evaluator_path, parameters)
+        derivative_columns = [ensemble.get_parameter_derivative_columns(evaluator_path, parameter)
+                              for parameter in parameters]
+
+        iterations = cls.common_iterations(*([iterations for (iterations, values) in derivative_columns] +
+                                              [vector[:,0] for vector in vectors.values()]))
+        sample_table = cls(iterations)
+
+        names = sorted(vectors.keys())
+        if "weight" not in vectors:
+            names.append("weight")
+        sample_table.add_columns(names)
+        for name in names:
+            if name in vectors:
+                sample_table.set_column(name, vectors[name][:,0], vectors[name][:,1])
+            else:
+                sample_table.column(name)[:] = 1.0
+
+        sample_table.add_columns([parameter.get_name() for parameter in parameters], ensemble.derivative_dtype)
+        for parameter, (derivative_iterations, derivative_values) in zip(parameters, derivative_columns):
+            sample_table.set_column(parameter.get_name(), derivative_iterations, derivative_values)
+
+        return sample_table
+
+
+    def __len__(self):
+        return len(self.iterations)
+
+
+    def add_columns(self, names, dtype=numpy.float64):
+        '''Add a block of columns with the given names. Returns the block, as
+a matrix with a column for each name, for the caller to fill in.'''
+        block = numpy.empty((len(self.iterations), len(names)), dtype=dtype)
+        for i, name in enumerate(names):
+            self.column_positions[name] = (len(self.blocks), i)
+        self.blocks.append(block)
+        return block
+
+
+    def values_at(self, iterations, values):
+        '''Select the values for the iterations of the table, given values for
+the iterations in the (increasing) array iterations, which must include all
+iterations of the table.'''
+        if len(iterations) == len(self.iterations) and numpy.all(iterations == self.iterations):
+            return values
+
+        positions = numpy.minimum(numpy.searchsorted(iterations, self.iterations), len(iterations)-1)
+        if numpy.any(iterations[positions] != self.iterations):
+            raise ValueError("Values are missing for some of the samples")
+        return values[positions]
+
+
+    def set_column(self, name, iterations, values):
+        '''Fill in the column with the given name, from values for the
+iterations in the array iterations'''
+        (block_index, column_index) = self.column_positions[name]
+        self.blocks[block_index][:,column_index] = self.values_at(iterations, values)
+
+
+    def column(self, name):
+        '''View of the column with the given name'''
+        (block_index, column_index) = self.column_positions[name]
+        return self.blocks[block_index][:,column_index]
+
+
+    def get_columns(self, names):
+        '''Matrix with the named columns. This is a view if the columns were
+added together in this order, and a copy otherwise.'''
+        positions = [self.column_positions[name] for name in names]
+        block_index = positions[0][0]
+        column_indices = [column_index for (index, column_index) in positions]
+        if (all([index == block_index for (index, column_index) in positions]) and
+            column_indices == range(column_indices[0], column_indices[0]+len(names))):
+            return self.blocks[block_index][:,column_indices[0]:column_indices[0]+len(names)]
+        return numpy.column_stack([self.column(name) for name in names])
+
+
+    def weighted_average(self, names, weights="weight", chunk_size=None):
+        '''Weighted averages of the named columns, calculated together. The
+weights are given as an array, or as the name of a column.'''
+        if isinstance(weights, str):
+            weights = self.column(weights)
+        return weighted_average(self.get_columns(names), weights, chunk_size)
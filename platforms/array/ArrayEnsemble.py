@@ -0,0 +1,227 @@
+# ArrayEnsemble.py --- Ensemble held in memory as numpy arrays
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import numpy
+
+from ..Ensemble import Ensemble
+from ArrayParameter import ArrayParameter
+
+
+class ArrayEnsemble(Ensemble):
+    '''Ensemble whose samples are given directly as numpy arrays: the
+iteration indices, the energies, the derivative of the energy with respect to
+each parameter, and optionally the log-weights of the samples. No evaluator is
+used. Energies at new parameter values are extrapolated linearly from the
+derivatives, so all parameters are linear.
+
+The arrays are passed as platform specific arguments to set_settings (or with
+from_arrays). Otherwise, they are read from a numpy .npz file given as the
+directory, containing the arrays iterations, energies, derivative_<name> and
+value_<name> for each parameter, and optionally log_weights and beta.'''
+
+    # Class variable specifying the name of the platform
+    simulation_type = "ARRAY"
+
+    def __init__(self, log_level=0):
+        '''Constructor.'''
+        Ensemble.__init__(self, log_level)
+
+
+    @classmethod
+    def from_arrays(cls, iterations, energies, derivatives, parameter_values, beta=None, log_weights=None,
+                    name="array", reweight_beta=None, iteration_range=None, log_level=0):
+        '''Construct an ensemble from arrays. The derivatives and
+parameter_values are dictionaries with parameter names as keys.'''
+        ensemble = cls(log_level)
+        ensemble.set_settings(name, reweight_beta, iteration_range, beta=beta, iterations=iterations,
+                              energies=energies, derivatives=derivatives, parameter_values=parameter_values,
+                              log_weights=log_weights)
+        return ensemble
+
+
+    def set_settings(self, directory, reweight_beta, iteration_range, beta=None, iterations=None, energies=None,
+                     derivatives=None, parameter_values=None, log_weights=None):
+        '''Initialize with object with current settings, and saves them
+for future retrieval. The arrays are not part of the settings, and are read
+from the file given as directory if they are not specified.'''
+
+        if iterations is None:
+            data = numpy.load(directory)
+            iterations = data["iterations"]
+            energies = data["energies"]
+            derivatives = {}
+            parameter_values = {}
+            for key in data.files:
+                if key.startswith("derivative_"):
+                    derivatives[key[len("derivative_"):]] = data[key]
+                elif key.startswith("value_"):
+                    parameter_values[key[len("value_"):]] = float(data[key])
+            if "log_weights" in data.files:
+                log_weights = data["log_weights"]
+            if beta == None and "beta" in data.files:
+                beta = float(data["beta"])
+
+        if beta != None:
+            beta = float(beta)
+        Ensemble.set_settings(self, directory, reweight_beta, iteration_range, beta=beta)
+
+        self.iterations = numpy.asarray(iterations)
+        self.energies = numpy.asarray(energies, dtype=float)
+        self.derivatives = dict((name, numpy.asarray(values)) for name, values in derivatives.items())
+        self.parameter_values = dict(parameter_values)
+        self.log_weights = None
+        if log_weights is not None:
+            self.log_weights = numpy.asarray(log_weights, dtype=float)
+
+        if len(self.iterations) > 1 and numpy.any(numpy.diff(self.iterations) <= 0):
+            raise ValueError("Iteration indices of array ensemble must be increasing")
+        for name, values in [("energies", self.energies), ("log_weights", self.log_weights)] + self.derivatives.items():
+            if values is not None and values.shape != self.iterations.shape:
+                raise ValueError("Array %s has shape %s, expected %s" % (name, values.shape, self.iterations.shape))
+
+
+    @classmethod
+    def get_option_help(self):
+        '''Output for ensemble options used by command line parser.'''
+        return {'beta':'The beta=1/(k_bT) at which \n\tthe samples were drawn'}
+
+
+    def get_selection(self):
+        '''Slice selecting the samples in the iteration range'''
+        start, end, every = self.iteration_range
+        first = 0
+        last = len(self.iterations)
+        if start != None:
+            first = numpy.searchsorted(self.iterations, start)
+        if end != None:
+            last = numpy.searchsorted(self.iterations, end, side='right')
+        # The stride counts samples, not iterations, as for Profasi ensembles
+        return slice(first, last, every)
+
+
+    def to_ensemble_array(self, values):
+        '''Two-column (iteration, value) array of values for the samples in
+the iteration range'''
+        selection = self.get_selection()
+        output = numpy.empty((len(self.iterations[selection]), 2))
+        output[:,0] = self.iterations[selection]
+        output[:,1] = values[selection]
+        return output
+
+
+    def read_parameter_values(self, requested_parameter_list):
+        '''Retrieve current values of the parameters. New parameter objects are
+returned for each call.'''
+        parameters = []
+        for requested_parameter in requested_parameter_list:
+            if self.parameter_values.has_key(requested_parameter):
+                parameters.append(ArrayParameter(requested_parameter, self.parameter_values[requested_parameter]))
+        return parameters
+
+
+    def write_parameter_values(self, parameters, directory=None):
+        '''Array ensembles have no settings file to which parameters can be
+written, so this does nothing. The parameter values of an array ensemble are
+those at which its samples were drawn, and are given along with the arrays.'''
+        pass
+
+
+    def get_parameter_derivative_values(self, evaluator_path, parameter):
+        '''Retrieve the derivatives for a particular parameter'''
+        return self.to_ensemble_array(self.derivatives[parameter.get_name()])
+
+
+    def get_parameter_derivative_columns(self, evaluator_path, parameter):
+        '''Retrieve the derivatives for a particular parameter, as a tuple of
+iteration indices and derivative values. These are views of the arrays of the
+ensemble.'''
+        selection = self.get_selection()
+        return self.iterations[selection], self.derivatives[parameter.get_name()][selection]
+
+
+    def get_energies(self, directory=None):
+        '''Retrieve energies for all samples in the iteration range'''
+        return self.to_ensemble_array(self.energies)
+
+
+    def calculate_energies(self, parameters, evaluator_path):
+        '''Extrapolate the energies linearly to the given parameter values'''
+        selection = self.get_selection()
+        energies = self.energies[selection].copy()
+        for parameter in parameters:
+            difference = parameter.get_value() - self.parameter_values[parameter.get_name()]
+            if difference != 0:
+                energies += difference*self.derivatives[parameter.get_name()][selection]
+        output = numpy.empty((len(energies), 2))
+        output[:,0] = self.iterations[selection]
+        output[:,1] = energies
+        return output
+
+
+    def get_reweight_weights(self, energies=None):
+        '''Retrieve the weights of the samples for Boltzmann averages at the
+analysis temperature. If log-weights are given, these are used as they are.
+Otherwise, samples drawn at beta are reweighted to reweight_beta, if it is set,
+using the given energies or those of the ensemble.'''
+
+        if energies is None:
+            weights = self.get_energies()
+        else:
+            weights = numpy.array(energies)
+
+        if self.log_weights is not None:
+            log_weights = self.to_ensemble_array(self.log_weights)
+            log_weights = log_weights[numpy.searchsorted(log_weights[:,0], weights[:,0]),1]
+        elif self.reweight_beta != None and self.beta != None:
+            log_weights = -(self.reweight_beta - self.beta)*weights[:,1]
+        else:
+            log_weights = numpy.zeros(len(weights))
+
+        if len(log_weights) > 0:
+            log_weights -= numpy.max(log_weights)
+        weights[:,1] = numpy.exp(log_weights)
+        return weights
+
+
+    def get_intrinsic_beta(self):
+        '''Return the beta=1/(k_bT) at which the samples were drawn'''
+        if self.beta == None:
+            raise ValueError("No beta given for array ensemble %s" % self.directory)
+        return self.beta
+
+
+    def get_data_filenames(self):
+        '''The .npz file the arrays were read from, if any'''
+        if os.path.isfile(self.directory):
+            return [self.directory]
+        return []
+
+
+    def has_samples(self, directory=None):
+        '''Whether the ensemble has samples or, if a directory is given, whether
+it is a non-empty .npz file'''
+        if directory == None:
+            return len(self.iterations) > 0
+        return os.path.isfile(directory) and os.path.getsize(directory) > 0
+
+
+    def estimate_memory(self):
+        '''Memory used by the arrays, in bytes. These are always held in memory.'''
+        return 0
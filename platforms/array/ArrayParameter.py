@@ -0,0 +1,41 @@
+# ArrayParameter.py --- Parameter class for ensembles held in memory
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from ..Parameter import Parameter
+
+class ArrayParameter(Parameter):
+    '''Parameter of an ArrayEnsemble. Unlike platform parameters, which have
+a class for each parameter, the name is given to the object. The energy is taken
+to depend linearly on the parameter, with the derivatives given by the ensemble.'''
+
+    _type='linear'
+
+    def __init__(self, name, value):
+        '''Constructor.'''
+        self.name = name
+        Parameter.__init__(self, value)
+
+    def get_name(self):
+        '''Get parameter name.'''
+        return self.name
+
+    def get_derivative_settings(self):
+        '''The derivatives are given to the ensemble as arrays, so no settings
+are necessary.'''
+        return None
@@ -25,11 +25,16 @@ import shutil
 import numpy
 import copy
 import sys
-import subprocess
+import json
 
-from ..Ensemble import Ensemble
-from ProfasiParameters import ProfasiParameter
-from utils import SubOptions
+from ..Ensemble import Ensemble, EvaluatorException
+from ..SampleTable import SampleTable
+from ProfasiParameters import ProfasiParameter, DerivativeNotAvailableError, generate_parameter_classes
+from utils import SubOptions, FileCache
+from tracing import tracer
+from Executor import ExecutorException
+from surrogate import TaylorSurrogate
+from finite_differences import FiniteDifferenceDerivatives
 
 
 class ProfasiEnsemble(Ensemble):
@@ -43,7 +48,34 @@ class ProfasiEnsemble(Ensemble):
     simulation_type = "PROFASI"
 
     # For linear parameters we don't need to calculate the deriv. again
-    cachedParameterDerivatives = {}
+    cachedParameterDerivatives = FileCache()
+
+    # Content of rt files (and the corresponding rtkey) for the ensemble directories
+    cachedRtFiles = FileCache()
+
+    # Parsed muninn statics logs for generalized ensemble simulations,
+    # averagers with precomputed bin assignments for the reference energies,
+    # and the muninn log file of each ensemble directory, if any
+    cachedCanonicalAveragers = FileCache()
+
+    # Parameter classes generated from the settings files of the ensemble directories
+    cachedParameterClasses = FileCache()
+
+    # File in the ensemble directory recording the types of generated parameters
+    parameter_types_filename = "nettuno_parameter_types.json"
+
+    # Number of frames evaluated when probing whether a parameter is linear
+    linearity_probe_frames = 10
+
+    # Settings file line restricting the force field to a list of energy terms,
+    # in the format used by the derivative settings of the parameter classes.
+    # Only ensembles simulated with the force field it is derived from (the
+    # default of Profasi) are evaluated with a restricted force field.
+    restricted_force_field = "force_field FF08DR=FF08:%s"
+    restricted_force_field_base = "FF08"
+
+    # Energy surrogates used for nonlinear parameters (see calculate_surrogate_energies)
+    cachedSurrogates = FileCache()
 
     def __init__(self, log_level=0):
         '''Constructor.'''
@@ -63,8 +95,8 @@ which settings are expected by this platform.'''
     @classmethod
     def get_option_help(self):
         '''Output for ensemble options used by command line parser.'''
-        return str(SubOptions({'simulation_index':'Which simulation directory (n?) \n\tto use',
-                               'temperature_index':'The index of the temperature \n\tto use for the analysis'}))
+        from ..PlatformSelector import PlatformSelector
+        return str(SubOptions(PlatformSelector.get_option_help(self.simulation_type)))
 
 
     
@@ -73,39 +105,279 @@ which settings are expected by this platform.'''
         return self.get_parameters(requested_parameter_list)
 
 
-    def write_parameter_values(self, requested_parameter_list):
-        '''Write current parameter values in platform specific syntax.'''
-        pass
+    def get_parameters(self, requested_parameter_list):
+        '''Retrieve current force field parameters. Parameters without a
+dedicated class are supported through classes generated from the settings file
+of the ensemble.'''
+
+        settings_filename = os.path.join(self.directory, "settings.cnf")
+        rt_directory = os.path.join(self.directory, "n%s" % self.simulation_index)
+        filenames = [settings_filename]
+        if os.path.exists(os.path.join(rt_directory, "rtkey")):
+            filenames.append(os.path.join(rt_directory, "rtkey"))
+
+        def load():
+            observables = []
+            if len(filenames) > 1:
+                observables = self.read_rtkey_file(rt_directory)
+            return generate_parameter_classes(settings_filename, observables)
+
+        self.cachedParameterClasses.get(self.directory, filenames, load)
+
+        return Ensemble.get_parameters(self, requested_parameter_list)
+
+
+    def classify_parameters(self, evaluator_path, parameters):
+        '''Determine whether parameters of unknown type are linear, in which case
+their derivatives are read from the rt file rather than calculated with the
+evaluator. The result is stored on the parameter class, and recorded in a file
+in the ensemble directory so that the evaluator is only probed once for each
+parameter and evaluator.'''
+
+        parameters = [parameter for parameter in parameters if getattr(parameter, "_type", None) == None]
+        if len(parameters) == 0:
+            return
+
+        parameter_types_filename = os.path.join(self.directory, self.parameter_types_filename)
+        parameter_types = {}
+        if os.path.exists(parameter_types_filename):
+            parameter_types_file = open(parameter_types_filename)
+            parameter_types = json.load(parameter_types_file)
+            parameter_types_file.close()
+        evaluator_key = os.path.abspath(evaluator_path)
+        evaluator_parameter_types = parameter_types.setdefault(evaluator_key, {})
+
+        for parameter in parameters:
+            parameter_type = evaluator_parameter_types.get(parameter.get_name())
+            if parameter_type == None:
+                if self.probe_linearity(evaluator_path, parameter):
+                    parameter_type = 'linear'
+                else:
+                    parameter_type = 'nonlinear'
+                evaluator_parameter_types[parameter.get_name()] = parameter_type
+
+            parameter.__class__._type = str(parameter_type)
+
+            if self.log_level >= 1:
+                print "Parameter %s is %s" % (parameter.get_name(), parameter_type)
+
+        parameter_types_file = open(parameter_types_filename, 'w')
+        json.dump(parameter_types, parameter_types_file, indent=1)
+        parameter_types_file.close()
+
+
+    def probe_linearity(self, evaluator_path, parameter, tolerance=1e-4):
+        '''Check whether the energy term of a parameter is proportional to the
+value of the parameter, by running the evaluator with two different values on a
+small subset of the frames (see linearity_probe_frames). Parameters whose energy
+term does not have its own rt column are not linear in this sense.'''
+
+        if parameter._rtname == None:
+            return False
+
+        iteration_range = self.get_subset_iteration_range(self.linearity_probe_frames)
+        if iteration_range == None:
+            return False
+
+        values = [parameter.get_value(), 2.0*parameter.get_value()]
+        if parameter.get_value() == 0.0:
+            values = [1.0, 2.0]
+
+        parameter_sets = []
+        for value in values:
+            probe_parameter = copy.copy(parameter)
+            probe_parameter.set_value(value)
+            parameter_sets.append([probe_parameter])
+        energies = self.evaluate_energies(evaluator_path, parameter_sets, iteration_range, parameter._rtname)
+
+        if len(energies[0]) == 0 or len(energies[0]) != len(energies[1]):
+            return False
+
+        # Proportionality: E(a)*b = E(b)*a
+        scaled_energies = [energies[0][:,1]*values[1], energies[1][:,1]*values[0]]
+        scale = max(1.0, numpy.max(numpy.abs(scaled_energies[0])))
+        return numpy.max(numpy.abs(scaled_energies[0] - scaled_energies[1])) <= tolerance*scale
+
+
+    def get_subset_iteration_range(self, frame_count):
+        '''Iteration range selecting about frame_count frames evenly spread over
+the iteration range of the ensemble, or None if there are too few frames'''
+        iterations = self.get_energies()[:,0]
+        if len(iterations) < 2:
+            return None
+        every = max(1, len(iterations)/frame_count)*self.iteration_range[2]
+        return [int(iterations[0]), int(iterations[-1]), every]
+
+
+    def write_parameter_values(self, parameters, directory=None):
+        '''Write a settings file with the given parameter values to directory,
+based on the settings file of the ensemble. If no directory is specified, the
+settings file of the ensemble itself is overwritten.'''
+
+        if directory == None:
+            directory = self.directory
+
+        settings_file_content = self.get_settings_file_content(parameters)
+
+        settings_file = open(os.path.join(directory, "settings.cnf"), 'w')
+        settings_file.write(settings_file_content)
+        settings_file.close()
+
+
+    def get_settings_file_content(self, parameters):
+        '''Content of the settings file of the ensemble, with the values of
+the given parameters substituted.'''
+
+        # Read in original settings file
+        settings_filename = self.directory + "/settings.cnf" 
+        settings_file = open(settings_filename)
+        settings_file_lines = settings_file.readlines()
+        settings_file.close()
+
+        settings_file_lines_dict = {}
+        for i,line in enumerate(settings_file_lines):
+
+            split_line = line.strip().split()
+
+            if len(split_line) == 0:
+                continue
+
+            settings_file_lines_dict[split_line[0].upper()] = i
+
+        # Group parameters by the settings file line they appear on
+        parameter_dict = {}
+        for parameter in parameters:
+            key = parameter.get_term_name_settings_file()
+            if not parameter_dict.has_key(key):
+                parameter_dict[key] = []
+            parameter_dict[key].append(parameter)
+
+        for key in parameter_dict.keys():
+
+            # Keep other values on the line of the energy term
+            tokens = []
+            line_number = settings_file_lines_dict.get(key.upper())
+            if line_number != None:
+                tokens = settings_file_lines[line_number].strip().split()[1:]
+
+            for parameter in parameter_dict[key]:
+                for i, existing_token in enumerate(tokens):
+                    name = existing_token.split(":")[0]
+                    if name.upper() == parameter.get_partial_name().upper():
+                        tokens[i] = name + ":" + repr(parameter.get_value())
+                        break
+                else:
+                    tokens.append(parameter.get_partial_name() + ":" + repr(parameter.get_value()))
+
+            line = key + " " + " ".join(tokens) + "\n"
+            if line_number != None:
+                settings_file_lines[line_number] = line
+            else:
+                if len(settings_file_lines) > 0 and not settings_file_lines[-1].endswith("\n"):
+                    settings_file_lines[-1] += "\n"
+                settings_file_lines.append(line)
+
+        return "".join(settings_file_lines)
 
     def get_observable_values(self, observable_name, directory=None ):
         '''Retrieve specified column of rt file of the ensemble. Note that this
 method does conduct any new evaluations but simply retrieves values.'''
 
-        # If no directory is specified, use the one associated with this ensemble
-        if not directory:
-            directory = os.path.join(self.directory, "n%s" % self.simulation_index)
+        with tracer.span("get_observable_values", observable=observable_name):
+
+            # If no directory is specified, use the one associated with this ensemble
+            cached = not directory
+            if cached:
+                directory = os.path.join(self.directory, "n%s" % self.simulation_index)
+            rt_filenames = [os.path.join(directory, "rt"), os.path.join(directory, "rtkey")]
 
-        # Read in rt file
-        rt_filename = os.path.join(directory, "rt")
-        rt_matrix = genfromtxt(rt_filename)
+            if self.memory_bounded:
 
-        print "*** In get_observable_values, reading: ", rt_filename
+                # Only read the iteration and observable columns. In the
+                # ensemble's own directory, columns are cached individually
+                if cached:
+                    rtcolumn = self.cachedRtFiles.get((directory, observable_name), rt_filenames,
+                                                      lambda: self.read_rt_columns(directory, observable_name))
+                else:
+                    rtcolumn = self.read_rt_columns(directory, observable_name)
 
-        # Find out how to associate rtkey with rt file
-        rtkeyFile = open(os.path.join(directory, "rtkey"))
-        self.observables = [line.rstrip("\n ") for line in rtkeyFile.readlines()[1:]]        
-        colindex = self.observables.index(observable_name)
+            else:
+
+                # The ensemble's own rt file is cached
+                if cached:
+                    rt_matrix, self.observables = self.cachedRtFiles.get(directory, rt_filenames,
+                                                                         lambda: self.read_rt_file(directory))
+                else:
+                    rt_matrix, self.observables = self.read_rt_file(directory)
+
+                colindex = self.observables.index(observable_name)
 
+                rtcolumn = rt_matrix[:,0:colindex+1:colindex]
 
-        rtcolumn = rt_matrix[:,0:colindex+1:colindex]
+            # Optionally limit rtcolumn to a specified range. This also
+            # ensures that the cached data is not returned directly.
+            limits = copy.copy(self.iteration_range)
+            if limits[0] == None:
+                limits[0] = 0
+            if limits[1] == None:
+                limits[1] = max(rtcolumn[:,0])
+            rtcolumn = rtcolumn[numpy.logical_and.reduce([rtcolumn[:,0] >= limits[0], rtcolumn[:,0] <= limits[1]])]
 
-        # Optionally limit rtcolumn to a specified range
-        limits = copy.copy(self.iteration_range)
-        if limits[0] == None:
-            limits[0] = 0
-        if limits[1] == None:
-            limits[1] = max(rtcolumn[:,0])
-        rtcolumn = rtcolumn[numpy.logical_and.reduce([rtcolumn[:,0] >= limits[0], rtcolumn[:,0] <= limits[1]])]
+            # Apply the stride to the ensemble's own samples. Evaluator output
+            # is already limited to every limits[2]'th frame
+            if cached and limits[2] != None and limits[2] > 1:
+                rtcolumn = rtcolumn[::limits[2]]
+
+        return rtcolumn
+
+
+    def read_rtkey_file(self, directory):
+        '''Read the names of the columns of the rt file in directory'''
+
+        rtkey_filename = os.path.join(directory, "rtkey")
+        rtkeyFile = open(rtkey_filename)
+        observables = [line.rstrip("\n ") for line in rtkeyFile.readlines()[1:]]        
+        rtkeyFile.close()
+        tracer.add_bytes_read(rtkey_filename, os.path.getsize(rtkey_filename))
+
+        return observables
+
+
+    def read_rt_file(self, directory):
+        '''Read rt file in directory, together with the names of its columns
+from the corresponding rtkey file.'''
+
+        with tracer.span("read_rt_file", directory=directory):
+
+            # Read in rt file
+            rt_filename = os.path.join(directory, "rt")
+            rt_matrix = genfromtxt(rt_filename)
+            tracer.add_bytes_read(rt_filename, os.path.getsize(rt_filename))
+
+            if self.log_level >= 3:
+                print "*** In get_observable_values, reading: ", rt_filename
+
+            # Find out how to associate rtkey with rt file
+            observables = self.read_rtkey_file(directory)
+
+        return rt_matrix, observables
+
+
+    def read_rt_columns(self, directory, observable_name):
+        '''Read only the iteration column and the column of the specified
+observable from the rt file in directory.'''
+
+        with tracer.span("read_rt_file", directory=directory, observable=observable_name):
+
+            self.observables = self.read_rtkey_file(directory)
+            colindex = self.observables.index(observable_name)
+
+            rt_filename = os.path.join(directory, "rt")
+            rtcolumn = genfromtxt(rt_filename, usecols=(0, colindex))
+            tracer.add_bytes_read(rt_filename, os.path.getsize(rt_filename))
+
+            if self.log_level >= 3:
+                print "*** In get_observable_values, reading column %s of: %s" % (observable_name, rt_filename)
 
         return rtcolumn
     
@@ -131,51 +403,191 @@ to an evaluator program'''
                 energies[:,1] += (parameter.get_value() - ensemble_parameter_value) * derivatives[:,1]
             return energies
             
-        # Read in original settings file
-        settings_filename = self.directory + "/settings.cnf" 
-        settings_file = open(settings_filename)
+        if self.surrogate_tolerance != None:
+            return self.calculate_surrogate_energies(parameters, evaluator_path)
 
-        settings_file_lines = settings_file.readlines()
-        settings_file_lines_dict = {}
-        for i,line in enumerate(settings_file_lines):
+        energies = self.evaluate_energies(evaluator_path, [parameters])[0]
 
-            split_line = line.strip().split()
+        assert(len(energies) != 0)
 
-            if len(split_line) == 0:
-                continue
+        return energies
 
-            settings_file_lines_dict[split_line[0]] = i
 
-        # Construct new settings file
-        parameter_dict = {}
+    def calculate_surrogate_energies(self, parameters, evaluator_path):
+        '''Calculate energies given a set of parameter values from a TaylorSurrogate
+of the energy of each frame. The surrogate is validated against an evaluator run on
+a subset of the frames (see surrogate_validation_frames), and fitted again around
+the parameter values if its error exceeds surrogate_tolerance.'''
+
+        rt_filename = os.path.join(self.directory, "n%s" % self.simulation_index, "rt")
+        settings_filename = os.path.join(self.directory, "settings.cnf")
+        key = (self.simulation_type, self.directory, self.simulation_index,
+               tuple([parameter.get_name() for parameter in parameters]), tuple(self.iteration_range))
+
+        # Holds the current surrogate, which is discarded when the data changes
+        surrogate_holder = self.cachedSurrogates.get(key, [rt_filename, settings_filename], lambda: [None])
+
+        values = numpy.array([parameter.get_value() for parameter in parameters])
+        surrogate = surrogate_holder[0]
+
+        if surrogate != None:
+            iteration_range = self.get_subset_iteration_range(self.surrogate_validation_frames)
+            validation_energies = self.evaluate_energies(evaluator_path, [parameters], iteration_range)[0]
+            error = self.get_beta()*numpy.max(numpy.abs(surrogate.evaluate(values, validation_energies[:,0]) -
+                                                        validation_energies[:,1]))
+            if self.log_level >= 2:
+                print "Energy surrogate error at %s: %s kT" % (values, error)
+            if error > self.surrogate_tolerance:
+                surrogate = None
+
+        if surrogate == None:
+            if self.log_level >= 1:
+                print "Fitting energy surrogate for %s at %s" % (self.directory, values)
+            surrogate = TaylorSurrogate(values, self.surrogate_step*numpy.maximum(numpy.abs(values), 1.0))
+            parameter_sets = []
+            for point in surrogate.get_design_points():
+                point_parameters = copy.deepcopy(parameters)
+                for parameter, value in zip(point_parameters, point):
+                    parameter.set_value(value)
+                parameter_sets.append(point_parameters)
+            design_energies = self.evaluate_energies(evaluator_path, parameter_sets)
+            surrogate.fit(design_energies[0][:,0], [energies[:,1] for energies in design_energies])
+            surrogate_holder[0] = surrogate
+
+        energies = numpy.empty((len(surrogate.iterations), 2))
+        energies[:,0] = surrogate.iterations
+        energies[:,1] = surrogate.evaluate(values)
+        return energies
+
+
+    def evaluate_energies(self, evaluator_path, parameter_sets, iteration_range=None, observable_name="Etot"):
+        '''Run the evaluator for each of a list of sets of parameter values, and
+return the values of the specified observable for each of them. All runs are
+submitted to the executor before waiting for any of them.'''
+
+        with tracer.span("evaluate_energies", directory=self.directory, runs=len(parameter_sets)) as span:
+            with tracer.child_process_usage(span):
+                evaluations = [self.submit_energy_evaluation(evaluator_path, parameters, iteration_range, observable_name)
+                               for parameters in parameter_sets]
+                return [self.collect_energy_evaluation(evaluation) for evaluation in evaluations]
+
+
+    def get_evaluation_terms(self, parameters):
+        '''Energy terms depending on the parameters, which are the only terms
+that need to be evaluated when the parameters change. None if the evaluation cannot
+be restricted, because it is disabled (see term_restricted_evaluation), the
+ensemble was not simulated with the force field the restricted force field is
+derived from, or some parameter is not associated with an rt column.'''
+        if not self.term_restricted_evaluation:
+            return None
+        if self.get_force_field() != self.restricted_force_field_base:
+            return None
+        terms = []
         for parameter in parameters:
-            if not parameter_dict.has_key(parameter.get_term_name()):
-                parameter_dict[parameter.get_term_name_settings_file()] = []
-            parameter_dict[parameter.get_term_name_settings_file()].append(parameter)
+            term = getattr(parameter, "_rtname", None)
+            if term == None:
+                return None
+            if term not in terms:
+                terms.append(term)
+        return terms
 
-        for key in parameter_dict.keys():
-            value = ""
-            for parameter in parameter_dict[key]:
-                value += parameter.get_partial_name() + ":" + repr(parameter.get_value()) + " "
-            value += "\n"
 
-            line_number = settings_file_lines_dict[key]
-            settings_file_lines[line_number] = key + " " + value
+    def get_force_field(self):
+        '''Force field given in the settings file of the ensemble, or the default
+force field of Profasi if none is given'''
+        force_field = self.restricted_force_field_base
+        settings_file = open(os.path.join(self.directory, "settings.cnf"))
+        for line in settings_file:
+            split_line = line.strip().split()
+            if len(split_line) > 1 and split_line[0].lower() == "force_field":
+                force_field = split_line[1]
+        settings_file.close()
+        return force_field
+
 
-        settings_file_content = "".join(settings_file_lines)
+    def get_term_restricted_settings_file_content(self, parameters, terms):
+        '''Content of the settings file of the ensemble with the values of the
+given parameters substituted, and the force field restricted to the given terms'''
+        lines = self.get_settings_file_content(parameters).splitlines(True)
+        force_field_line = self.restricted_force_field % ":".join(terms) + "\n"
+        for i, line in enumerate(lines):
+            split_line = line.strip().split()
+            if len(split_line) > 0 and split_line[0].lower() == "force_field":
+                lines[i] = force_field_line
+                break
+        else:
+            if len(lines) > 0 and not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            lines.append(force_field_line)
+        return "".join(lines)
+
+
+    def submit_energy_evaluation(self, evaluator_path, parameters, iteration_range=None, observable_name="Etot"):
+        '''Submit an evaluator run for a set of parameter values. For the total
+energy, the evaluator only calculates the energy terms depending on the parameters
+when possible (see get_evaluation_terms), and the remaining terms are taken from the
+rt file of the ensemble. Returns an object to be passed to collect_energy_evaluation.'''
+
+        terms = self.get_evaluation_terms(parameters)
+        if terms == None:
+            job = self.submit_evaluator(evaluator_path, self.get_settings_file_content(parameters), iteration_range)
+        elif len(terms) == 0 and observable_name == "Etot":
+            # The energies are those of the ensemble itself
+            job = None
+        else:
+            job = self.submit_evaluator(evaluator_path, self.get_term_restricted_settings_file_content(parameters, terms),
+                                        iteration_range)
+        return (job, terms, iteration_range, observable_name)
 
-        energies = self.run_evaluator(evaluator_path, settings_file_content)
 
-        assert(len(energies) != 0)
+    def collect_energy_evaluation(self, evaluation):
+        '''Wait for an evaluation submitted with submit_energy_evaluation, and
+return the values of the observable. Total energies from term restricted runs are
+calculated as Etot_ref - sum(terms_ref) + sum(terms_new), where the reference values
+are those in the rt file of the ensemble.'''
 
-        return energies
+        (job, terms, iteration_range, observable_name) = evaluation
+        if terms == None or observable_name != "Etot":
+            return self.collect_evaluator(job, observable_name)
+
+        # Energy of the terms that are not evaluated again
+        energies = self.get_energies()
+        for term in terms:
+            energies[:,1] -= self.get_observable_values(term)[:,1]
+
+        if job == None:
+            if iteration_range == None:
+                return energies
+            energies = energies[numpy.logical_and(energies[:,0] >= iteration_range[0], energies[:,0] <= iteration_range[1])]
+            return energies[::max(1, iteration_range[2]/self.iteration_range[2])]
+
+        # The total energy of the restricted force field is the sum of the terms
+        term_energies = self.collect_evaluator(job)
+        term_energies[:,1] += SampleTable(term_energies[:,0]).values_at(energies[:,0], energies[:,1])
+        return term_energies
+
+
+    def run_evaluator(self, evaluator_path, settings_file_content, observable_name="Etot"):
+        '''Wrapper code to run the evaluator given the specified settings.
+Returns the values of the specified observable.'''
 
+        with tracer.span("run_evaluator", directory=self.directory) as span:
+            with tracer.child_process_usage(span):
+                job = self.submit_evaluator(evaluator_path, settings_file_content)
+                return self.collect_evaluator(job, observable_name)
 
-    def run_evaluator(self, evaluator_path, settings_file_content):
-        '''Wrapper code to run the evaluator given the specified settings.'''
+
+    def submit_evaluator(self, evaluator_path, settings_file_content, iteration_range=None):
+        '''Submit an evaluator run with the specified settings to the executor,
+without waiting for it to finish. The run covers the iteration range of the
+ensemble, unless another iteration_range is given. Returns a job to be passed to
+collect_evaluator.'''
+
+        if iteration_range == None:
+            iteration_range = self.iteration_range
 
         # Prefix for temporary directory
-        tmp_dir = tempfile.mkdtemp(prefix="nettuno_")
+        tmp_dir = tempfile.mkdtemp(prefix="nettuno_", dir=self.executor.scratch_directory)
 
         if self.log_level >= 5:
             print "Using temporary directory: ",tmp_dir
@@ -188,19 +600,19 @@ to an evaluator program'''
 
         # If specified, limit simulation to range
         start_str = ""
-        if self.iteration_range[0] != None:
-            start_str = "--start %s" % self.iteration_range[0]
+        if iteration_range[0] != None:
+            start_str = "--start %s" % iteration_range[0]
         end_str = ""
-        if self.iteration_range[1] != None:
-            end_str = "--end %s" % self.iteration_range[1]
+        if iteration_range[1] != None:
+            end_str = "--end %s" % iteration_range[1]
         interval_str = ""
-        if self.iteration_range[1] != 1:
-            interval_str = "--every %s" % self.iteration_range[2]
+        if iteration_range[2] != 1:
+            interval_str = "--every %s" % iteration_range[2]
 
-        command_line = "cd %s; %s %s %s %s --get_rt %s/n%s/traj &> out.txt" % (tmp_dir, os.path.abspath(evaluator_path), 
-                                                                               start_str, end_str, interval_str,
-                                                                               os.path.abspath(self.directory), 
-                                                                               self.simulation_index)
+        command_line = "cd %s; %s %s %s %s --get_rt %s/n%s/traj > out.txt 2>&1" % (tmp_dir, os.path.abspath(evaluator_path), 
+                                                                                   start_str, end_str, interval_str,
+                                                                                   os.path.abspath(self.directory), 
+                                                                                   self.simulation_index)
         if self.log_level >= 5:
             print "Command line: ", command_line
 
@@ -208,43 +620,141 @@ to an evaluator program'''
             print "Running evaluator...",
             sys.stdout.flush()
 
-        # Call evaluator
-        subprocess.call(command_line, shell=True)
+        try:
+            job = self.executor.submit(command_line, tmp_dir)
+        except ExecutorException, e:
+            shutil.rmtree(tmp_dir)
+            raise EvaluatorException("Evaluator could not be submitted for %s: %s" % (self.directory, e.value))
 
-        if self.log_level >=1:
-            print "done"
+        return job
+
+
+    def collect_evaluator(self, job, observable_name="Etot"):
+        '''Wait for an evaluator run submitted with submit_evaluator to finish,
+and return the resulting values of the specified observable (by default the
+energies). Raises EvaluatorException if it failed.'''
+
+        tmp_dir = job.working_directory
 
-        values = self.get_energies(tmp_dir)
+        try:
+            try:
+                self.executor.collect(job)
+            except ExecutorException, e:
 
-        # Remove temporary directory
-        shutil.rmtree(tmp_dir)
+                # Include the end of the evaluator output in the error
+                output = ""
+                output_filename = os.path.join(tmp_dir, "out.txt")
+                if os.path.exists(output_filename):
+                    output_file = open(output_filename)
+                    output = "".join(output_file.readlines()[-10:])
+                    output_file.close()
+                raise EvaluatorException("Evaluator failed for %s: %s\n%s" % (self.directory, e.value, output))
+
+            if self.log_level >=1:
+                print "done"
+
+            values = self.get_observable_values(observable_name, tmp_dir)
+
+        finally:
+            # Remove temporary directory
+            shutil.rmtree(tmp_dir)
         
         return values
 
 
+    def get_data_filenames(self):
+        '''The rt file, the settings file and, for generalized ensembles, the
+muninn log file'''
+        filenames = [os.path.join(self.directory, "n%s" % self.simulation_index, "rt"),
+                     os.path.join(self.directory, "settings.cnf")]
+        muninn_filename = self.get_muninn_filename()
+        if muninn_filename != None:
+            filenames.append(muninn_filename)
+        return filenames
+
+
+    def has_samples(self, directory=None):
+        '''Whether the rt file in directory (by default the directory of the
+ensemble) is non-empty. The file is not read.'''
+        if directory == None:
+            directory = self.directory
+        rt_filename = os.path.join(directory, "n%s" % self.simulation_index, "rt")
+        return os.path.exists(rt_filename) and os.path.getsize(rt_filename) > 0
+
+
+    def get_muninn_filename(self):
+        '''Return the filename of the muninn log file if the ensemble was
+simulated in a generalized ensemble, and None otherwise. This is determined once
+per directory, and again when the directory is modified.'''
+        muninn_filename = self.directory + "/muninn.txt"
+
+        def load():
+            if os.path.exists(muninn_filename):
+                return muninn_filename
+            return None
+
+        return self.cachedCanonicalAveragers.get(("muninn_filename", self.directory), [self.directory], load)
+
+
+    def get_canonical_averager(self, muninn_filename):
+        '''Retrieve CanonicalAverager for the muninn log file. Parsed log
+files are cached, and only read again if the file has been modified.'''
+
+        from external.muninn_scripts.details.CanonicalAverager import CanonicalAverager
+
+        def load():
+            with tracer.span("CanonicalAverager", muninn_filename=muninn_filename):
+                ca = CanonicalAverager(muninn_filename, -1)
+                tracer.add_bytes_read(muninn_filename, ca.bytes_read)
+            return ca
+
+        return self.cachedCanonicalAveragers.get(muninn_filename, [muninn_filename], load)
+
+
+    def get_reference_canonical_averager(self, muninn_filename):
+        '''Retrieve the reference energies of the ensemble together with
+a CanonicalAveragerFixedEnergies holding their bin assignment.'''
+
+        # The reference energies depend on which rt file is used and on the range
+        rt_filename = os.path.join(self.directory, "n%s" % self.simulation_index, "rt")
+        key = (muninn_filename, rt_filename, tuple(self.iteration_range))
+
+        def load():
+            energies = self.get_energies()
+            ca = self.get_canonical_averager(muninn_filename)
+            return (energies, ca.fixed_energies(energies[:,1]))
+
+        return self.cachedCanonicalAveragers.get(key, [muninn_filename, rt_filename], load)
+
+
     def get_reweight_weights(self, energies=None):
         '''Retrieve the weights necessary when calculating Boltzmann averages
 over the ensemble. This is 1.0 when evaluating an ensemble at the same temperature
 as it was simulated, but can be used both to reweight constant temperature simulations
 to a different temperature, or for generalized ensembles.'''
 
-        if energies == None:
-            energies = self.get_energies()
-
-        # Transfer the index column
-        weights = copy.copy(energies)
-        
         # Check for muninn log file (suggesting a generalized ensemble simulation)
-        muninn_filename = self.directory + "/muninn.txt" 
-        if os.path.exists(muninn_filename):
-        
-            from external.muninn_scripts.details.CanonicalAverager import CanonicalAverager
-            ca = CanonicalAverager(muninn_filename, -1)
-            
-            weights[:,1] = ca.calc_weights(energies[:,1], float(self.reweight_beta))
+        muninn_filename = self.get_muninn_filename()
+        if muninn_filename:
+
+            if energies is None:
+                # Use the cached bin assignment of the reference energies
+                energies, fixed_energy_averager = self.get_reference_canonical_averager(muninn_filename)
+                weights = copy.copy(energies)
+                weights[:,1] = fixed_energy_averager.calc_weights(float(self.reweight_beta))
+            else:
+                ca = self.get_canonical_averager(muninn_filename)
+                weights = copy.copy(energies)
+                weights[:,1] = ca.calc_weights(energies[:,1], float(self.reweight_beta))
 
         else:
 
+            # Transfer the index column
+            if energies is None:
+                weights = self.get_energies()
+            else:
+                weights = copy.copy(energies)
+
             if (not self.reweight_beta or (self.reweight_beta - self.get_beta()) < 0.001):
                 weights[:,1] = 1.0
             else:
@@ -256,22 +766,8 @@ to a different temperature, or for generalized ensembles.'''
 
     def get_parameter_derivative_values(self, evaluator_path, parameter):
         '''Calculate the derivatives for a particular parameter.'''
-        if(parameter._type == 'linear'):
-            ensemble_parameter = self.get_parameters([parameter.get_name()])
-            ensemble_parameter_value = float(str(ensemble_parameter[0]))
-            vals=[]
-            # Want to cache linear derivative values
-            cache_id = self.directory + parameter.get_name() 
-            if(cache_id in self.cachedParameterDerivatives):
-                print self.directory
-                print "[Linear] Derivatives are cached"
-                vals=self.cachedParameterDerivatives[cache_id]
-            else:
-                print "linear parameter, scaling back rt values ", parameter._rtname , " ", ensemble_parameter_value
-                vals = self.get_observable_values(parameter._rtname)
-                vals[:,1] = vals[:,1] * (1.0 / ensemble_parameter_value)            
-                self.cachedParameterDerivatives[cache_id] = vals
-            return vals 
+        if(parameter._type == 'linear' or self.uses_finite_differences(parameter)):
+            return numpy.column_stack(self.get_parameter_derivative_columns(evaluator_path, parameter))
         print "[Nonlinear] parameter, need to do something else"
         settings_file_content = parameter.get_derivative_settings()
         print "with settings file: ", settings_file_content
@@ -279,6 +775,103 @@ to a different temperature, or for generalized ensembles.'''
         return values
 
 
+    def get_parameter_derivative_columns(self, evaluator_path, parameter):
+        '''Calculate the derivatives for a particular parameter, as a tuple of
+iteration indices and derivative values. For linear parameters and parameters
+differentiated by finite differences, the cached arrays are returned, which must
+not be modified.'''
+        if(parameter._type == 'linear'):
+            ensemble_parameter = self.get_parameters([parameter.get_name()])
+            ensemble_parameter_value = float(str(ensemble_parameter[0]))
+            # Want to cache linear derivative values. They are recalculated
+            # if the rt file changes, for instance while a simulation is running
+            (cache_id, filenames) = self.get_derivative_cache_key(parameter)
+
+            def load():
+                print "linear parameter, scaling back rt values ", parameter._rtname , " ", ensemble_parameter_value
+                vals = self.get_observable_values(parameter._rtname)
+
+                # Derivatives are stored with the precision selected for the
+                # ensemble, while the iteration indices keep full precision
+                return (numpy.array(vals[:,0]), (vals[:,1] * (1.0 / ensemble_parameter_value)).astype(self.derivative_dtype))
+
+            return self.cachedParameterDerivatives.get(cache_id, filenames, load)
+
+        if self.uses_finite_differences(parameter):
+            (cache_id, filenames) = self.get_derivative_cache_key(parameter)
+            return self.cachedParameterDerivatives.get(cache_id, filenames,
+                                                       lambda: self.calculate_finite_difference_derivatives(evaluator_path,
+                                                                                                            [parameter])[0])
+
+        return Ensemble.get_parameter_derivative_columns(self, evaluator_path, parameter)
+
+
+    def get_derivative_cache_key(self, parameter):
+        '''Key of the cached derivatives of a parameter, and the files on which
+they depend'''
+        cache_id = (self.directory, self.simulation_index, parameter.get_name(), tuple(self.iteration_range))
+        rt_filename = os.path.join(self.directory, "n%s" % self.simulation_index, "rt")
+        settings_filename = os.path.join(self.directory, "settings.cnf")
+        return cache_id, [rt_filename, settings_filename]
+
+
+    def uses_finite_differences(self, parameter):
+        '''Whether the derivatives of a nonlinear parameter are calculated by
+finite differences, which is the case for parameters without settings for an
+analytical derivative'''
+        if parameter._type == 'linear':
+            return False
+        try:
+            parameter.get_derivative_settings()
+        except DerivativeNotAvailableError:
+            return True
+        return False
+
+
+    def calculate_finite_difference_derivatives(self, evaluator_path, parameters):
+        '''Calculate the derivatives of parameters by finite differences around
+the parameter values of the ensemble. Returns a list with a tuple of iteration
+indices and derivative values for each parameter.'''
+        ensemble_parameters = self.get_parameters([parameter.get_name() for parameter in parameters])
+        engine = FiniteDifferenceDerivatives(self.finite_difference_order, self.finite_difference_step,
+                                             log_level=self.log_level)
+        return [(numpy.array(values[:,0]), values[:,1].astype(self.derivative_dtype))
+                for values in engine.calculate(self, evaluator_path, ensemble_parameters)]
+
+
+    def prepare_parameter_derivatives(self, evaluator_path, parameters):
+        '''Calculate the finite difference derivatives of all parameters that
+need them and are not cached, together, so that their evaluator runs are
+submitted concurrently and share a single run at the unperturbed parameters'''
+
+        parameters = [parameter for parameter in parameters
+                      if self.uses_finite_differences(parameter) and
+                      not self.cachedParameterDerivatives.is_current(*self.get_derivative_cache_key(parameter))]
+        if len(parameters) == 0:
+            return
+
+        derivatives = self.calculate_finite_difference_derivatives(evaluator_path, parameters)
+        for parameter, parameter_derivatives in zip(parameters, derivatives):
+            (cache_id, filenames) = self.get_derivative_cache_key(parameter)
+            self.cachedParameterDerivatives.get(cache_id, filenames, lambda: parameter_derivatives)
+
+
+    def prefetch(self):
+        '''Load the rt file and, for generalized ensembles, the muninn log of
+the ensemble into the caches.'''
+        self.get_energies()
+
+        muninn_filename = self.get_muninn_filename()
+        if muninn_filename:
+            self.get_reference_canonical_averager(muninn_filename)
+
+
+    def estimate_memory(self):
+        '''Estimate of the memory used by prefetch(), in bytes. The rt file is
+stored as doubles, taking roughly as much space as its text representation.'''
+        return os.path.getsize(os.path.join(self.directory, "n%s" % self.simulation_index, "rt"))
+
+
     def get_intrinsic_beta(self):
         '''Return the beta=1/(k_bT) at which the simulation was conducted, or
 None if it was conducted in a generalized ensemble. '''
@@ -286,8 +879,7 @@ None if it was conducted in a generalized ensemble. '''
         # Check if muninn output file is available
         # if so, we return None to indicate that the simulation
         # cannot be said to have a corresponding beta
-        muninn_filename = self.directory + "/muninn.txt" 
-        if os.path.exists(muninn_filename):
+        if self.get_muninn_filename():
 
             # When doing a generalize ensemble, a reweighting temperature 
             # option must be specified
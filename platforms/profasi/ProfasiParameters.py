@@ -30,6 +30,17 @@ class ParameterValueNotFoundError(Exception):
 
 
 
+class DerivativeNotAvailableError(Exception):
+    '''Exception raised when no derivative settings exist for a parameter.'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "No derivative settings available for parameter: " + repr(self.value)
+
+
+
 class ProfasiParameter(Parameter):
     '''Base class for all profasi parameters. Contains functionality to 
 read write Profasi style parameters.'''
@@ -131,3 +142,103 @@ class ProfasiHBMMScale(ProfasiParameter):
         '''Get settings necessary to calculate derivative.'''
         settings_content = "main_chain_hydrogenbonds_pars SCALE:1.0\nforce_field FF08DR=FF08:HBMM"
         return settings_content
+
+
+
+
+class ProfasiGeneratedParameter(ProfasiParameter):
+    '''Base class for parameter classes generated from the settings file of an
+ensemble (see generate_parameter_classes). Whether the parameter is linear, that
+is, whether its energy term is proportional to its value, is not known in
+advance. It is determined by the ensemble (see ProfasiEnsemble.classify_parameters),
+which sets _type on the class.'''
+
+    # Name used for the parameter in the settings file
+    _settings_name='UNDEFINED'
+
+    # None until classified as 'linear' or 'nonlinear'
+    _type=None
+
+    # Name of the rt column of the energy term, or None if not available
+    _rtname=None
+
+    def __init__(self, directory):
+        '''Constructor.'''
+        ProfasiParameter.__init__(self, directory)
+
+    def get_derivative_settings(self):
+        '''Get settings necessary to calculate derivative. Only available for
+linear parameters, for which the derivative is the energy term at unit value.'''
+        if self._type != 'linear':
+            raise DerivativeNotAvailableError(self.get_name())
+        settings_content = "%s %s:1.0\nforce_field FF08DR=FF08:%s" % (self.get_term_name_settings_file(),
+                                                                     self._settings_name, self._rtname)
+        return settings_content
+
+
+
+# Rt column names of energy terms, for terms where the column name is not the
+# term name with the underscores removed
+rt_names = {'main_chain_hydrogenbonds': 'HBMM'}
+
+
+def find_rt_name(term_name, observables):
+    '''Name of the rt column containing the energy term, if any'''
+    if rt_names.has_key(term_name) and rt_names[term_name] in observables:
+        return rt_names[term_name]
+    for observable in observables:
+        if observable.replace("_", "").upper() == term_name.replace("_", "").upper():
+            return observable
+    return None
+
+
+def generate_parameter_classes(settings_filename, observables):
+    '''Create ProfasiParameter classes for all numerical parameters of the
+energy terms in a settings file (lines of the form <term>_pars NAME:value ...),
+unless a class for the parameter already exists. The energy term is associated
+with its column among observables, the column names of the rt file. Returns the
+list of generated classes.'''
+
+    existing_names = set()
+    def add_names(cls):
+        for subclass in cls.__subclasses__():
+            if subclass is not ProfasiGeneratedParameter:
+                existing_names.add(subclass.get_name())
+            add_names(subclass)
+    add_names(ProfasiParameter)
+
+    settings_file = open(settings_filename)
+    settings_file_lines = settings_file.readlines()
+    settings_file.close()
+
+    classes = []
+    for line in settings_file_lines:
+        split_line = line.strip().split()
+        if len(split_line) == 0 or not split_line[0].lower().endswith("_pars"):
+            continue
+
+        term_name = split_line[0][:-len("_pars")].lower()
+        for token in split_line[1:]:
+            split_token = token.split(":")
+            if len(split_token) != 2:
+                continue
+            try:
+                float(split_token[1])
+            except ValueError:
+                continue
+
+            name = term_name + "_" + split_token[0].lower()
+            if name in existing_names:
+                continue
+
+            class_name = "Profasi" + "".join([word.capitalize() for word in name.split("_")])
+            cls = type(class_name, (ProfasiGeneratedParameter,),
+                       {'__doc__': "Generated parameter class for the %s parameter in the %s term." % (split_token[0], term_name),
+                        '_name': split_token[0].lower(),
+                        '_settings_name': split_token[0],
+                        '_term_name': term_name,
+                        '_rtname': find_rt_name(term_name, observables)})
+            existing_names.add(name)
+            classes.append(cls)
+
+    return classes
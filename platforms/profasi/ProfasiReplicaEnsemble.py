@@ -0,0 +1,339 @@
+# ProfasiReplicaEnsemble.py --- All replicas of a Profasi run as a single ensemble
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import sys
+import threading
+import numpy
+
+from ..Ensemble import Ensemble
+from ProfasiEnsemble import ProfasiEnsemble
+from utils import FileCache
+from reweighting import mbar_free_energies, mbar_weights
+from tracing import tracer
+
+
+class ProfasiReplicaEnsemble(ProfasiEnsemble):
+    '''Ensemble combining all replicas (the n<i> directories) of a Profasi
+run, for instance a parallel tempering simulation. The frames of all replicas,
+sampled at all temperatures, are pooled and reweighted to the analysis
+temperature using MBAR.
+
+Frames are renumbered so that the frames of replica k have indices
+k*span + MC cycle, where span exceeds the largest MC cycle of any replica.
+The frames of a replica thus keep their relative order and spacing, and
+values from different sources can still be matched by index.'''
+
+    # Class variable specifying the name of the platform
+    simulation_type = "PROFASI_REPLICAS"
+
+    # Free energies of the temperatures, for each set of replicas
+    cachedFreeEnergies = FileCache()
+
+    # Offsets between the frame indices of consecutive replicas (see get_span)
+    cachedSpans = FileCache()
+
+    def __init__(self, log_level=0):
+        '''Constructor.'''
+        ProfasiEnsemble.__init__(self, log_level)
+
+
+    def set_settings(self, directory, reweight_beta, iteration_range,
+                     temperature_index=0, loader_threads=None):
+        '''Initialize with object with current settings, and saves them
+for future retrieval. The replicas are discovered in the directory, and a
+ProfasiEnsemble is created for each of them.'''
+        Ensemble.set_settings(self, **dict((key,value) for key, value in locals().iteritems() if key != "self"))
+
+        self.replicas = []
+        for simulation_index in self.find_simulation_indices():
+            replica = ProfasiEnsemble(self.log_level)
+            replica.set_settings(directory, reweight_beta, self.settings["iteration_range"],
+                                 simulation_index=simulation_index, temperature_index=temperature_index)
+            self.replicas.append(replica)
+
+        if len(self.replicas) == 0:
+            print "No replica directories (n<i>) found in %s" % directory
+            sys.exit(1)
+
+        # Used by the methods inherited from ProfasiEnsemble for the settings
+        # shared by all replicas, such as the temperatures
+        self.simulation_index = self.replicas[0].simulation_index
+
+
+    def find_simulation_indices(self):
+        '''Indices of the replica directories n<i> in the ensemble directory'''
+        simulation_indices = []
+        for filename in os.listdir(self.directory):
+            match = re.match("^n(\d+)$", filename)
+            if match and os.path.isdir(os.path.join(self.directory, filename)):
+                simulation_indices.append(int(match.group(1)))
+        return sorted(simulation_indices)
+
+
+    def map_replicas(self, function):
+        '''Call function on each replica, using several threads. Returns the
+list of results, in the order of the replicas.'''
+
+        thread_count = self.loader_threads
+        if thread_count == None:
+            thread_count = min(8, len(self.replicas))
+        thread_count = max(1, int(thread_count))
+
+        results = [None]*len(self.replicas)
+        errors = []
+        next_index = [0]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    index = next_index[0]
+                    next_index[0] += 1
+                if index >= len(self.replicas) or len(errors) > 0:
+                    return
+                try:
+                    results[index] = function(self.replicas[index])
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Raise the first error in the calling thread
+        if len(errors) > 0:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        return results
+
+
+    def set_iteration_range(self, start, end, every):
+        '''Change the range of iterations used in the analysis, for all
+replicas'''
+        Ensemble.set_iteration_range(self, start, end, every)
+        for replica in self.replicas:
+            replica.set_iteration_range(start, end, every)
+
+
+    def detect_iteration_range(self, evaluator_path, parameters):
+        '''Choose the start and stride of the iteration range for each replica,
+and use the most conservative choice for all of them'''
+
+        def detect(replica):
+            replica.detect_iteration_range(evaluator_path, parameters)
+            return replica.iteration_range
+
+        iteration_ranges = self.map_replicas(detect)
+        starts = [iteration_range[0] for iteration_range in iteration_ranges if iteration_range[0] != None]
+        start = None
+        if len(starts) > 0:
+            start = max(starts)
+        every = max([iteration_range[2] for iteration_range in iteration_ranges])
+        self.set_iteration_range(start, self.iteration_range[1], every)
+
+
+    def get_rt_filenames(self):
+        '''The rt files of all replicas'''
+        return [os.path.join(self.directory, "n%s" % replica.simulation_index, "rt") for replica in self.replicas]
+
+
+    def get_span(self):
+        '''Offset between the frame indices of consecutive replicas. Calculated
+once for each iteration range, and again when any of the rt files changes.'''
+
+        def load():
+            replica_energies = self.map_replicas(lambda replica: replica.get_energies())
+            return max([numpy.max(energies[:,0]) for energies in replica_energies if len(energies) > 0]) + 1
+
+        key = (self.directory, tuple(self.iteration_range))
+        return self.cachedSpans.get(key, self.get_rt_filenames(), load)
+
+
+    def combine(self, replica_values):
+        '''Combine values of the individual replicas (in the two column format
+of get_observable_values) into a single array, renumbering the frames'''
+        span = self.get_span()
+        combined = []
+        for k, values in enumerate(replica_values):
+            values = numpy.array(values, dtype=float)
+            values[:,0] += k*span
+            combined.append(values)
+        return numpy.concatenate(combined)
+
+
+    def get_observable_values(self, observable_name, directory=None):
+        '''Retrieve the values of an observable for the frames of all replicas.
+The replicas are read in parallel.'''
+        with tracer.span("get_observable_values", observable=observable_name, replicas=len(self.replicas)):
+            return self.combine(self.map_replicas(lambda replica: replica.get_observable_values(observable_name)))
+
+
+    def get_temperature_indices(self):
+        '''Index of the temperature at which each frame was sampled'''
+        return self.get_observable_values("Temperature")
+
+
+    def get_temperature_betas(self):
+        '''Inverse temperatures beta_k of the temperature indices k, as given
+by temperature.info'''
+        temperature_filename = os.path.join(self.directory, "n%s" % self.simulation_index, "temperature.info")
+        temperature_file = open(temperature_filename)
+        beta_column_index = 3
+        betas = {}
+        for line in temperature_file.readlines():
+            line = line.strip()
+            if len(line) == 0 or line[0] == "#":
+                continue
+            split_line = line.split()
+            betas[int(split_line[0])] = float(split_line[beta_column_index])
+        temperature_file.close()
+
+        return numpy.array([betas[i] for i in range(max(betas.keys())+1)])
+
+
+    def get_free_energies(self):
+        '''Free energies of all temperatures, calculated with MBAR from the
+frames of all replicas. Recalculated when any of the rt files changes.'''
+
+        rt_filenames = self.get_rt_filenames()
+        key = (self.directory, tuple(self.iteration_range))
+
+        def load():
+            with tracer.span("mbar_free_energies", directory=self.directory):
+                energies = self.get_energies()
+                temperature_indices = self.get_temperature_indices()
+                return mbar_free_energies(energies[:,1], temperature_indices[:,1], self.get_temperature_betas())
+
+        return self.cachedFreeEnergies.get(key, rt_filenames, load)
+
+
+    def get_reweight_weights(self, energies=None):
+        '''Retrieve the weights of the frames of all replicas for Boltzmann
+averages at the analysis temperature. If energies are given, for instance those
+at other parameter values, the frames are reweighted to these energies. The free
+energies of the temperatures and the MBAR mixture denominators are always those
+of the energies with which the frames were sampled.'''
+
+        temperature_indices = self.get_temperature_indices()
+        sampled_energies = self.get_energies()
+
+        if energies is None:
+            weights = sampled_energies.copy()
+        else:
+            weights = numpy.array(energies)
+            if not numpy.array_equal(weights[:,0], sampled_energies[:,0]):
+                raise ValueError("Energies given for reweighting do not match the frames of %s" % self.directory)
+
+        weights[:,1] = mbar_weights(weights[:,1], temperature_indices[:,1], self.get_temperature_betas(),
+                                    self.get_beta(), self.get_free_energies(), sampled_energies[:,1])
+        return weights
+
+
+    def get_parameter_derivative_values(self, evaluator_path, parameter):
+        '''Calculate the derivatives for a particular parameter, for the frames
+of all replicas'''
+        return self.combine(self.map_replicas(lambda replica: replica.get_parameter_derivative_values(evaluator_path,
+                                                                                                      parameter)))
+
+
+    def prepare_parameter_derivatives(self, evaluator_path, parameters):
+        '''Calculate derivatives requiring evaluator runs for all replicas
+together'''
+        self.map_replicas(lambda replica: replica.prepare_parameter_derivatives(evaluator_path, parameters))
+
+
+    def get_parameter_derivative_columns(self, evaluator_path, parameter):
+        '''Calculate the derivatives for a particular parameter, as a tuple of
+iteration indices and derivative values, for the frames of all replicas'''
+        return Ensemble.get_parameter_derivative_columns(self, evaluator_path, parameter)
+
+
+    def classify_parameters(self, evaluator_path, parameters):
+        '''Determine whether parameters of unknown type are linear, by probing
+the first replica'''
+        self.replicas[0].classify_parameters(evaluator_path, parameters)
+
+
+    def get_subset_iteration_range(self, frame_count):
+        '''Iteration range selecting about frame_count frames of each replica'''
+        return self.replicas[0].get_subset_iteration_range(frame_count)
+
+
+    def evaluate_energies(self, evaluator_path, parameter_sets, iteration_range=None, observable_name="Etot"):
+        '''Run the evaluator on the trajectories of all replicas for each of a
+list of sets of parameter values, and return the combined values of the specified
+observable for each of them. All runs are submitted before waiting for any of them.'''
+        with tracer.span("evaluate_energies", directory=self.directory, runs=len(parameter_sets),
+                         replicas=len(self.replicas)) as span:
+            with tracer.child_process_usage(span):
+                evaluations = [[replica.submit_energy_evaluation(evaluator_path, parameters, iteration_range,
+                                                                 observable_name)
+                                for replica in self.replicas]
+                               for parameters in parameter_sets]
+                return [self.combine([replica.collect_energy_evaluation(evaluation)
+                                      for replica, evaluation in zip(self.replicas, replica_evaluations)])
+                        for replica_evaluations in evaluations]
+
+
+    def run_evaluator(self, evaluator_path, settings_file_content, observable_name="Etot"):
+        '''Run the evaluator on the trajectories of all replicas. The evaluator
+runs are all submitted to the executor before waiting for any of them.'''
+        with tracer.span("run_evaluator", directory=self.directory, replicas=len(self.replicas)) as span:
+            with tracer.child_process_usage(span):
+                jobs = [replica.submit_evaluator(evaluator_path, settings_file_content) for replica in self.replicas]
+                return self.combine([replica.collect_evaluator(job, observable_name)
+                                     for replica, job in zip(self.replicas, jobs)])
+
+
+    def prefetch(self):
+        '''Load the rt files of all replicas and calculate the free energies'''
+        self.get_free_energies()
+
+
+    def estimate_memory(self):
+        '''Estimate of the memory used by prefetch(), in bytes'''
+        return sum([replica.estimate_memory() for replica in self.replicas])
+
+
+    def get_data_filenames(self):
+        '''The rt files of all replicas and the settings file'''
+        return self.get_rt_filenames() + [os.path.join(self.directory, "settings.cnf")]
+
+
+    def has_samples(self, directory=None):
+        '''Whether the rt files of all replicas in directory (by default the
+directory of the ensemble) are non-empty'''
+        for replica in self.replicas:
+            if not replica.has_samples(directory):
+                return False
+        return True
+
+
+    def get_muninn_filename(self):
+        '''Replica runs are not combined with generalized ensembles'''
+        return None
+
+
+    def get_intrinsic_beta(self):
+        '''Return the beta=1/(k_bT) of the temperature with index temperature_index'''
+        return self.get_temperature_betas()[int(self.temperature_index)]
@@ -0,0 +1,100 @@
+# reweighting.py --- Multi-temperature reweighting of combined simulations
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+
+def log_sum_exp(summands, axis=None):
+    '''Calculate log(sum(exp(summands))) along axis, avoiding overflow'''
+    summands = numpy.asarray(summands, dtype=float)
+    maximum = numpy.max(summands, axis=axis, keepdims=True)
+    maximum[numpy.isinf(maximum)] = 0.0
+    result = numpy.log(numpy.sum(numpy.exp(summands - maximum), axis=axis, keepdims=True)) + maximum
+    if axis == None:
+        return result.reshape(())
+    return numpy.squeeze(result, axis=axis)
+
+
+def mbar_log_denominators(energies, betas, sample_counts, free_energies):
+    '''Log of the MBAR mixture denominator sum_k N_k exp(f_k - beta_k E_n) for
+each sample n'''
+    with numpy.errstate(divide='ignore'):
+        log_sample_counts = numpy.log(sample_counts)
+    return log_sum_exp(log_sample_counts + free_energies - numpy.outer(energies, betas), axis=1)
+
+
+def mbar_free_energies(energies, temperature_indices, betas, tolerance=1e-8, max_iterations=10000):
+    '''Dimensionless free energies f_k = -ln Z_k of the temperatures with
+inverse temperatures betas, from samples pooled over all temperatures. The
+sample with energy energies[n] was drawn at temperature temperature_indices[n].
+The MBAR (equivalently, binless WHAM) equations are solved by self-consistent
+iteration, which is vectorized over samples and temperatures. Free energies are
+relative to the first temperature. Temperatures without samples get f_k from
+the pooled samples as well.'''
+
+    energies = numpy.asarray(energies, dtype=float)
+    betas = numpy.asarray(betas, dtype=float)
+    sample_counts = numpy.bincount(numpy.asarray(temperature_indices, dtype=int),
+                                   minlength=len(betas)).astype(float)
+
+    # Start from equal free energies
+    free_energies = numpy.zeros(len(betas))
+
+    for iteration in range(max_iterations):
+        log_denominators = mbar_log_denominators(energies, betas, sample_counts, free_energies)
+        new_free_energies = -log_sum_exp(-numpy.outer(energies, betas).T - log_denominators, axis=1)
+        new_free_energies -= new_free_energies[0]
+
+        if numpy.max(numpy.abs(new_free_energies - free_energies)) < tolerance:
+            return new_free_energies
+        free_energies = new_free_energies
+
+    return free_energies
+
+
+def mbar_log_weights(energies, betas, sample_counts, free_energies, beta, sampled_energies=None):
+    '''Log of the (unnormalized) weight of each sample for averages at inverse
+temperature beta, given the free energies of the sampled temperatures. When
+reweighting to other parameters, the energies are those at the new parameters,
+while the mixture denominators are calculated from the sampled_energies, the
+energies with which the samples were drawn.'''
+    energies = numpy.asarray(energies, dtype=float)
+    if sampled_energies is None:
+        sampled_energies = energies
+    sampled_energies = numpy.asarray(sampled_energies, dtype=float)
+    return -beta*energies - mbar_log_denominators(sampled_energies, betas, sample_counts, free_energies)
+
+
+def mbar_weights(energies, temperature_indices, betas, beta, free_energies=None, sampled_energies=None):
+    '''Normalized weights of pooled samples for averages at inverse temperature
+beta. If the energies are not those with which the samples were drawn, for
+instance when reweighting to other parameters, the sampled energies must be given
+as well (see mbar_log_weights). The free energies of the sampled temperatures
+are calculated from the sampled energies if not given.'''
+
+    if sampled_energies is None:
+        sampled_energies = energies
+
+    if free_energies is None:
+        free_energies = mbar_free_energies(sampled_energies, temperature_indices, betas)
+
+    sample_counts = numpy.bincount(numpy.asarray(temperature_indices, dtype=int),
+                                   minlength=len(betas)).astype(float)
+    log_weights = mbar_log_weights(energies, betas, sample_counts, free_energies, beta, sampled_energies)
+    log_weights -= log_sum_exp(log_weights)
+    return numpy.exp(log_weights)
@@ -0,0 +1,95 @@
+# surrogate.py --- Approximations of the energies of frames as functions of the parameters
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+
+class TaylorSurrogate:
+    '''Second-order Taylor expansion of the energy of every frame in the
+parameters around a center point:
+
+  E_n(center + d) = a_n + sum_i b_ni d_i + 1/2 sum_ij c_nij d_i d_j
+
+The coefficients of all frames are fitted together from the energies at a set of
+design points: the center, a step forward and backward along each parameter, and
+a step forward along each pair of parameters.'''
+
+    def __init__(self, center, step_sizes):
+        '''Constructor. The step sizes give the distance of the design points
+from the center along each parameter.'''
+        self.center = numpy.asarray(center, dtype=float)
+        self.step_sizes = numpy.asarray(step_sizes, dtype=float)
+        self.iterations = None
+        self.coefficients = None
+
+
+    def get_design_points(self):
+        '''Parameter values at which the energies are needed for the fit, as
+an array with a row for each point'''
+        parameter_count = len(self.center)
+        displacements = [numpy.zeros(parameter_count)]
+        for i in range(parameter_count):
+            for sign in [1.0, -1.0]:
+                displacement = numpy.zeros(parameter_count)
+                displacement[i] = sign*self.step_sizes[i]
+                displacements.append(displacement)
+        for i in range(parameter_count):
+            for j in range(i+1, parameter_count):
+                displacement = numpy.zeros(parameter_count)
+                displacement[i] = self.step_sizes[i]
+                displacement[j] = self.step_sizes[j]
+                displacements.append(displacement)
+        return self.center + numpy.array(displacements)
+
+
+    def get_features(self, points):
+        '''Terms of the expansion (1, d_i, d_i^2/2, d_i d_j for i<j) at the
+given parameter values, as an array with a row for each point'''
+        displacements = numpy.atleast_2d(points) - self.center
+        parameter_count = len(self.center)
+        features = [numpy.ones(len(displacements))]
+        features += [displacements[:,i] for i in range(parameter_count)]
+        features += [0.5*displacements[:,i]**2 for i in range(parameter_count)]
+        for i in range(parameter_count):
+            for j in range(i+1, parameter_count):
+                features.append(displacements[:,i]*displacements[:,j])
+        return numpy.column_stack(features)
+
+
+    def fit(self, iterations, energies):
+        '''Fit the coefficients of all frames, given their iteration indices and
+an array with a row of frame energies for each design point'''
+        energies = numpy.asarray(energies, dtype=float)
+        design_points = self.get_design_points()
+        if energies.shape != (len(design_points), len(iterations)):
+            raise ValueError("Expected energies of %d frames at %d design points, got array of shape %s" %
+                             (len(iterations), len(design_points), energies.shape))
+        self.iterations = numpy.asarray(iterations)
+        self.coefficients = numpy.linalg.lstsq(self.get_features(design_points), energies, rcond=None)[0]
+
+
+    def evaluate(self, values, iterations=None):
+        '''Approximate energies of the frames at the parameter values. If
+iterations are given, only the energies of these frames are returned.'''
+        coefficients = self.coefficients
+        if iterations is not None:
+            positions = numpy.minimum(numpy.searchsorted(self.iterations, iterations), len(self.iterations)-1)
+            if numpy.any(self.iterations[positions] != iterations):
+                raise ValueError("Surrogate does not cover all requested frames")
+            coefficients = coefficients[:,positions]
+        return numpy.dot(self.get_features(values), coefficients)[0]
@@ -0,0 +1,88 @@
+# test_iteration_range.py --- Tests of the iteration range of ensembles
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from platforms.array.ArrayEnsemble import ArrayEnsemble
+
+
+def correlated_series(random_state, sample_count, correlation, offset):
+    '''Autoregressive series with an initial offset that decays, mimicking
+an equilibration period'''
+    values = numpy.empty(sample_count)
+    noise = random_state.randn(sample_count)
+    values[0] = noise[0]
+    for i in range(1, sample_count):
+        values[i] = correlation*values[i-1] + noise[i]
+    return values + offset*numpy.exp(-numpy.arange(sample_count)/(0.05*sample_count))
+
+
+class TestIterationRange(unittest.TestCase):
+
+    # Samples are written every 10th iteration, so strides in samples and in
+    # iterations differ
+    spacing = 10
+    sample_count = 4000
+
+    def create_ensemble(self, iteration_range=None):
+        random_state = numpy.random.RandomState(42)
+        iterations = numpy.arange(self.sample_count)*self.spacing
+        energies = correlated_series(random_state, self.sample_count, 0.9, 20.0)
+        derivatives = {"a": correlated_series(random_state, self.sample_count, 0.8, 10.0)}
+        return ArrayEnsemble.from_arrays(iterations, energies, derivatives, {"a": 1.0}, beta=1.0,
+                                         iteration_range=iteration_range)
+
+    def test_explicit_stride_counts_samples(self):
+        # A stride sharing a factor with the spacing, which would select every
+        # sample if it counted iterations
+        ensemble = self.create_ensemble("[100:600:5]")
+        iterations = ensemble.get_energies()[:,0]
+        self.assertEqual(list(iterations), range(100, 601, 5*self.spacing))
+
+    def test_detected_range(self):
+        ensemble = self.create_ensemble()
+        ensemble.detect_iteration_range(None, ensemble.read_parameter_values(["a"]))
+        start, end, every = ensemble.iteration_range
+
+        self.assertEqual(end, None)
+        self.assertTrue(start > 0)
+        self.assertEqual(start % self.spacing, 0)
+        self.assertTrue(every > 1)
+
+        # Every'th sample after the equilibration period is used
+        all_iterations = ensemble.iterations
+        expected = all_iterations[all_iterations >= start][::every]
+        numpy.testing.assert_array_equal(ensemble.get_energies()[:,0], expected)
+        parameter = ensemble.read_parameter_values(["a"])[0]
+        numpy.testing.assert_array_equal(ensemble.get_parameter_derivative_values(None, parameter)[:,0], expected)
+
+        # The detected range is stored in the settings, and gives the same
+        # samples when used explicitly
+        explicit = self.create_ensemble(ensemble.get_settings()["iteration_range"])
+        numpy.testing.assert_array_equal(explicit.get_energies()[:,0], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+# tracing.py --- Timing and resource usage of the optimization pipeline
+# Copyright (C) 2012 Sandro Bottaro, Christian Holzgraefe, Wouter Boomsma
+#
+# This file is part of Nettuno
+#
+# Nettuno is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettuno is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import json
+import threading
+import resource
+import functools
+
+
+class Span:
+    '''A timed section of code. Spans opened while another span is open on
+the same thread become its children.'''
+
+    def __init__(self, tracer, name, attributes):
+        '''Constructor'''
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.id = None
+        self.parent_id = None
+        self.depth = 0
+        self.start = None
+        self.duration = None
+        self.children_duration = 0.0
+
+    def __enter__(self):
+        self.tracer.open_span(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        self.tracer.close_span(self)
+        return False
+
+    def set_attribute(self, name, value):
+        '''Attach a value to the span'''
+        self.attributes[name] = value
+
+    def add_to_attribute(self, name, value):
+        '''Add a value to a numeric attribute of the span'''
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+
+class NullSpan:
+    '''Span used when tracing is disabled'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, name, value):
+        pass
+
+    def add_to_attribute(self, name, value):
+        pass
+
+
+class ChildProcessUsage:
+    '''Measures the resources used by child processes that finish while
+the object is used as a context manager, and attaches them to a span'''
+
+    def __init__(self, span):
+        '''Constructor'''
+        self.span = span
+
+    def __enter__(self):
+        self.usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.span.add_to_attribute("child_user_time", usage_after.ru_utime - self.usage_before.ru_utime)
+        self.span.add_to_attribute("child_system_time", usage_after.ru_stime - self.usage_before.ru_stime)
+
+        # The maximum resident set size is only available as the maximum
+        # over all child processes so far
+        self.span.set_attribute("child_max_rss_kb", usage_after.ru_maxrss)
+        return False
+
+
+class Tracer:
+    '''Records nested timed spans, resource usage of child processes and the
+number of bytes read from each file. Disabled tracers hand out spans that do
+nothing, so instrumentation can stay in place at negligible cost.'''
+
+    def __init__(self):
+        '''Constructor'''
+        self.enabled = False
+        self.spans = []
+        self.bytes_read = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next_id = 0
+
+    def enable(self):
+        '''Start recording'''
+        self.enabled = True
+
+    def span(self, name, **attributes):
+        '''Context manager timing the enclosed code'''
+        if not self.enabled:
+            return NullSpan()
+        return Span(self, name, attributes)
+
+    def child_process_usage(self, span):
+        '''Context manager attaching the resource usage of child processes
+finishing within it to span'''
+        if not self.enabled:
+            return NullSpan()
+        return ChildProcessUsage(span)
+
+    def current_stack(self):
+        '''Stack of open spans for the calling thread'''
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def open_span(self, span):
+        '''Register span as opened on the calling thread'''
+        stack = self.current_stack()
+        with self.lock:
+            span.id = self.next_id
+            self.next_id += 1
+        if len(stack) > 0:
+            span.parent_id = stack[-1].id
+            span.depth = len(stack)
+        span.thread = threading.current_thread().name
+        stack.append(span)
+
+    def close_span(self, span):
+        '''Register span as closed'''
+        stack = self.current_stack()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].children_duration += span.duration
+        with self.lock:
+            self.spans.append(span)
+
+    def add_bytes_read(self, filename, byte_count):
+        '''Record that byte_count bytes were read from filename. The bytes
+are also attributed to the innermost open span.'''
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytes_read[filename] = self.bytes_read.get(filename, 0) + byte_count
+        stack = self.current_stack()
+        if len(stack) > 0:
+            stack[-1].add_to_attribute("bytes_read", byte_count)
+
+    def summary(self):
+        '''Aggregate the spans by name. Returns a dictionary from span name to
+a dictionary of totals.'''
+        summary = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            entry = summary.setdefault(span.name, {"count": 0, "total_time": 0.0, "self_time": 0.0,
+                                                   "child_user_time": 0.0, "child_system_time": 0.0,
+                                                   "child_max_rss_kb": 0, "bytes_read": 0})
+            entry["count"] += 1
+            entry["total_time"] += span.duration
+            entry["self_time"] += span.duration - span.children_duration
+            entry["child_user_time"] += span.attributes.get("child_user_time", 0.0)
+            entry["child_system_time"] += span.attributes.get("child_system_time", 0.0)
+            entry["child_max_rss_kb"] = max(entry["child_max_rss_kb"], span.attributes.get("child_max_rss_kb", 0))
+            entry["bytes_read"] += span.attributes.get("bytes_read", 0)
+        return summary
+
+    def format_summary(self):
+        '''Summary as a table'''
+        summary = self.summary()
+        output = "%-40s %8s %12s %12s %12s %12s %14s\n" % ("stage", "count", "total (s)", "self (s)",
+                                                           "child cpu (s)", "child rss (kB)", "bytes read")
+        for name in sorted(summary.keys(), key=lambda name: -summary[name]["total_time"]):
+            entry = summary[name]
+            output += "%-40s %8d %12.3f %12.3f %12.3f %12d %14d\n" % (name, entry["count"], entry["total_time"],
+                                                                     entry["self_time"],
+                                                                     entry["child_user_time"] + entry["child_system_time"],
+                                                                     entry["child_max_rss_kb"], entry["bytes_read"])
+        for filename in sorted(self.bytes_read.keys()):
+            output += "read %d bytes from %s\n" % (self.bytes_read[filename], filename)
+        return output
+
+    def write_json(self, filename):
+        '''Write all spans, the bytes read per file and the summary to a JSON file'''
+        with self.lock:
+            spans = list(self.spans)
+        trace = {"spans": [{"id": span.id,
+                            "parent_id": span.parent_id,
+                            "name": span.name,
+                            "thread": span.thread,
+                            "depth": span.depth,
+                            "start": span.start,
+                            "duration": span.duration,
+                            "attributes": span.attributes} for span in sorted(spans, key=lambda span: span.id)],
+                 "bytes_read": self.bytes_read,
+                 "summary": self.summary()}
+        trace_file = open(filename, 'w')
+        json.dump(trace, trace_file, indent=1, default=repr)
+        trace_file.close()
+
+
+# Tracer shared by all of Nettuno
+tracer = Tracer()
+
+
+def traced(name):
+    '''Decorator wrapping every call of a function in a span'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -17,6 +17,8 @@
 # along with Nettuno.  If not, see <http://www.gnu.org/licenses/>.
 
 import optparse
+import threading
+import os
 
 class SubOptions:
     '''Class for defining sub-options used for the command line parser'''
@@ -105,6 +107,61 @@ def vararg_callback(option, opt_str, value, parser):
     parser.values.ensure_value(option.dest, []).append(value)
     
 
+def option_list_to_dict(option_list):
+    '''Translate a list of name:value options from the command line or a
+configuration file into a dictionary'''
+    return dict([option.split(":",1) for option in option_list])
+
+
 class CallbackHasMetaVarOption(optparse.Option):
     '''Overrides default optparse Option class, giving callbacks a metavar description'''
     ALWAYS_TYPED_ACTIONS = optparse.Option.ALWAYS_TYPED_ACTIONS + ('callback',)
+
+
+
+class FileCache:
+    '''Thread-safe cache of data loaded from files. An entry is loaded again when
+the modification time of any of the files it depends on changes. Loading is locked
+per entry, so that threads requesting the same entry wait for a single load, while
+different entries can be loaded concurrently.'''
+
+    def __init__(self):
+        '''Constructor'''
+        self.entries = {}
+        self.entry_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, filenames, load_function):
+        '''Retrieve the entry for key, calling load_function to (re)load it if
+it is missing or any of the files in filenames has been modified since.'''
+
+        with self.lock:
+            entry_lock = self.entry_locks.setdefault(key, threading.Lock())
+
+        with entry_lock:
+            mtimes = tuple([os.path.getmtime(filename) for filename in filenames])
+            entry = self.entries.get(key)
+            if entry == None or entry[0] != mtimes:
+                entry = (mtimes, load_function())
+                self.entries[key] = entry
+            return entry[1]
+
+    def is_current(self, key, filenames):
+        '''Whether an entry for key exists, and none of the files in filenames
+has been modified since it was loaded'''
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry == None:
+            return False
+        return entry[0] == tuple([os.path.getmtime(filename) for filename in filenames])
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        '''Remove all entries'''
+        with self.lock:
+            self.entries = {}